@@ -0,0 +1,201 @@
+import asyncio
+import time
+
+from auctionto import aio, archive, consistency, events, rmanager, scheduler, summary
+from auctionto import constants as const
+from auctionto.auction import Auction
+
+
+async def main():
+    rmanager.flushall()
+
+    auctioneer = await aio.AsyncAuctioneer.create()
+    participant_one = await aio.AsyncParticipant.create()
+    participant_two = await aio.AsyncParticipant.create()
+
+    # Async and blocking users see the same data.
+    assert len(auctioneer.user.all()) == 1
+    assert len(participant_one.user.all()) == 2
+    assert await aio.count(aio.Participant) == 2
+
+    ret = await auctioneer.register_item("macbook", 800)
+    assert ret["status"] == "success"
+
+    ret = await auctioneer.register_item("macbook", 800)
+    assert "Item already exists." in ret["errors"]
+
+    ret = await auctioneer.create_auction("macbook")
+    assert ret["status"] == "success"
+    assert len(await auctioneer.query_all_auctions()) == 1
+
+    ret = await auctioneer.unstage_item_from_auction("macbook")
+    assert ret["status"] == "success"
+    assert len(await auctioneer.query_all_auctions()) == 0
+
+    ret = await auctioneer.register_item_and_start_auction("iphone", 400)
+    assert ret["status"] == "success"
+    auction_id = ret["auction_id"]
+
+    ret = await auctioneer.create_auction("iphone")
+    assert "Auction already exists for this item." in ret["errors"]
+
+    assert len(await participant_one.query_all_live_auctions()) == 1
+    assert len(await participant_one.query_all_live_auctions(involved_only=True)) == 0
+
+    for price in (0, float("nan"), float("inf")):
+        ret = await participant_one.submit_bid_for_auction(auction_id, price)
+        assert "Not a valid bid price for submission." in ret["errors"]
+
+    # Bid storm: all bids race, only ever-higher ones are accepted.
+    rets = await asyncio.gather(*[
+        participant.submit_bid_for_auction(auction_id, price)
+        for price in range(100, 150)
+        for participant in [participant_one, participant_two]
+    ])
+    accepted = [r for r in rets if r["status"] == "success"]
+    assert accepted
+
+    bids = await auctioneer.query_all_bids_for_auction(auction_id)
+    assert len(bids) == len(accepted)
+    highest = bids[0]
+    assert [b.offer_price for b in bids] == sorted(
+        [b.offer_price for b in bids], reverse=True)
+    # Each beat the one before, and is stamped by the server as accepted.
+    in_time = await auctioneer.query_bids_between(auction_id=auction_id)
+    assert [b.id for b in in_time] == [b.id for b in reversed(bids)]
+
+    ret = await auctioneer.query_all_bids_for_auction(auction_id, page_size=3)
+    assert [b.id for b in ret["bids"]] == [b.id for b in bids[:3]]
+
+    leader = participant_one if highest.participant_id == participant_one.id else participant_two
+    ret = await leader.query_rank_for_auction(auction_id)
+    assert ret["bidders"] == len(set(b.participant_id for b in bids))
+    assert (ret["rank"], ret["best_offer"]) == (1, highest.offer_price)
+
+    ret = await participant_two.query_latest_summary_for_item("iphone")
+    assert ret["item"]["status_code"] == const.ITEM_STATUS_STAGED
+    assert ret["prevailing_bid"]["id"] == highest.id
+    assert ret["prevailing_bid"]["offer_price"] == 149
+
+    # Worked out from its sources without a summary record, the same.
+    rmanager.delete_one_record(summary.CATEGORY, "iphone")
+    assert await participant_two.query_latest_summary_for_item("iphone") == ret
+    consistency.rebuild_item_summary("iphone")
+    ret = await participant_two.query_latest_summary_for_item("missing")
+    assert "Item does not exist." in ret["errors"]
+
+    # Auctions live since before the bidders ladder start one from their
+    # highest bid.
+    Auction.drop_bidders(auction_id)
+    ret = await participant_one.submit_bid_for_auction(auction_id, 149)
+    assert "Bid must be higher than the current highest bid." in ret["errors"]
+    ret = await participant_one.submit_bid_for_auction(auction_id, 160)
+    assert ret["status"] == "success"
+    bidders = Auction.bidders(auction_id)
+    assert bidders[0] == participant_one.id and highest.participant_id in bidders
+
+    # Not met, back to available.
+    ret = await auctioneer.call_auction(auction_id)
+    assert ret["status"] == "success"
+    ret = await auctioneer.query_latest_summary_for_item("iphone")
+    assert ret["item"]["status_code"] == const.ITEM_STATUS_AVAILABLE
+    assert ret["auction"] == None
+    items = await auctioneer.query_all_items(status_code=const.ITEM_STATUS_AVAILABLE)
+    assert "iphone" in [i.name for i in items]
+    assert const.ITEM_STATUS_STAGED not in [i.status for i in items]
+
+    ret = await auctioneer.update_item_reserved_price("iphone", 200)
+    assert ret["status"] == "success"
+
+    ret = await auctioneer.create_auction("iphone")
+    auction_id = ret["auction_id"]
+    subscription = await participant_two.subscribe(auction_ids=[auction_id])
+    ret = await auctioneer.start_auction(auction_id)
+    assert ret["status"] == "success"
+
+    event = await subscription.get(timeout=5)
+    assert event["type"] == events.AUCTION_STARTED
+
+    ret = await participant_two.submit_bid_for_auction(auction_id, 250)
+    bid_id = ret["bid_id"]
+    assert len(await participant_two.query_all_live_auctions(involved_only=True)) == 1
+
+    ret = await auctioneer.call_auction(auction_id)
+    assert ret["status"] == "success"
+
+    received = [await subscription.get(timeout=5) for _ in range(3)]
+    assert [e["type"] for e in received[:1]] == [events.BID_ACCEPTED]
+    assert sorted(e["type"] for e in received[1:]) == [
+        events.AUCTION_CALLED, events.AUCTION_WON]
+    subscription.close()
+
+    ret = await auctioneer.query_latest_summary_for_item("iphone")
+    assert ret["item"]["status_code"] == const.ITEM_STATUS_SOLD
+    assert ret["auction"]["winning_bid_id"] == bid_id
+    assert ret["prevailing_bid"]["participant_id"] == participant_two.id
+
+    # Same answer from the blocking api.
+    assert participant_two.user.query_latest_summary_for_item("iphone") == ret
+
+    ret = await auctioneer.query_aggregates()
+    assert ret == auctioneer.user.query_aggregates()
+    assert (ret["called"], ret["sold"], ret["sell_through_rate"]) == (2, 1, 0.5)
+
+    item_names = []
+    cursor = 0
+    while True:
+        ret = await auctioneer.query_all_items(page_size=1, cursor=cursor)
+        item_names += [i.name for i in ret["items"]]
+        cursor = ret["cursor"]
+        if cursor == 0:
+            break
+
+    assert sorted(item_names) == ["iphone", "macbook"]
+
+    # Same time ranges as the blocking api.
+    bids = await participant_two.query_bids_between(auction_id=auction_id)
+    assert [b.id for b in bids] == [bid_id]
+    ret = await auctioneer.query_auctions_between("closed_at", newest_first=True, page_size=1)
+    assert [a.id for a in ret["auctions"]] == [auction_id]
+
+    # Archived, the sold item's summary is still worked out the same.
+    expected = await auctioneer.query_latest_summary_for_item("iphone")
+    assert archive.archive_closed_auctions(retention=0, pause=0) == 2
+    rmanager.delete_one_record(summary.CATEGORY, "iphone")
+    assert await auctioneer.query_latest_summary_for_item("iphone") == expected
+    ret = await auctioneer.create_auction("iphone")
+    assert "Auction already exists for this item." in ret["errors"]
+
+    # Bids landing while an auction is called can't hold the call up.
+    ret = await auctioneer.register_item_and_start_auction("watch", 100)
+    auction_id = ret["auction_id"]
+    results = await asyncio.gather(
+        auctioneer.call_auction(auction_id),
+        *[participant_one.submit_bid_for_auction(auction_id, 100 + i) for i in range(20)])
+    assert results[0]["status"] == "success"
+    ret = await participant_two.query_latest_summary_for_item("watch")
+    assert ret["item"]["status_code"] != const.ITEM_STATUS_STAGED
+    ret = await participant_one.submit_bid_for_auction(auction_id, 200)
+    assert "This auction is currently not in progress." in ret["errors"]
+
+    # Timed auctions are called by the scheduler once due.
+    ret = await auctioneer.register_item_and_start_auction("ipad", 100, extension=5)
+    assert "Only timed auctions can be extended." in ret["errors"]
+    ends_at = time.time() + 60
+    ret = await auctioneer.register_item_and_start_auction(
+        "ipad", 100, ends_at=ends_at, extension=30)
+    auction_id = ret["auction_id"]
+    ret = await participant_one.submit_bid_for_auction(auction_id, 150)
+    assert ret["status"] == "success"
+    assert scheduler.next_deadline() == ends_at
+    assert scheduler.call_due_auctions(now=ends_at - 1) == 0
+    assert scheduler.call_due_auctions(now=ends_at) == 1
+    ret = await participant_two.query_latest_summary_for_item("ipad")
+    assert ret["item"]["status_code"] == const.ITEM_STATUS_SOLD
+    assert ret["prevailing_bid"]["participant_id"] == participant_one.id
+
+    await aio.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,2 +1,2 @@
 # Operate with these two classes.
-from user import Auctioneer, Participant
+from .user import Auctioneer, Participant
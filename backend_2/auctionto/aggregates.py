@@ -0,0 +1,107 @@
+from . import rmanager
+from . import stats
+from . import constants as const
+
+
+"""
+Aggregates over items and auctions, read in one round trip however many
+records there are.
+
+Counts per status are the sizes of the status index sets, which every item
+and auction save keeps current in the same transaction as the record.
+Figures about called auctions are counters in one hash,
+"aggregate:auctions", added to in the transaction calling the auction (see
+`Auction._increments`):
+
+    called       auctions called, with or without a winner
+    sold         those called with a winner
+    sold_volume  sum of their winning offers
+
+Counts per status only cover live records, while the counters cover every
+auction ever called, archived ones (see archive.py) included.
+consistency.py checks the counters against the auctions and the archive,
+and rebuilds them.
+"""
+
+COUNTERS_KEY = "aggregate:auctions"
+
+ITEM_STATUSES = sorted(const.ITEM_STATUS_NAMES)
+AUCTION_STATUSES = sorted(const.AUCTION_STATUS_NAMES)
+
+
+def closed_increments(auction, sold_price=None):
+    """Counter increments for an auction being called."""
+
+    increments = [(COUNTERS_KEY, "called", 1)]
+    if auction.status == const.AUCTION_STATUS_CALLED_SUCCESS:
+        increments += [
+            (COUNTERS_KEY, "sold", 1),
+            (COUNTERS_KEY, "sold_volume", float(sold_price)),
+        ]
+    return increments
+
+
+def get_aggregates():
+    """
+    Items and auctions per status code, and the called auction counters
+    along with the sell-through rate (sold / called, None before any call).
+
+    """
+
+    r = rmanager.reader()
+    pipe = r.pipeline(transaction=False)
+    queue_aggregates(pipe)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    results = pipe.execute()
+    stats.record("aggregate", "read", started, sent, results)
+    return decode_aggregates(results)
+
+
+def queue_aggregates(pipe):
+    for status in ITEM_STATUSES:
+        pipe.scard(rmanager.index_key("item", "status", status))
+    for status in AUCTION_STATUSES:
+        pipe.scard(rmanager.index_key("auction", "status", status))
+    pipe.hgetall(COUNTERS_KEY)
+
+
+def decode_aggregates(results):
+    item_counts = results[:len(ITEM_STATUSES)]
+    auction_counts = results[len(ITEM_STATUSES):-1]
+    counters = decode_counters(results[-1])
+
+    return dict(counters, **{
+        "items": dict(zip(ITEM_STATUSES, item_counts)),
+        "auctions": dict(zip(AUCTION_STATUSES, auction_counts)),
+        "sell_through_rate": (
+            float(counters["sold"]) / counters["called"] if counters["called"] else None),
+    })
+
+
+def decode_counters(raw):
+    raw = dict((rmanager._text(k), rmanager._text(v)) for k, v in raw.items())
+    return {
+        "called": int(raw.get("called", 0)),
+        "sold": int(raw.get("sold", 0)),
+        "sold_volume": float(raw.get("sold_volume", 0)),
+    }
+
+
+def get_counters():
+    r = rmanager.reader()
+    started = stats.clock()
+    raw = r.hgetall(COUNTERS_KEY)
+    stats.record("aggregate", "read", started, received=raw)
+    return decode_counters(raw)
+
+
+def set_counters(counters):
+    """Overwrite the counters, e.g. with ones recounted from the records."""
+
+    r = rmanager.get_backend()
+    started = stats.clock()
+    mapping = dict((k, counters[k]) for k in ("called", "sold", "sold_volume"))
+    r.hset(COUNTERS_KEY, mapping=mapping)
+    stats.record("aggregate", "write", started, mapping)
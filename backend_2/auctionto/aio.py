@@ -0,0 +1,1111 @@
+"""
+asyncio api, for callers running an event loop (python 3.6+ only, so it is
+not imported by the package itself):
+
+    from auctionto import aio
+
+    auctioneer = await aio.AsyncAuctioneer.create()
+    ret = await auctioneer.register_item_and_start_auction("iphone", 400)
+
+    participant = await aio.AsyncParticipant.create()
+    ret = await participant.submit_bid_for_auction(ret["auction_id"], 250)
+
+Every operation is a coroutine that sends the exact same commands as its
+blocking counterpart, so both apis can be used side by side on the same data,
+and return the same values. Managed objects are the usual classes; load and
+save them with the coroutines below instead of their methods, e.g.
+`await aio.one(Auction, auction_id)` or `await aio.save(item)`. Units of work
+(see rmanager) are `async with aio.unit_of_work():` blocks, or `aio.atomic`.
+
+With the redis backend this goes through redis.asyncio (redis-py 4.2+) over
+its own connection pool, built from the same rmanager settings. The pool is
+bound to the event loop that first used it, so `await aio.disconnect()` before
+that loop goes away. With the memory backend it shares rmanager's in-process
+engine, whose commands never block. With shards, it shares rmanager's sharded
+backend too, calling it from the loop's default executor.
+"""
+
+import asyncio
+import functools
+
+import redis
+
+from . import aggregates
+from . import archive
+from . import backends
+from . import bidpool
+from . import events
+from . import rmanager
+from . import sharding
+from . import stats
+from . import constants as const
+from .archive import ArchivedAuction
+from .auction import (
+    Auction, ACCEPT_BID_RETRY, ACCEPT_BID_SCRIPT, CLOSE_AUCTION_SCRIPT, CLOSE_ERRORS,
+    bidders_key)
+from .bid import Bid
+from .item import Item
+from . import summary
+from .user import Auctioneer, Participant, Read, summary_steps
+
+
+class AsyncRedisBackend(object):
+    """redis.asyncio client, plus script support by sha."""
+
+    def __init__(self, client):
+        self.client = client
+        self._scripts = {}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def run_script(self, script, keys, args):
+        registered = self._scripts.get(script)
+        if registered is None:
+            registered = self._scripts[script] = self.client.register_script(script.lua)
+
+        return await registered(keys=keys, args=args, client=self.client)
+
+    async def close(self):
+        await self.client.connection_pool.disconnect()
+
+
+class AsyncMemoryBackend(object):
+    """Awaitable view of a MemoryBackend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        if name not in backends.COMMANDS:
+            raise AttributeError(name)
+
+        command = getattr(self.backend, name)
+
+        async def call(*args, **kwargs):
+            return command(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return AsyncMemoryPipeline(self.backend)
+
+    async def run_script(self, script, keys, args):
+        return self.backend.run_script(script, keys, args)
+
+    async def close(self):
+        pass
+
+
+class AsyncMemoryPipeline(backends.MemoryPipeline):
+
+    async def watch(self, *names):
+        return super(AsyncMemoryPipeline, self).watch(*names)
+
+    async def execute(self, raise_on_error=True):
+        return super(AsyncMemoryPipeline, self).execute(raise_on_error)
+
+    async def reset(self):
+        super(AsyncMemoryPipeline, self).reset()
+
+
+class AsyncBlockingBackend(object):
+    """
+    Awaitable view of a blocking backend (e.g. a sharded one), whose calls
+    run in the event loop's default executor.
+
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        if name not in backends.COMMANDS:
+            raise AttributeError(name)
+
+        command = getattr(self.backend, name)
+
+        async def call(*args, **kwargs):
+            return await _in_executor(command, *args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return AsyncBlockingPipeline(self.backend.pipeline(transaction))
+
+    async def run_script(self, script, keys, args):
+        return await _in_executor(self.backend.run_script, script, keys, args)
+
+    async def close(self):
+        pass
+
+
+class AsyncBlockingPipeline(object):
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        if name not in backends.COMMANDS:
+            raise AttributeError(name)
+
+        command = getattr(self.pipe, name)
+
+        def queue(*args, **kwargs):
+            command(*args, **kwargs)
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.pipe)
+
+    @property
+    def command_stack(self):
+        return self.pipe.command_stack
+
+    def multi(self):
+        self.pipe.multi()
+
+    async def watch(self, *names):
+        return await _in_executor(self.pipe.watch, *names)
+
+    async def execute(self, raise_on_error=True):
+        return await _in_executor(self.pipe.execute, raise_on_error)
+
+    async def reset(self):
+        await _in_executor(self.pipe.reset)
+
+
+class AsyncWatchedReader(backends.WatchedReader):
+    """backends.WatchedReader, over a redis.asyncio pipeline."""
+
+    def pipeline(self, transaction=True):
+        return AsyncReadBatch(self)
+
+
+class AsyncReadBatch(backends.ReadBatch):
+
+    async def execute(self, raise_on_error=True):
+        stack, self.command_stack = self.command_stack, []
+        results = []
+        for name, args, kwargs in stack:
+            try:
+                results.append(await getattr(self.client, name)(*args, **kwargs))
+            except redis.ResponseError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+
+def _in_executor(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+_backend = None
+_generation = None
+
+
+def _make_backend():
+    backend = rmanager.get_backend()
+    if isinstance(backend, backends.MemoryBackend):
+        return AsyncMemoryBackend(backend)
+    if isinstance(backend, sharding.ShardedBackend):
+        return AsyncBlockingBackend(backend)
+
+    import redis.asyncio
+
+    pool = redis.asyncio.BlockingConnectionPool(**rmanager.pool_kwargs(redis.asyncio))
+    return AsyncRedisBackend(redis.asyncio.StrictRedis(connection_pool=pool))
+
+
+def get_backend():
+    """Return the shared async backend, rebuilt whenever rmanager's is."""
+    global _backend, _generation
+    if _backend is None or _generation != rmanager._generation:
+        _backend = _make_backend()
+        _generation = rmanager._generation
+
+    return _backend
+
+
+def reader():
+    """rmanager.reader, for the async backend."""
+    unit = rmanager.current_unit_of_work()
+    if unit is not None and unit._pipe is not None:
+        return unit.reader()
+    return get_backend()
+
+
+async def disconnect():
+    """Close every pooled connection; a new backend is built on next use."""
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+    _backend = None
+
+
+def tracked(func):
+    """stats.tracked for coroutines (which end when awaited, not called)."""
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(owner, *args, **kwargs):
+        cls = owner if isinstance(owner, type) else type(owner)
+        token = stats.begin("{}.{}".format(cls.__name__, name))
+        try:
+            return await func(owner, *args, **kwargs)
+        finally:
+            stats.end(token)
+
+    return wrapper
+
+
+class AsyncUnitOfWork(rmanager.UnitOfWork):
+    """rmanager.UnitOfWork, watching and writing through the async backend."""
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self._outer is not None:
+            return False
+
+        rmanager._unit.reset(self._token)
+        if exc_type is None:
+            await self.flush()
+        else:
+            await self.discard()
+        return False
+
+    async def watch(self, first_key, keys):
+        keys = self._to_watch(keys)
+        if not keys:
+            return
+
+        if self._pipe is None:
+            self._pipe = get_backend().pipeline()
+        started = stats.clock()
+        await self._pipe.watch(*keys)
+        stats.record(first_key, "watch", started, keys)
+
+    def reader(self):
+        if isinstance(self._pipe, AsyncBlockingPipeline):
+            return AsyncBlockingBackend(self._pipe.pipe.reader())
+        if isinstance(self._pipe, AsyncMemoryPipeline):
+            return get_backend()
+        return AsyncWatchedReader(self._pipe)
+
+    async def flush(self):
+        pipe, self._pipe = self._pipe, None
+        try:
+            if not self._pending():
+                return
+            if pipe is None:
+                pipe = get_backend().pipeline()
+
+            entries = self._queue_writes(pipe)
+            started = stats.clock()
+            sent = pipe.command_stack
+            try:
+                await pipe.execute()
+            except redis.WatchError:
+                raise rmanager.ConflictError(
+                    "Records read in this unit of work changed.")
+            stats.record(rmanager.categories(entries), "write", started, sent)
+            rmanager.invalidate_cached(rmanager.written_keys(entries))
+        finally:
+            self._writes = []
+            self._messages = []
+            self._increments = []
+            if pipe is not None:
+                await pipe.reset()
+
+    async def discard(self):
+        self._writes = []
+        self._messages = []
+        self._increments = []
+        if self._pipe is not None:
+            await self._pipe.reset()
+            self._pipe = None
+
+
+def unit_of_work():
+    return AsyncUnitOfWork()
+
+
+def atomic(func):
+    """rmanager.atomic for coroutines."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if rmanager.current_unit_of_work() is not None:
+            return await func(*args, **kwargs)
+
+        for attempt in range(rmanager.ATOMIC_RETRIES):
+            try:
+                async with AsyncUnitOfWork():
+                    return await func(*args, **kwargs)
+            except rmanager.ConflictError:
+                if attempt == rmanager.ATOMIC_RETRIES - 1:
+                    raise
+
+    return wrapper
+
+
+class AsyncSubscription(object):
+    """
+    events.Subscription for coroutines, fed by the same process-wide hub;
+    made with `await AsyncSubscription.create(channels)`.
+
+    """
+
+    def __init__(self, channels):
+        self.channels = list(channels)
+        self._events = asyncio.Queue()
+        self._loop = asyncio.get_event_loop()
+        self.hub = rmanager.get_hub()
+
+    @classmethod
+    async def create(cls, channels):
+        subscription = cls(channels)
+        # Waits for the hub to subscribe, off the event loop.
+        await subscription._loop.run_in_executor(
+            None, subscription.hub.add, subscription.channels, subscription._sink)
+        return subscription
+
+    def _sink(self, event):
+        # Called from the hub's thread.
+        try:
+            self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+        except RuntimeError:
+            # The loop is gone.
+            pass
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self._events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        self.hub.remove(self.channels, self._sink)
+        self._events.put_nowait(None)
+
+
+"""
+Storage helpers, same as their namesakes in rmanager.
+"""
+
+
+async def get_one_record(first_key, second_key, fields=None):
+    return (await get_many_records(first_key, [second_key], fields=fields))[0]
+
+
+async def get_many_records(first_key, second_keys, fields=None):
+    if not second_keys:
+        return []
+
+    unit = rmanager.current_unit_of_work()
+    if unit is not None:
+        await unit.watch(
+            first_key, [rmanager.record_key(first_key, k) for k in second_keys])
+
+    pipe = reader().pipeline(transaction=False)
+    rmanager.queue_reads(pipe, first_key, second_keys, fields)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    results = await pipe.execute()
+    records = rmanager.decode_reads(results, fields)
+    stats.record(first_key, "read", started, sent, results,
+                 rmanager.count_records(records))
+    return records
+
+
+async def get_cached_records(first_key, second_keys, fields=None):
+    record_cache = rmanager.get_cache()
+    if record_cache is None:
+        return await get_many_records(first_key, second_keys, fields=fields)
+
+    records, missing = rmanager.cache_lookup(record_cache, first_key, second_keys)
+    if missing:
+        fetched = await get_many_records(
+            first_key, [second_keys[i] for i, _, _ in missing])
+        rmanager.cache_fill(record_cache, records, missing, fetched)
+
+    return rmanager.project_records(records, fields)
+
+
+async def scan_records(first_key, cursor=0, count=100, set_key=None, filter_func=None):
+    started = stats.clock()
+    cursor, second_keys = await reader().sscan(
+        set_key or rmanager.ids_key(first_key), cursor=cursor, count=count)
+    cursor = rmanager.scan_cursor(cursor)
+    stats.record(first_key, "scan", started, received=second_keys)
+
+    records = await get_many_records(
+        first_key, [rmanager._text(k) for k in second_keys])
+    return cursor, rmanager.filter_records(records, filter_func)
+
+
+async def get_indexed_records(first_key, index_keys):
+    started = stats.clock()
+    second_keys = await reader().sinter(index_keys)
+    stats.record(first_key, "index", started, index_keys, second_keys)
+    records = await get_many_records(
+        first_key, [rmanager._text(k) for k in second_keys])
+    return rmanager.filter_records(records)
+
+
+async def count_indexed(first_key, index_keys):
+    started = stats.clock()
+    if len(index_keys) == 1:
+        count = await reader().scard(index_keys[0])
+    else:
+        count = len(await reader().sinter(index_keys))
+    stats.record(first_key, "count", started, index_keys)
+    return count
+
+
+async def range_records(first_key, set_key, start=None, end=None, cursor=0, count=100,
+                        reverse=False, filter_func=None):
+    low, high, offset = rmanager.range_bounds(start, end, cursor, reverse)
+
+    started = stats.clock()
+    if reverse:
+        members = await reader().zrevrangebyscore(
+            set_key, high, low, start=offset, num=count, withscores=True)
+    else:
+        members = await reader().zrangebyscore(
+            set_key, low, high, start=offset, num=count, withscores=True)
+    stats.record(first_key, "range", started, received=members)
+
+    records = await get_many_records(
+        first_key, [rmanager._text(m) for m, _ in members])
+    return (rmanager.range_cursor(members, count, cursor),
+            rmanager.filter_records(records, filter_func))
+
+
+async def get_rank(first_key, set_key, member):
+    pipe = reader().pipeline(transaction=False)
+    rmanager.queue_rank(pipe, set_key, member)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    results = await pipe.execute()
+    stats.record(first_key, "rank", started, sent, results)
+    return rmanager.decode_rank(results)
+
+
+async def sorted_members(first_key, set_key, reverse=False):
+    started = stats.clock()
+    if reverse:
+        members = await reader().zrevrangebyscore(set_key, "+inf", "-inf")
+    else:
+        members = await reader().zrangebyscore(set_key, "-inf", "+inf")
+    stats.record(first_key, "range", started, received=members)
+    return [rmanager._text(m) for m in members]
+
+
+async def set_many_records(entries, messages=(), increments=()):
+    unit = rmanager.current_unit_of_work()
+    if unit is not None:
+        unit.queue(rmanager.queue_writes, entries)
+        unit.publish(messages)
+        unit.increment(increments)
+        return True
+
+    pipe = get_backend().pipeline()
+    rmanager.queue_writes(pipe, entries)
+    rmanager.queue_increments(pipe, increments)
+    rmanager.queue_publishes(pipe, messages)
+    if len(pipe):
+        started = stats.clock()
+        sent = pipe.command_stack
+        await pipe.execute()
+        stats.record(rmanager.categories(entries), "write", started, sent)
+        rmanager.invalidate_cached(rmanager.written_keys(entries))
+
+    return True
+
+
+async def delete_many_records(entries):
+    if not entries:
+        return 0
+
+    unit = rmanager.current_unit_of_work()
+    if unit is not None:
+        unit.queue(rmanager.queue_deletes, entries)
+        return len(entries)
+
+    pipe = get_backend().pipeline()
+    rmanager.queue_deletes(pipe, entries)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    deleted = (await pipe.execute())[0]
+    stats.record(rmanager.categories(entries), "delete", started, sent)
+    rmanager.invalidate_cached(rmanager.written_keys(entries))
+    return deleted
+
+
+async def run_script(script, keys=(), args=()):
+    started = stats.clock()
+    ret = rmanager._text(await get_backend().run_script(script, list(keys), list(args)))
+    stats.record(script.name, "script", started, [keys, args], ret)
+    rmanager.invalidate_cached(keys)
+    return ret
+
+
+"""
+Managed object operations, same as the ManagedObject methods of the same name
+with the class (or object) passed first.
+"""
+
+
+@tracked
+async def one(cls, unique_key):
+    return (await _load(cls, [unique_key]))[0]
+
+
+@tracked
+async def one_many(cls, unique_keys):
+    return await _load(cls, list(unique_keys))
+
+
+async def _load(cls, unique_keys):
+    unit = rmanager.current_unit_of_work()
+    if unit is None:
+        records = await get_cached_records(cls.category, unique_keys)
+        return [
+            cls._make_object_from_record(r) if r is not None else None
+            for r in records
+        ]
+
+    found, missing = unit.lookup(cls, unique_keys)
+    records = await get_many_records(cls.category, missing)
+    for unique_key, record in zip(missing, records):
+        found[unique_key] = unit.adopt(cls, unique_key, record)
+    return [found[k] for k in unique_keys]
+
+
+@tracked
+async def get_fields(cls, unique_key, *fields):
+    if rmanager.current_unit_of_work() is not None:
+        return cls._fields_of((await _load(cls, [unique_key]))[0], fields)
+
+    return (await get_cached_records(cls.category, [unique_key], fields=list(fields)))[0]
+
+
+async def iter_all(cls, batch_size=100, filter_func=None, **criteria):
+    """Async generator version of `ManagedObject.iter_all`."""
+
+    set_key, record_filter = cls._scan_plan(criteria, filter_func)
+    cursor = 0
+    while True:
+        cursor, records = await scan_records(
+            cls.category, cursor=cursor, count=batch_size, set_key=set_key,
+            filter_func=record_filter)
+        for record in records:
+            yield cls._make_object_from_record(record)
+        if cursor == 0:
+            break
+
+
+async def run_read(read):
+    """Await a user.Read with the coroutine of the same name."""
+    function = {"one": one, "find": find}[read.method]
+    return await function(read.cls, *read.args, **read.criteria)
+
+
+@tracked
+async def all_of(cls, filter_func=None):
+    """`ManagedObject.all`, named so as not to shadow the builtin."""
+    seen = set()
+    objects = []
+    async for o in iter_all(cls, filter_func=filter_func):
+        unique_key = getattr(o, cls.identifier)
+        if unique_key not in seen:
+            seen.add(unique_key)
+            objects.append(o)
+
+    return objects
+
+
+@tracked
+async def page(cls, cursor=0, page_size=100, filter_func=None, **criteria):
+    set_key, record_filter = cls._scan_plan(criteria, filter_func)
+    cursor, records = await scan_records(
+        cls.category, cursor=cursor, count=page_size, set_key=set_key,
+        filter_func=record_filter)
+
+    return [cls._make_object_from_record(r) for r in records], cursor
+
+
+@tracked
+async def find(cls, **criteria):
+    records = await get_indexed_records(cls.category, cls._find_plan(criteria))
+    return cls._found(records, criteria)
+
+
+@tracked
+async def count(cls, **criteria):
+    return await count_indexed(cls.category, cls._count_plan(criteria))
+
+
+@tracked
+async def between(cls, field, start=None, end=None, reverse=False, limit=None,
+                  **criteria):
+    objects = []
+    cursor = 0
+    while limit is None or len(objects) < limit:
+        objects_page, cursor = await page_between(
+            cls, field, start, end, cursor=cursor, reverse=reverse,
+            page_size=min(100, limit - len(objects)) if limit else 100,
+            **criteria)
+        objects += objects_page
+        if cursor == 0:
+            break
+
+    return objects[:limit] if limit else objects
+
+
+@tracked
+async def page_between(cls, field, start=None, end=None, cursor=0, page_size=100,
+                       reverse=False, **criteria):
+    set_key, record_filter = cls._range_plan(field, criteria)
+    cursor, records = await range_records(
+        cls.category, set_key, start, end, cursor=cursor, count=page_size,
+        reverse=reverse, filter_func=record_filter)
+
+    return [cls._make_object_from_record(r) for r in records], cursor
+
+
+@tracked
+async def save(obj):
+    return await save_many([obj])
+
+
+async def save_many(objects):
+    with stats.operation("ManagedObject.save_many"):
+        entries, derived, messages, increments = rmanager.ManagedObject._save_entries(
+            objects)
+        ret = await set_many_records(entries + derived, messages, increments)
+        for o, entry in zip(objects, entries):
+            o._mark_saved(entry)
+
+    return ret
+
+
+@tracked
+async def delete(obj):
+    return await delete_many([obj])
+
+
+async def delete_many(objects):
+    with stats.operation("ManagedObject.delete_many"):
+        ret = await delete_many_records([o._delete_entry() for o in objects])
+        rmanager.ManagedObject._mark_deleted(objects)
+
+    return ret
+
+
+"""
+Users.
+
+The async users wrap a regular Auctioneer/Participant (as `user`), and have
+the same operations as coroutines.
+"""
+
+
+def _error(message):
+    return {
+        "status": "error",
+        "errors": [message],
+    }
+
+
+class AsyncUser(object):
+
+    user_class = None
+
+    def __init__(self, user):
+        self.user = user
+
+    def __repr__(self):
+        return "<Async{!r}>".format(self.user)
+
+    @property
+    def id(self):
+        return self.user.id
+
+    @classmethod
+    async def create(cls):
+        """Create and save a new user."""
+        user = cls.user_class()
+        await save(user)
+        return cls(user)
+
+    async def subscribe(self, auction_ids=()):
+        """Same as BaseUser.subscribe, as an AsyncSubscription."""
+        channels = [events.auction_channel(a) for a in auction_ids]
+        return await AsyncSubscription.create(
+            channels + [events.user_channel(self.id)])
+
+    @tracked
+    async def query_latest_summary_for_item(self, item_name):
+        record = await get_one_record(summary.CATEGORY, item_name)
+        if record is not None:
+            return summary.render_record(record)
+
+        # No summary record, work it out like user.compute_summary.
+        steps = summary_steps(item_name)
+        step = next(steps)
+        while isinstance(step, Read):
+            step = steps.send(await run_read(step))
+        if step is None:
+            return _error("Item does not exist.")
+
+        return summary.render_objects(*step)
+
+    @tracked
+    async def query_auctions_between(self, field, start=None, end=None,
+                                     status_code=None, newest_first=False,
+                                     page_size=None, cursor=0):
+        if field not in Auction._sorted_fields():
+            return _error("Cannot order auctions by {}.".format(field))
+
+        criteria = {}
+        if status_code is not None:
+            criteria["status"] = status_code
+
+        if page_size is None:
+            return await between(
+                Auction, field, start, end, reverse=newest_first, **criteria)
+
+        auctions, cursor = await page_between(
+            Auction, field, start, end, cursor=cursor, page_size=page_size,
+            reverse=newest_first, **criteria)
+        return {
+            "status": "success",
+            "auctions": auctions,
+            "cursor": cursor,
+        }
+
+    @tracked
+    async def query_bids_between(self, start=None, end=None, auction_id=None,
+                                 newest_first=False, page_size=None, cursor=0):
+        criteria = {}
+        if auction_id is not None:
+            criteria["auction_id"] = auction_id
+
+        if page_size is None:
+            return await between(
+                Bid, "submitted_at", start, end, reverse=newest_first, **criteria)
+
+        bids, cursor = await page_between(
+            Bid, "submitted_at", start, end, cursor=cursor, page_size=page_size,
+            reverse=newest_first, **criteria)
+        return {
+            "status": "success",
+            "bids": bids,
+            "cursor": cursor,
+        }
+
+
+class AsyncAuctioneer(AsyncUser):
+
+    user_class = Auctioneer
+
+    @tracked
+    async def query_all_items(self, status_code=None, page_size=None, cursor=0):
+        criteria = {}
+        if status_code is not None:
+            criteria["status"] = status_code
+
+        if page_size is None:
+            if criteria:
+                return await find(Item, **criteria)
+            return await all_of(Item)
+
+        items, cursor = await page(Item, cursor, page_size, **criteria)
+        return {
+            "status": "success",
+            "items": items,
+            "cursor": cursor,
+        }
+
+    @tracked
+    async def query_all_auctions(self, status_code=None, page_size=None, cursor=0):
+        criteria = {}
+        if status_code is not None:
+            criteria["status"] = status_code
+
+        if page_size is None:
+            if criteria:
+                return await find(Auction, **criteria)
+            return await all_of(Auction)
+
+        auctions, cursor = await page(Auction, cursor, page_size, **criteria)
+        return {
+            "status": "success",
+            "auctions": auctions,
+            "cursor": cursor,
+        }
+
+    @tracked
+    async def query_all_bids_for_auction(self, auction_id, page_size=None, cursor=0):
+        if await get_fields(Auction, auction_id, "id") is None:
+            return _error("This auction does not exist.")
+
+        if page_size is None:
+            return await between(
+                Bid, "offer_price", reverse=True, auction_id=auction_id)
+
+        bids, cursor = await page_between(
+            Bid, "offer_price", cursor=cursor, page_size=page_size, reverse=True,
+            auction_id=auction_id)
+        return {
+            "status": "success",
+            "bids": bids,
+            "cursor": cursor,
+        }
+
+    @tracked
+    async def query_aggregates(self):
+        pipe = reader().pipeline(transaction=False)
+        aggregates.queue_aggregates(pipe)
+
+        started = stats.clock()
+        sent = pipe.command_stack
+        results = await pipe.execute()
+        stats.record("aggregate", "read", started, sent, results)
+        return dict(aggregates.decode_aggregates(results), status="success")
+
+    @tracked
+    @atomic
+    async def register_item(self, item_name, reserved_price):
+        if await one(Item, item_name) is not None:
+            return _error("Item already exists.")
+
+        item = Item(item_name, reserved_price)
+        await save(item)
+
+        return {
+            "status": "success",
+            "item_name": item.name,
+        }
+
+    @tracked
+    @atomic
+    async def create_auction(self, item_name, ends_at=None, extension=None):
+        error = Auction._deadline_error(ends_at, extension)
+        if error:
+            return error
+
+        item = await one(Item, item_name)
+        if item is None:
+            return _error("Item does not exist.")
+
+        auctions = await find(Auction, item_name=item_name)
+        if item.status == const.ITEM_STATUS_SOLD or summary.summary_auction(auctions):
+            return _error("Auction already exists for this item.")
+
+        auction = Auction(item_name, item=item, ends_at=ends_at, extension=extension)
+        await save_many([auction, item])
+
+        return {
+            "status": "success",
+            "auction_id": auction.id,
+        }
+
+    @tracked
+    @atomic
+    async def start_auction(self, auction_id):
+        auction = await one(Auction, auction_id)
+        if auction is None:
+            return _error("This auction does not exist.")
+
+        error = auction._start()
+        if error:
+            return error
+
+        await save(auction)
+
+        return {
+            "status": "success",
+            "auction_id": auction.id,
+        }
+
+    @tracked
+    @atomic
+    async def register_item_and_start_auction(self, item_name, reserved_price,
+                                              ends_at=None, extension=None):
+        error = Auction._deadline_error(ends_at, extension)
+        if error:
+            return error
+
+        ret = await self.register_item(item_name, reserved_price)
+        if ret["status"] != "success":
+            return ret
+
+        ret = await self.create_auction(
+            ret["item_name"], ends_at=ends_at, extension=extension)
+        if ret["status"] != "success":
+            return ret
+
+        return await self.start_auction(ret["auction_id"])
+
+    @tracked
+    async def call_auction(self, auction_id):
+        keys, args = Auction._close_call(auction_id)
+        ret = await run_script(CLOSE_AUCTION_SCRIPT, keys, args)
+        if ret != "ok":
+            return _error(CLOSE_ERRORS[ret])
+
+        return await self._end_closing(auction_id)
+
+    @atomic
+    async def _end_closing(self, auction_id):
+        auction = await one(Auction, auction_id)
+        error = Auction._end_closing_error(auction)
+        if error:
+            return error
+
+        item, highest_bid = await one(Item, auction.item_name), None
+        if auction.highest_bid_id:
+            highest_bid = await one(Bid, auction.highest_bid_id)
+        bidders = await sorted_members(
+            Auction.category, bidders_key(auction.id), reverse=True)
+        auction._close(item, highest_bid, bidders)
+        await save_many([auction, item])
+
+        return {
+            "status": "success",
+            "auction_id": auction.id,
+        }
+
+    @tracked
+    @atomic
+    async def update_item_reserved_price(self, item_name, reserved_price):
+        item = await one(Item, item_name)
+        if item is None:
+            return _error("Item does not exist.")
+
+        if item.status != const.ITEM_STATUS_AVAILABLE:
+            return _error(
+                "You cannot change the reserved price of an item that is"
+                "currently staged for auction or was sold already.")
+
+        item.reserved_price = reserved_price
+        await save(item)
+
+        return {
+            "status": "success",
+            "item_name": item.name,
+        }
+
+    @tracked
+    @atomic
+    async def unstage_item_from_auction(self, item_name):
+        item = await one(Item, item_name)
+        if item is None:
+            return _error("Item does not exist.")
+
+        if item.status != const.ITEM_STATUS_STAGED:
+            return _error("Item is not staged for auction.")
+
+        ret = await find(
+            Auction, item_name=item_name, status=const.AUCTION_STATUS_CREATED)
+        if not ret:
+            return _error(
+                "Auction for this item already progressed, and cannot "
+                "unstage the item at this time.")
+
+        await delete(ret[0])
+
+        item.status = const.ITEM_STATUS_AVAILABLE
+        await save(item)
+
+        return {
+            "status": "success",
+            "item_name": item.name,
+        }
+
+
+class AsyncParticipant(AsyncUser):
+
+    user_class = Participant
+
+    @tracked
+    async def query_all_live_auctions(self, involved_only=False, page_size=None, cursor=0):
+        if page_size is None:
+            if involved_only:
+                records = await get_indexed_records(
+                    Auction.category, Auction._joined_plan(self.id))
+                return [Auction._make_object_from_record(r) for r in records]
+            return await find(Auction, status=const.AUCTION_STATUS_IN_PROGRESS)
+
+        if involved_only:
+            set_key, record_filter = Auction._joined_page_plan(self.id)
+            cursor, records = await scan_records(
+                Auction.category, cursor, page_size, set_key=set_key,
+                filter_func=record_filter)
+            auctions = [Auction._make_object_from_record(r) for r in records]
+        else:
+            auctions, cursor = await page(
+                Auction, cursor, page_size, status=const.AUCTION_STATUS_IN_PROGRESS)
+
+        return {
+            "status": "success",
+            "auctions": auctions,
+            "cursor": cursor,
+        }
+
+    @tracked
+    async def query_rank_for_auction(self, auction_id):
+        if await get_fields(Auction, auction_id, "id") is None:
+            return _error("This auction does not exist.")
+
+        rank, best_offer, bidders = await get_rank(
+            Auction.category, bidders_key(auction_id), self.id)
+        if rank is None:
+            return _error("You have not bid on this auction.")
+
+        return {
+            "status": "success",
+            "auction_id": auction_id,
+            "rank": rank,
+            "bidders": bidders,
+            "best_offer": best_offer,
+        }
+
+    @tracked
+    async def submit_bid_for_auction(self, auction_id, bid_price):
+        pool = bidpool.get_pool()
+        if pool is not None:
+            return await _in_executor(pool.submit_bid, auction_id, bid_price, self.id)
+        bid, keys, args = Auction._accept_bid_call(auction_id, bid_price, self.id)
+        ret = await run_script(ACCEPT_BID_SCRIPT, keys, args)
+        if ret in ACCEPT_BID_RETRY:
+            auction = (await get_fields(
+                Auction, auction_id, "item_name", "highest_bid_id")) or {}
+            highest_bid_id = auction.get("highest_bid_id")
+            highest_bid = highest_bid_id and (await get_fields(
+                Bid, highest_bid_id, "offer_price", "participant_id"))
+            bid, keys, args = Auction._accept_bid_call(
+                auction_id, bid_price, self.id,
+                *Auction._accept_bid_context(auction, highest_bid))
+            ret = await run_script(ACCEPT_BID_SCRIPT, keys, args)
+
+        return Auction._accept_bid_result(bid, ret)
@@ -0,0 +1,145 @@
+import base64
+import json
+import time
+import zlib
+
+from . import rmanager
+from . import constants as const
+from .auction import Auction
+from .bid import Bid
+
+
+"""
+Archival of closed auctions and their bids, to keep live data from growing
+with history.
+
+Auctions called (successfully or not) more than a retention window ago are
+moved, along with their bids, into one compressed archive record each,
+"archive:rec:<auction id>", and their own records and index entries are
+deleted, so scans and indexes over live data only cover recent auctions.
+Archive records keep the auction id, so they stay on the auction's shard
+(see sharding.py).
+
+Each auction is archived in its own unit of work, a batch at a time with a
+pause in between, so archiving runs alongside live traffic instead of
+blocking it, and can be stopped and resumed at any point; see
+`archive_closed_auctions`, or `python -m auctionto.compact`.
+
+Item summaries are left alone; summaries worked out from their sources (see
+user.summary_sources) find a sold item's auction in the archive.
+"""
+
+RETENTION_SECONDS = 7 * 24 * 3600
+
+CLOSED = (const.AUCTION_STATUS_CALLED_SUCCESS, const.AUCTION_STATUS_CALLED_FAIL)
+
+
+def pack(data):
+    return base64.b64encode(
+        zlib.compress(json.dumps(data, sort_keys=True).encode("utf-8"))).decode("ascii")
+
+
+def unpack(blob):
+    return json.loads(zlib.decompress(base64.b64decode(blob)).decode("utf-8"))
+
+
+class ArchivedAuction(rmanager.ManagedObject):
+    """
+    A closed auction and its bids, compressed into a single record. The
+    fields other than `data` stay readable for lookups without unpacking.
+
+    """
+
+    category = "archive"
+    identifier = "auction_id"
+    fields = (
+        "auction_id", "item_name", "status", "closed_at", "archived_at",
+        "bid_count", "data",
+    )
+    indexes = ("item_name",)
+    sorted_indexes = ("closed_at",)
+
+    def __init__(self, auction, bids):
+        self.auction_id = auction.id
+        self.item_name = auction.item_name
+        self.status = auction.status
+        self.closed_at = auction.closed_at
+        self.archived_at = time.time()
+        self.bid_count = len(bids)
+        self.data = pack({
+            "auction": auction._record(),
+            "bids": [b._record() for b in bids],
+        })
+
+    def __repr__(self):
+        return "<ArchivedAuction auction_id:'{}'>".format(self.auction_id)
+
+    def auction(self):
+        return Auction._make_object_from_record(unpack(self.data)["auction"])
+
+    def bids(self):
+        """The auction's bids, highest offer first."""
+        bids = [Bid._make_object_from_record(r) for r in unpack(self.data)["bids"]]
+        return sorted(bids, key=lambda b: b.offer_price, reverse=True)
+
+
+def sold_auction(archived):
+    """The successful auction among archived ones, with its winning bid."""
+
+    for a in archived:
+        if a.status == const.AUCTION_STATUS_CALLED_SUCCESS:
+            auction = a.auction()
+            winning = [b for b in a.bids() if b.id == auction.winning_bid_id]
+            return auction, (winning[0] if winning else None)
+
+    return None, None
+
+
+def archive_auction(auction_id):
+    """
+    Archive one closed auction and its bids, returning the ArchivedAuction,
+    or None if there is no such closed auction.
+
+    """
+
+    archived = _archive_auction(auction_id)
+    if archived is not None:
+        Auction.drop_bidders(auction_id)
+    return archived
+
+
+@rmanager.atomic
+def _archive_auction(auction_id):
+    auction = Auction.one(auction_id)
+    if auction is None or auction.status not in CLOSED:
+        return None
+
+    bids = Bid.find(auction_id=auction_id)
+    archived = ArchivedAuction(auction, bids)
+    archived.save()
+    rmanager.ManagedObject.delete_many([auction] + bids)
+    return archived
+
+
+def archive_closed_auctions(retention=RETENTION_SECONDS, batch_size=100, pause=0.1,
+                            limit=None):
+    """
+    Archive auctions closed more than `retention` seconds ago, oldest first,
+    `batch_size` at a time with `pause` seconds in between, at most `limit`
+    of them. Returns how many were archived.
+
+    """
+
+    cutoff = time.time() - retention
+    archived = 0
+    while limit is None or archived < limit:
+        size = batch_size if limit is None else min(batch_size, limit - archived)
+        auctions = Auction.between("closed_at", end=cutoff, limit=size)
+        done = sum(1 for a in auctions if archive_auction(a.id) is not None)
+        archived += done
+        if not done or len(auctions) < size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    return archived
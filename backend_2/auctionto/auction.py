@@ -1,10 +1,394 @@
-import uuid
-from datetime import datetime
+import math
+import time
+
+from . import aggregates
+from . import events
+from . import rmanager
+from . import serializers
+from . import sharding
+from . import summary
+from .bid import Bid
+from .item import Item
+from . import constants as const
+from .serializers import HEADER_FIELD
+
+
+# Bid acceptance as a single compare-and-set on the server, so that two
+# concurrent bids can never both beat the same highest bid.
+#
+# The item summary (see summary.py) gets the new bid in the same go, and the
+# bid's events (see events.py) are published.
+#
+# The new bid is also the bidder's best offer on the auction, so it goes
+# straight into the auction's bidders ladder (see `bidders_key`), and the
+# auction into the bidder's joined auctions (see `joined_key`).
+#
+# An auction being called (see CLOSE_AUCTION_LUA) takes no more bids. A timed
+# auction takes none once its end time has passed either, and a bid landing
+# less than its extension before the end pushes the end back to that long
+# after the bid (see `deadlines_key`). Both go by the server's clock, not the
+# bidder's, and so does the bid's submitted_at: left null (or "" for its
+# sorted index scores) by the caller, the script stamps it to the microsecond,
+# in the bid record and its indexes, the events and the summary, so that bids
+# sort in the order they were accepted.
+#
+# The caller declares the summary record of the item it expects the auction to
+# be for (its tag, see sharding.tag_of, for all but names with braces), and
+# gets "other_item" back, having written nothing, if it's not. The highest bid
+# so far is the top of the bidders ladder, whose best offer it is. Auctions
+# live since before the ladder have none until `Auction.rebuild_bidders`: the
+# caller declares the auction's highest bid as it read it, which starts the
+# ladder, or gets "no_ladder" back, having written nothing, if that's not the
+# auction's highest bid.
+#
+# KEYS[1]: auction record, KEYS[2]: new bid record, KEYS[3]: bidders ladder,
+# KEYS[4]: bidder's joined auctions, KEYS[5]: auctions by end time, KEYS[6]:
+# item summary record, KEYS[7]: bid ids set, KEYS[8..n]: bid index sets to add
+# the new bid to, the last ARGV[17] of them sorted ones.
+# ARGV[1]: in-progress status code, ARGV[2]: offer price, ARGV[3]: new bid id,
+# ARGV[4]: the item name KEYS[6] is for, ARGV[5], ARGV[6]: the summary's new
+# prevailing_bid and highest_bid_id values, ARGV[7], ARGV[8]: bid_accepted and
+# outbid events, ARGV[9]: the auction's channel, ARGV[10]: user channel
+# prefix, ARGV[11]: the bidder's channel (not told they outbid themselves),
+# ARGV[12]: the bidder's id, ARGV[13]: the auction's id, ARGV[14], ARGV[15],
+# ARGV[16]: the auction's highest bid id, offer and bidder, as the caller read
+# them ("" if unknown), ARGV[17]: how many sorted index sets, ARGV[18..]: the
+# sorted index scores, then the encoded bid field/value pairs.
+ACCEPT_BID_LUA = serializers.LUA_HELPERS + """
+local auction = redis.call(
+    "HMGET", KEYS[1], "status", "_codec", "item_name", "ends_at", "extension",
+    "closed_at", "highest_bid_id")
+if not auction[1] then
+    return "missing"
+end
+
+local header = auction[2]
+if decode_field(header, auction[1]) ~= tonumber(ARGV[1]) then
+    return "not_in_progress"
+end
+local closed_at = auction[6] and decode_field(header, auction[6])
+if closed_at and closed_at ~= cjson.null then
+    return "not_in_progress"
+end
+
+local time = redis.call("TIME")
+-- Written out as is: cjson would round it to 14 digits.
+local stamp = time[1] .. "." .. string.format("%06d", tonumber(time[2]))
+local now = tonumber(stamp)
+local ends_at = auction[4] and decode_field(header, auction[4])
+if ends_at == cjson.null then
+    ends_at = nil
+end
+if ends_at and now >= ends_at then
+    return "not_in_progress"
+end
+
+local offer_price = tonumber(ARGV[2])
+-- NaN is the only value not equal to itself.
+if offer_price == nil or offer_price ~= offer_price or offer_price == math.huge
+        or offer_price <= 0 then
+    return "invalid_price"
+end
+
+local outbid_channel = nil
+local seeded = false
+local highest = redis.call(
+    "ZREVRANGEBYSCORE", KEYS[3], "+inf", "-inf", "WITHSCORES", "LIMIT", 0, 1)
+if not highest[1] then
+    local highest_bid_id = auction[7] and decode_field(header, auction[7])
+    if highest_bid_id and highest_bid_id ~= cjson.null then
+        if highest_bid_id ~= ARGV[14] then
+            return "no_ladder"
+        end
+        if ARGV[16] ~= "" then
+            highest = {ARGV[16], ARGV[15]}
+            seeded = true
+        end
+    end
+end
+if highest[1] then
+    if offer_price <= tonumber(highest[2]) then
+        return "too_low"
+    end
+    outbid_channel = ARGV[10] .. highest[1]
+end
+
+if decode_field(header, auction[3]) ~= ARGV[4] then
+    return "other_item"
+end
+
+local sorted = tonumber(ARGV[17])
+local bid = {}
+for i = 18 + sorted, #ARGV, 2 do
+    bid[ARGV[i]] = ARGV[i + 1]
+end
+if bid["_codec"] == "msgpack:1" then
+    bid["submitted_at"] = cmsgpack.pack(now)
+else
+    bid["submitted_at"] = stamp
+end
+local record = {}
+for field, value in pairs(bid) do
+    record[#record + 1] = field
+    record[#record + 1] = value
+end
+redis.call("HMSET", KEYS[2], unpack(record))
+for i = 7, #KEYS - sorted do
+    redis.call("SADD", KEYS[i], ARGV[3])
+end
+for i = 1, sorted do
+    local score = ARGV[17 + i]
+    if score == "" then
+        score = stamp
+    end
+    redis.call("ZADD", KEYS[#KEYS - sorted + i], score, ARGV[3])
+end
+if seeded then
+    redis.call("ZADD", KEYS[3], ARGV[15], ARGV[16])
+end
+redis.call("ZADD", KEYS[3], ARGV[2], ARGV[12])
+redis.call("SADD", KEYS[4], ARGV[13])
+
+redis.call("HSET", KEYS[1], "highest_bid_id", encode_field(header, ARGV[3]))
+
+local extension = auction[5] and decode_field(header, auction[5])
+if ends_at and extension and extension ~= cjson.null and ends_at - now < extension then
+    -- To the millisecond, which cjson encodes exactly.
+    ends_at = math.floor((now + extension) * 1000 + 0.5) / 1000
+    redis.call("HSET", KEYS[1], "ends_at", encode_field(header, ends_at))
+    redis.call("ZADD", KEYS[5], ends_at, ARGV[13])
+end
+
+-- Summaries are only kept for items that have one already.
+local function stamped(encoded)
+    return (string.gsub(encoded, '"submitted_at": null', '"submitted_at": ' .. stamp, 1))
+end
+
+if redis.call("HEXISTS", KEYS[6], "item") == 1 then
+    redis.call(
+        "HMSET", KEYS[6], "prevailing_bid", stamped(ARGV[5]), "highest_bid_id", ARGV[6])
+end
+
+redis.call("PUBLISH", ARGV[9], stamped(ARGV[7]))
+if outbid_channel and outbid_channel ~= ARGV[11] then
+    redis.call("PUBLISH", outbid_channel, stamped(ARGV[8]))
+end
+
+return "ok"
+"""
+
+
+def accept_bid_python(r, keys, args):
+    # Same as ACCEPT_BID_LUA, for backends without lua.
+    in_progress, offer_price, bid_id, summary_item_name = args[:4]
+
+    status, header, item_name, ends_at, extension, closed_at, highest_bid_id = r.hmget(
+        keys[0], ["status", HEADER_FIELD, "item_name", "ends_at", "extension",
+                  "closed_at", "highest_bid_id"])
+    if status is None:
+        return "missing"
+
+    codec = serializers.codec_for_header(header)
+    if codec.decode(status) != int(in_progress):
+        return "not_in_progress"
+    if closed_at and codec.decode(closed_at) is not None:
+        return "not_in_progress"
+
+    stamp = "%.6f" % time.time()
+    now = float(stamp)
+    ends_at = ends_at and codec.decode(ends_at)
+    if ends_at is not None and now >= ends_at:
+        return "not_in_progress"
+
+    try:
+        offer_price = float(offer_price)
+    except ValueError:
+        return "invalid_price"
+    if math.isnan(offer_price) or math.isinf(offer_price) or offer_price <= 0:
+        return "invalid_price"
+
+    accepted_event, outbid_event, auction_channel, user_channel_prefix, bidder_channel = (
+        args[6:11])
+
+    outbid_channel = None
+    seed = None
+    highest = r.zrevrangebyscore(keys[2], "+inf", "-inf", start=0, num=1, withscores=True)
+    highest_bid_id = highest_bid_id and codec.decode(highest_bid_id)
+    if not highest and highest_bid_id is not None:
+        known_bid_id, known_offer, known_bidder = args[13:16]
+        if highest_bid_id != known_bid_id.decode("utf-8"):
+            return "no_ladder"
+        if known_bidder:
+            seed = {known_bidder: float(known_offer)}
+            highest = list(seed.items())
+    if highest:
+        highest_participant_id, highest_price = highest[0]
+        if offer_price <= highest_price:
+            return "too_low"
+        outbid_channel = user_channel_prefix + highest_participant_id
+
+    if codec.decode(item_name).encode("utf-8") != summary_item_name:
+        return "other_item"
+
+    participant_id, auction_id = args[11:13]
+    sorted_count = int(args[16])
+    scores = args[17:17 + sorted_count]
+    pairs = args[17 + sorted_count:]
+    bid = dict(zip(pairs[::2], pairs[1::2]))
+    bid_codec = serializers.codec_for_header(bid[HEADER_FIELD.encode()])
+    bid[b"submitted_at"] = bid_codec.encode(now)
+    r.hmset(keys[1], bid)
+    for set_key in keys[6:len(keys) - sorted_count]:
+        r.sadd(set_key, bid_id)
+    for set_key, score in zip(keys[len(keys) - sorted_count:], scores):
+        r.zadd(set_key, {bid_id: score or now})
+    if seed:
+        r.zadd(keys[2], seed)
+    r.zadd(keys[2], {participant_id: offer_price})
+    r.sadd(keys[3], auction_id)
+
+    r.hset(keys[0], "highest_bid_id", codec.encode(bid_id.decode()))
+
+    extension = extension and codec.decode(extension)
+    if ends_at is not None and extension is not None and ends_at - now < extension:
+        ends_at = round(now + extension, 3)
+        r.hset(keys[0], "ends_at", codec.encode(ends_at))
+        r.zadd(keys[4], {auction_id: ends_at})
+
+    def stamped(encoded):
+        return encoded.replace(
+            b'"submitted_at": null', b'"submitted_at": ' + stamp.encode(), 1)
+
+    if r.hget(keys[5], "item") is not None:
+        r.hmset(keys[5], {"prevailing_bid": stamped(args[4]), "highest_bid_id": args[5]})
+
+    r.publish(auction_channel, stamped(accepted_event))
+    if outbid_channel and outbid_channel != bidder_channel:
+        r.publish(outbid_channel, stamped(outbid_event))
+
+    return "ok"
+
+
+# First step of calling an auction: stamping its closing time, which stops its
+# bids (see ACCEPT_BID_LUA) right away and in the same step as it is checked to
+# be in progress. The auction is then closed by a unit of work (see
+# `Auction.call`) as no bid can get in its way anymore; one stamped but left in
+# progress (by a caller gone in between) is closed by the next call.
+#
+# KEYS[1]: auction record.
+# ARGV[1]: in-progress status code, ARGV[2]: closing time, ARGV[3]: time the
+# auction must have ended by to be called, "" for any time.
+CLOSE_AUCTION_LUA = serializers.LUA_HELPERS + """
+local auction = redis.call("HMGET", KEYS[1], "status", "_codec", "ends_at", "closed_at")
+if not auction[1] then
+    return "missing"
+end
+
+local header = auction[2]
+if decode_field(header, auction[1]) ~= tonumber(ARGV[1]) then
+    return "not_in_progress"
+end
+
+local closed_at = auction[4] and decode_field(header, auction[4])
+if closed_at and closed_at ~= cjson.null then
+    return "ok"
+end
+
+if ARGV[3] ~= "" then
+    local ends_at = auction[3] and decode_field(header, auction[3])
+    if not ends_at or ends_at == cjson.null or ends_at > tonumber(ARGV[3]) then
+        return "not_due"
+    end
+end
+
+-- To the millisecond, which cjson encodes exactly.
+closed_at = math.floor(tonumber(ARGV[2]) * 1000 + 0.5) / 1000
+redis.call("HSET", KEYS[1], "closed_at", encode_field(header, closed_at))
+return "ok"
+"""
+
+
+def close_auction_python(r, keys, args):
+    # Same as CLOSE_AUCTION_LUA, for backends without lua.
+    in_progress, closing_time, due_at = args
+
+    status, header, ends_at, closed_at = r.hmget(
+        keys[0], ["status", HEADER_FIELD, "ends_at", "closed_at"])
+    if status is None:
+        return "missing"
+
+    codec = serializers.codec_for_header(header)
+    if codec.decode(status) != int(in_progress):
+        return "not_in_progress"
+
+    if closed_at and codec.decode(closed_at) is not None:
+        return "ok"
+
+    if due_at != b"":
+        ends_at = ends_at and codec.decode(ends_at)
+        if ends_at is None or ends_at > float(due_at):
+            return "not_due"
+
+    r.hset(keys[0], "closed_at", codec.encode(round(float(closing_time), 3)))
+    return "ok"
+
+
+def bidders_key(auction_id):
+    """
+    Sorted set of an auction's bidders, scored by their best offer. The
+    auction id's hash tag keeps it on the auction's shard (see sharding.py).
+
+    """
+
+    return "auction:bidders:{}".format(auction_id)
+
+
+def joined_key(participant_id):
+    """
+    Set of the live auctions a participant has bid on. Kept like an index
+    set of auctions (spread over shards along with them), but only ever
+    read and written directly: the bid script adds to it, and closing an
+    auction takes it out of its bidders' sets.
+
+    """
+
+    return rmanager.index_key("auction", "bidder", participant_id)
+
+
+def deadlines_key():
+    """
+    Sorted set of the timed auctions in progress, scored by their end time:
+    the ("ends_at", "status") sorted index of those in progress, which the
+    bid script also writes when a bid extends an auction.
+
+    """
+
+    return rmanager.sorted_index_key(
+        "auction", "ends_at", "status", const.AUCTION_STATUS_IN_PROGRESS)
+
+
+ACCEPT_BID_SCRIPT = rmanager.Script(ACCEPT_BID_LUA, accept_bid_python, "accept_bid")
+
+CLOSE_AUCTION_SCRIPT = rmanager.Script(
+    CLOSE_AUCTION_LUA, close_auction_python, "close_auction")
 
-import rmanager
-from bid import Bid
-from item import Item
-import constants as const
+CLOSE_ERRORS = {
+    "missing": "This auction does not exist.",
+    "not_in_progress": (
+        "This auction cannot be ended because it is currently not in progress."),
+    "not_due": "This auction is not due to end yet.",
+}
+
+# What ACCEPT_BID_SCRIPT answers when it needs to be run again, having read
+# the auction's item and highest bid (see `Auction._accept_bid_context`).
+ACCEPT_BID_RETRY = ("other_item", "no_ladder")
+
+BID_ERRORS = {
+    "missing": "This auction does not exist.",
+    "not_in_progress": "This auction is currently not in progress.",
+    "invalid_price": "Not a valid bid price for submission.",
+    "too_low": "Bid must be higher than the current highest bid.",
+}
 
 
 class Auction(rmanager.ManagedObject):
@@ -20,11 +404,26 @@ class Auction(rmanager.ManagedObject):
 
     category = "auction"
     identifier = "id"
-
-    def __init__(self, item_name):
-        item = Item.one(item_name)
-
-        self.id = str(uuid.uuid4())
+    fields = (
+        "id", "item_name", "reserved_price", "highest_bid_id", "winning_bid_id",
+        "status", "created_at", "started_at", "closed_at", "ends_at", "extension",
+    )
+    indexes = ("item_name", "status")
+    # Timestamps are epoch seconds; unstarted auctions are also kept by age,
+    # and timed ones in progress by end time (see `deadlines_key`).
+    sorted_indexes = (
+        "created_at", "started_at", "closed_at", ("created_at", "status"),
+        ("ends_at", "status"))
+
+    def __init__(self, item_name, item=None, ends_at=None, extension=None):
+        # Callers that have the item loaded already pass it in, and then save
+        # it along with the auction themselves.
+        save_item = item is None
+        if item is None:
+            item = Item.one(item_name)
+
+        # Stored on the item's shard (see sharding.py), bids on the auction's.
+        self.id = sharding.tagged_id(item.name)
         self.item_name = item.name
         self.reserved_price = item.reserved_price
 
@@ -32,28 +431,137 @@ class Auction(rmanager.ManagedObject):
         self.winning_bid_id = None
 
         self.status = const.AUCTION_STATUS_CREATED
-        self.created_at = str(datetime.now())
+        self.created_at = time.time()
         self.started_at = None
         self.closed_at = None
 
+        # Timed auctions are called once past `ends_at` (see scheduler.py),
+        # which a bid less than `extension` seconds before pushes back to
+        # `extension` seconds after the bid.
+        self.ends_at = ends_at
+        self.extension = extension
+
         # By association to an auction, item is now staged.
         item.status = const.ITEM_STATUS_STAGED
-        item.save()
+        if save_item:
+            item.save()
 
     def __repr__(self):
         return "<Auction id:'{}'>".format(self.id)
 
-    def save(self):
+    def _before_save(self):
         # Always update the status automatically at "save".
         self.status = self.get_status()
-        return super(Auction, self).save()
 
-    def get_all_submitted_bids(self):
+    def _derived_entries(self):
+        entry = summary.auction_entry(self, self.dirty_fields())
+        return [entry] if entry else []
+
+    def _index_changes(self, dirty_fields):
+        add_to, remove_from = super(Auction, self)._index_changes(dirty_fields)
+        # Closed, it leaves its bidders' joined auctions (see `_close`).
+        remove_from += [joined_key(p) for p in getattr(self, "_leaving", ())]
+        return add_to, remove_from
 
-        def filter_func(bid_record):
-            return bid_record.get("auction_id", None) == self.id
+    def _increments(self):
+        if "closed_at" not in self.dirty_fields() or not self.closed_at:
+            return []
+        return aggregates.closed_increments(self, getattr(self, "_sold_price", None))
 
-        return Bid.all(filter_func)
+    def _events(self):
+        if "status" not in self.dirty_fields():
+            return []
+        return events.auction_events(self, getattr(self, "_winner_id", None))
+
+    def get_all_submitted_bids(self):
+        # Highest first, from the auction's price ladder.
+        return Bid.between("offer_price", reverse=True, auction_id=self.id)
+
+    @classmethod
+    def top_bids(cls, auction_id, count=10):
+        """The auction's `count` highest bids, highest first."""
+        return Bid.between(
+            "offer_price", reverse=True, limit=count, auction_id=auction_id)
+
+    @classmethod
+    def bidder_rank(cls, auction_id, participant_id):
+        """
+        (rank, best offer, number of bidders) of a participant on the auction,
+        ranked by best offer, 1 for the highest bidder; rank and best offer
+        are None if they haven't bid.
+
+        """
+
+        return rmanager.get_rank(
+            cls.category, bidders_key(auction_id), participant_id)
+
+    @classmethod
+    def bidders(cls, auction_id):
+        """Participant ids of the auction's bidders, highest bidder first."""
+        return rmanager.sorted_members(
+            cls.category, bidders_key(auction_id), reverse=True)
+
+    @classmethod
+    def joined_by(cls, participant_id):
+        """Live auctions the participant has bid on."""
+        records = rmanager.get_indexed_records(
+            cls.category, cls._joined_plan(participant_id))
+        return [cls._make_object_from_record(r) for r in records]
+
+    @classmethod
+    def page_joined_by(cls, participant_id, cursor=0, page_size=100):
+        """One page of `joined_by`, as (auctions, next_cursor)."""
+        set_key, record_filter = cls._joined_page_plan(participant_id)
+        cursor, records = rmanager.scan_records(
+            cls.category, cursor, page_size, set_key=set_key,
+            filter_func=record_filter)
+        return [cls._make_object_from_record(r) for r in records], cursor
+
+    @classmethod
+    def _joined_plan(cls, participant_id):
+        # Sets to intersect for `joined_by`; the status index guards against
+        # auctions closed outside of the api.
+        return [
+            joined_key(participant_id),
+            rmanager.index_key(cls.category, "status", const.AUCTION_STATUS_IN_PROGRESS),
+        ]
+
+    @classmethod
+    def _joined_page_plan(cls, participant_id):
+        # Set to scan for `page_joined_by`, and the same guard as a filter.
+        def record_filter(record):
+            return record.get("status") == const.AUCTION_STATUS_IN_PROGRESS
+
+        return joined_key(participant_id), record_filter
+
+    @classmethod
+    def drop_bidders(cls, auction_id):
+        """Delete the auction's bidders ladder, e.g. once it is archived."""
+        rmanager.set_sorted(cls.category, bidders_key(auction_id), {})
+
+    @classmethod
+    def rebuild_bidders(cls):
+        """
+        Rebuild every auction's bidders ladder, and the live ones' places in
+        their bidders' joined auctions, from the saved bids, e.g. for bids
+        accepted before these were kept.
+
+        """
+
+        best = {}
+        for bid in Bid.all():
+            offers = best.setdefault(bid.auction_id, {})
+            offers[bid.participant_id] = max(
+                bid.offer_price, offers.get(bid.participant_id, bid.offer_price))
+
+        for auction_id, offers in best.items():
+            rmanager.set_sorted(cls.category, bidders_key(auction_id), offers)
+
+        live = cls.find(status=const.AUCTION_STATUS_IN_PROGRESS)
+        rmanager.set_many_records([
+            (cls.category, a.id, {}, [joined_key(p) for p in best[a.id]], (), None)
+            for a in live if a.id in best
+        ])
 
     def get_status(self):
         # Auction status can be derived implicitly based on timestamps(s)
@@ -71,6 +579,18 @@ class Auction(rmanager.ManagedObject):
             return const.AUCTION_STATUS_CREATED
 
     def start(self):
+        error = self._start()
+        if error:
+            return error
+
+        self.save()
+
+        return {
+            "status": "success",
+            "auction_id": self.id,
+        }
+
+    def _start(self):
         # Auction already in progress or closed, should not restart.
         if self.status > const.AUCTION_STATUS_CREATED:
             return {
@@ -82,15 +602,90 @@ class Auction(rmanager.ManagedObject):
             }
 
         # All good, go ahead and update necessary fields.
-        self.started_at = str(datetime.now())
-        self.save()
+        self.started_at = time.time()
+
+    @staticmethod
+    def _deadline_error(ends_at, extension):
+        # End time and extension for a new timed auction, if any.
+        errors = []
+        if ends_at is not None and ends_at <= time.time():
+            errors.append("Auction end time must be in the future.")
+        if extension is not None and ends_at is None:
+            errors.append("Only timed auctions can be extended.")
+        elif extension is not None and extension <= 0:
+            errors.append("Not a valid auction extension.")
+
+        if errors:
+            return {
+                "status": "error",
+                "errors": errors,
+            }
+
+    @classmethod
+    def call(cls, auction_id, due_at=None):
+        """
+        Call (end) the auction, however many bids keep coming in: its bids
+        are stopped first (see CLOSE_AUCTION_LUA), then it is closed as
+        `end` does. With `due_at`, only if it's a timed auction whose end
+        time is no later.
+
+        """
+
+        ret = CLOSE_AUCTION_SCRIPT(*cls._close_call(auction_id, due_at))
+        if ret != "ok":
+            return {
+                "status": "error",
+                "errors": [CLOSE_ERRORS[ret]],
+            }
+
+        return cls._end_closing(auction_id)
+
+    @classmethod
+    def _close_call(cls, auction_id, due_at=None):
+        # The keys and args to run CLOSE_AUCTION_SCRIPT with.
+        keys = [rmanager.record_key(cls.category, auction_id)]
+        args = [const.AUCTION_STATUS_IN_PROGRESS, time.time(),
+                "" if due_at is None else due_at]
+        return keys, args
+
+    @classmethod
+    @rmanager.atomic
+    def _end_closing(cls, auction_id):
+        auction = cls.one(auction_id)
+        error = cls._end_closing_error(auction)
+        if error:
+            return error
+
+        return auction.end()
+
+    @staticmethod
+    def _end_closing_error(auction):
+        # Why an auction whose bids `call` stopped can't be ended, if so.
+        if auction is None:
+            return {
+                "status": "error",
+                "errors": [CLOSE_ERRORS["missing"]],
+            }
+        return auction._end_error()
+
+    def end(self):
+        error = self._end_error()
+        if error:
+            return error
+
+        item = Item.one(self.item_name)
+        highest_bid = Bid.one(self.highest_bid_id)
+        self._close(item, highest_bid, Auction.bidders(self.id))
+
+        # Auction and item go out together, so neither is ever saved alone.
+        self.save_many([self, item])
 
         return {
             "status": "success",
             "auction_id": self.id,
         }
 
-    def end(self):
+    def _end_error(self):
         # Auction already going or closed, should not restart.
         if self.status != const.AUCTION_STATUS_IN_PROGRESS:
             return {
@@ -101,60 +696,136 @@ class Auction(rmanager.ManagedObject):
                 ],
             }
 
+    def _close(self, item, highest_bid, bidders=()):
         # Check if we have winning bid based on highest bid vs reserved price.
-        item = Item.one(self.item_name)
-        highest_bid = Bid.one(self.highest_bid_id)
-        if highest_bid.offer_price >= self.reserved_price:
+        if highest_bid and highest_bid.offer_price >= self.reserved_price:
             self.winning_bid_id = highest_bid.id
+            # Not persisted, for the auction_won event and the aggregates.
+            self._winner_id = highest_bid.participant_id
+            self._sold_price = highest_bid.offer_price
             item.status = const.ITEM_STATUS_SOLD
         else:
             # Mark the item back so that it can be available for auction again.
             item.status = const.ITEM_STATUS_AVAILABLE
 
-        self.closed_at = str(datetime.now())
-        self.save()
-        item.save()
-
-        return {
-            "status": "success",
-            "auction_id": self.id,
-        }
+        if self.closed_at:
+            # Stamped when stopping its bids (see `call`), but to be saved
+            # (and indexed) along with the rest still.
+            self.mark_dirty("closed_at")
+        else:
+            self.closed_at = time.time()
+        # Not persisted, whose joined auctions it leaves when saved.
+        self._leaving = list(bidders)
 
     def process_bid(self, submitted_price, participant_id):
-        status = self.get_status()
-
-        # Auction is not live; no bid to process.
-        if status != const.AUCTION_STATUS_IN_PROGRESS:
+        ret = Auction.accept_bid(self.id, submitted_price, participant_id)
+        if ret["status"] == "success":
+            # Already stored by accept_bid, so not dirty.
+            self.highest_bid_id = ret["bid_id"]
+            if getattr(self, "_saved_state", None) is not None:
+                self._saved_state["highest_bid_id"] = ret["bid_id"]
+
+        return ret
+
+    @classmethod
+    def accept_bid(cls, auction_id, submitted_price, participant_id):
+        """
+        Validate and store a bid for the given auction in one round trip,
+        without loading the auction first.
+
+        The auction must exist and be in progress, and the submitted price must
+        be positive and beat the current highest bid; all checked atomically
+        against what is stored at the time the bid lands.
+
+        """
+
+        bid, keys, args = cls._accept_bid_call(
+            auction_id, submitted_price, participant_id)
+        ret = ACCEPT_BID_SCRIPT(keys, args)
+        if ret in ACCEPT_BID_RETRY:
+            auction = cls.get_fields(auction_id, "item_name", "highest_bid_id") or {}
+            highest_bid_id = auction.get("highest_bid_id")
+            highest_bid = highest_bid_id and Bid.get_fields(
+                highest_bid_id, "offer_price", "participant_id")
+            bid, keys, args = cls._accept_bid_call(
+                auction_id, submitted_price, participant_id,
+                *cls._accept_bid_context(auction, highest_bid))
+            ret = ACCEPT_BID_SCRIPT(keys, args)
+
+        return cls._accept_bid_result(bid, ret)
+
+    @staticmethod
+    def _accept_bid_context(auction, highest_bid):
+        # The item name and highest bid to run ACCEPT_BID_SCRIPT again with,
+        # from the auction's item_name and highest_bid_id fields and that
+        # bid's offer_price and participant_id (None if gone).
+        highest_bid_id = auction.get("highest_bid_id")
+        if not highest_bid_id:
+            return auction.get("item_name"), None
+        if highest_bid is None:
+            return auction.get("item_name"), (highest_bid_id, "", "")
+        return auction.get("item_name"), (
+            highest_bid_id, highest_bid["offer_price"], highest_bid["participant_id"])
+
+    @classmethod
+    def _accept_bid_call(cls, auction_id, submitted_price, participant_id,
+                         item_name=None, highest=None):
+        # The new bid, and the keys and args to run ACCEPT_BID_SCRIPT with,
+        # for the auction of the given item (by default, of its id's tag) and
+        # with the given (id, offer, bidder) highest bid, if known.
+        if item_name is None:
+            item_name = sharding.tag_of(auction_id)
+        bid = Bid(auction_id, submitted_price, participant_id)
+        _, bid_key, bid_data, add_to, _, header = bid._save_entry()
+        # Stamped by the script instead (see ACCEPT_BID_LUA).
+        bid.submitted_at = None
+        stamped_by = rmanager.sorted_index_key(Bid.category, "submitted_at")
+
+        field_pairs = []
+        for field, value in rmanager.encode_record(bid_data, header).items():
+            field_pairs += [field, value]
+
+        set_keys = [k for k in add_to if not isinstance(k, tuple)]
+        sorted_keys = [k for k in add_to if isinstance(k, tuple)]
+        keys = [
+            rmanager.record_key(cls.category, auction_id),
+            rmanager.record_key(Bid.category, bid_key),
+            bidders_key(auction_id),
+            joined_key(participant_id),
+            deadlines_key(),
+            rmanager.record_key(summary.CATEGORY, item_name),
+            rmanager.ids_key(Bid.category),
+        ] + set_keys + [k for k, _ in sorted_keys]
+        args = [
+            const.AUCTION_STATUS_IN_PROGRESS,
+            submitted_price,
+            bid.id,
+            item_name,
+            summary.encode(summary.bid_part(bid)),
+            summary.encode(bid.id),
+        ] + list(events.bid_events(bid)) + [
+            events.auction_channel(auction_id),
+            events.user_channel(""),
+            events.user_channel(participant_id),
+            participant_id,
+            auction_id,
+        ] + list(highest or ("", "", "")) + [
+            len(sorted_keys),
+        ] + [
+            "" if k == stamped_by or k.startswith(stamped_by + ":") else score
+            for k, score in sorted_keys
+        ] + field_pairs
+
+        return bid, keys, args
+
+    @classmethod
+    def _accept_bid_result(cls, bid, ret):
+        if ret != "ok":
             return {
                 "status": "error",
-                "errors": ["This auction is currently not in progress."],
+                "errors": [BID_ERRORS[ret]],
             }
 
-        # Some basic input validation.
-        if submitted_price <= 0:
-            return {
-                "status": "error",
-                "errors": ["Not a valid bid price for submission."],
-            }
-
-        # Submitted bid must beat current highest bid, otherwise not allowed.
-        if self.highest_bid_id is not None:
-            highest_bid = Bid.one(self.highest_bid_id)
-            if submitted_price <= highest_bid.offer_price:
-                return {
-                    "status": "error",
-                    "errors": [
-                        "Bid must be higher than the current highest bid."
-                    ],
-                }
-
-        # All good, save submitted bid and update necessary fields.
-        bid = Bid(self.id, submitted_price, participant_id)
-        self.highest_bid_id = bid.id
-
-        bid.save()
-        self.save()
-
         return {
             "status": "success",
             "bid_id": bid.id
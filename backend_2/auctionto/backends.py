@@ -0,0 +1,687 @@
+import bisect
+import fnmatch
+import numbers
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import redis
+
+
+"""
+Storage backends for rmanager.
+
+A backend is anything that speaks the (small) subset of the redis-py client
+api that rmanager relies on, plus `run_script` to execute an rmanager.Script
+atomically (and `run_scripts` to execute it several times in one round trip,
+each run atomic on its own):
+
+    hget, hmget, hgetall, hset, hmset, hdel, hincrby, hincrbyfloat,
+    sadd, srem, smembers, sinter, scard, sscan,
+    zadd, zrem, zscore, zcard, zcount, zrevrank, zrangebyscore,
+    zrevrangebyscore, exists, delete, type, flushall, ping, publish,
+    pipeline, pubsub
+
+with pipelines supporting WATCH/MULTI for optimistic transactions, and pub/sub
+objects supporting subscribe, unsubscribe, get_message and close.
+
+`RedisBackend` is the real thing. `MemoryBackend` keeps everything in process
+with the same semantics (values come back as byte strings, pipelines apply
+atomically like MULTI/EXEC, wrong-type access raises ResponseError), so the
+library can run embedded and the test/bench scripts need no redis-server.
+
+Scan cursors are opaque: callers start from 0, pass back whatever they got,
+and stop once they get 0 back.
+"""
+
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+class RedisBackend(redis.StrictRedis):
+    """Shared redis-py client, plus script support by sha."""
+
+    def __init__(self, *args, **kwargs):
+        super(RedisBackend, self).__init__(*args, **kwargs)
+        self._scripts = {}
+
+    def run_script(self, script, keys, args):
+        registered = self._scripts.get(script)
+        if registered is None:
+            registered = self._scripts[script] = self.register_script(script.lua)
+
+        return registered(keys=keys, args=args, client=self)
+
+    def run_scripts(self, script, calls, raise_on_error=True):
+        registered = self._scripts.get(script)
+        if registered is None:
+            registered = self._scripts[script] = self.register_script(script.lua)
+
+        pipe = self.pipeline(transaction=False)
+        for keys, args in calls:
+            registered(keys=keys, args=args, client=pipe)
+        return pipe.execute(raise_on_error=raise_on_error)
+
+    def close(self):
+        self.connection_pool.disconnect()
+
+
+def encode(value):
+    """Encode a key or value the way redis-py sends it to the server."""
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, bool):
+        raise redis.DataError(
+            "Invalid input of type: 'bool'. Convert to a bytes, string, int or "
+            "float first.")
+    elif isinstance(value, float):
+        return repr(value).encode()
+    elif isinstance(value, numbers.Integral):
+        return str(value).encode()
+    elif isinstance(value, text_type):
+        return value.encode("utf-8")
+
+    raise redis.DataError(
+        "Invalid input of type: '{}'. Convert to a bytes, string, int or "
+        "float first.".format(type(value).__name__))
+
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+# Commands supported by the memory engine, each implemented as "_<name>".
+COMMANDS = (
+    "hget", "hmget", "hgetall", "hset", "hmset", "hdel", "hincrby", "hincrbyfloat",
+    "sadd", "srem", "smembers", "sinter", "scard", "sscan",
+    "zadd", "zrem", "zscore", "zcard", "zcount", "zrevrank",
+    "zrangebyscore", "zrevrangebyscore",
+    "exists", "delete", "type", "flushall", "ping", "publish",
+)
+
+
+class MemoryBackend(object):
+    """
+    Thread-safe in-process engine with redis semantics for the commands above.
+
+    One re-entrant lock guards the whole keyspace; every command, pipeline and
+    script runs under it, which gives pipelines and scripts the same
+    all-or-nothing visibility they have on a real server.
+
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+        # Sorted members of sets being scanned (and of sorted sets being
+        # ranged over), dropped when the set changes.
+        self._sorted_members = {}
+        # Changes per key, for WATCH; FLUSHALL counts as a change to all.
+        self._versions = {}
+        self._flushes = 0
+        # channel -> MemoryPubSubs subscribed to it
+        self._subscribers = {}
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return MemoryPubSub(self)
+
+    def run_script(self, script, keys, args):
+        # Scripts see keys and args as byte strings, like KEYS/ARGV in lua.
+        keys = [encode(k) for k in keys]
+        args = [encode(a) for a in args]
+        with self._lock:
+            return script.python(_Raw(self), keys, args)
+
+    def run_scripts(self, script, calls, raise_on_error=True):
+        replies = []
+        for keys, args in calls:
+            try:
+                replies.append(self.run_script(script, keys, args))
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                replies.append(e)
+        return replies
+
+    def scan_iter(self, match=None, count=None):
+        """Every key (matching the glob pattern), like redis-py's scan_iter."""
+        with self._lock:
+            names = list(self._data)
+        for name in names:
+            if match is None or fnmatch.fnmatchcase(name, encode(match)):
+                yield name
+
+    def close(self):
+        pass
+
+    def _execute(self, name, args, kwargs):
+        with self._lock:
+            return getattr(self, "_" + name)(*args, **kwargs)
+
+    # Keyspace helpers.
+
+    def _get(self, name, kind, create=False):
+        name = encode(name)
+        value = self._data.get(name)
+        if value is None:
+            if not create:
+                return None
+            value = self._data[name] = kind()
+        elif not isinstance(value, kind):
+            raise redis.ResponseError(WRONGTYPE)
+        return value
+
+    def _touch(self, name):
+        name = encode(name)
+        self._versions[name] = self._versions.get(name, 0) + 1
+
+    def _version(self, name):
+        return (self._flushes, self._versions.get(encode(name), 0))
+
+    def _cleanup(self, name):
+        # Like redis, empty hashes and sets stop existing.
+        name = encode(name)
+        if not self._data.get(name, True):
+            del self._data[name]
+            self._sorted_members.pop(name, None)
+
+    # Hashes.
+
+    def _hget(self, name, key):
+        return (self._get(name, dict) or {}).get(encode(key))
+
+    def _hmget(self, name, keys, *args):
+        keys = _list_or_args(keys, args)
+        hash_ = self._get(name, dict) or {}
+        return [hash_.get(encode(k)) for k in keys]
+
+    def _hgetall(self, name):
+        return dict(self._get(name, dict) or {})
+
+    def _hset(self, name, key=None, value=None, mapping=None):
+        items = {}
+        if key is not None:
+            items[key] = value
+        items.update(mapping or {})
+        if not items:
+            raise redis.DataError("'hset' with no key value pairs")
+
+        hash_ = self._get(name, dict, create=True)
+        added = 0
+        for k, v in items.items():
+            k = encode(k)
+            added += k not in hash_
+            hash_[k] = encode(v)
+        self._touch(name)
+        return added
+
+    def _hmset(self, name, mapping):
+        if not mapping:
+            raise redis.DataError("'hmset' with 'mapping' of length 0")
+        self._hset(name, mapping=mapping)
+        return True
+
+    def _hdel(self, name, *keys):
+        hash_ = self._get(name, dict) or {}
+        removed = 0
+        for k in keys:
+            removed += hash_.pop(encode(k), None) is not None
+        if removed:
+            self._touch(name)
+        self._cleanup(name)
+        return removed
+
+    def _hincrby(self, name, key, amount=1):
+        return self._hincr(name, key, amount, int, "ERR hash value is not an integer")
+
+    def _hincrbyfloat(self, name, key, amount=1.0):
+        return self._hincr(name, key, amount, float, "ERR hash value is not a float")
+
+    def _hincr(self, name, key, amount, kind, error):
+        hash_ = self._get(name, dict, create=True)
+        try:
+            value = kind(hash_.get(encode(key), b"0").decode()) + kind(amount)
+        except ValueError:
+            raise redis.ResponseError(error)
+        hash_[encode(key)] = encode(value)
+        self._touch(name)
+        return value
+
+    # Sets.
+
+    def _sadd(self, name, *values):
+        set_ = self._get(name, set, create=True)
+        before = len(set_)
+        set_.update(encode(v) for v in values)
+        self._sorted_members.pop(encode(name), None)
+        if len(set_) != before:
+            self._touch(name)
+        return len(set_) - before
+
+    def _srem(self, name, *values):
+        set_ = self._get(name, set) or set()
+        self._sorted_members.pop(encode(name), None)
+        before = len(set_)
+        set_.difference_update(encode(v) for v in values)
+        if len(set_) != before:
+            self._touch(name)
+        self._cleanup(name)
+        return before - len(set_)
+
+    def _smembers(self, name):
+        return set(self._get(name, set) or ())
+
+    def _sinter(self, keys, *args):
+        keys = _list_or_args(keys, args)
+        sets = [self._get(k, set) or set() for k in keys]
+        return set.intersection(*sets) if sets else set()
+
+    def _scard(self, name):
+        return len(self._get(name, set) or ())
+
+    def _sscan(self, name, cursor=0, match=None, count=None):
+        """
+        Members in sorted order, `count` at a time. The cursor is the last
+        member returned, so members present for the whole scan are returned
+        exactly once even if the set changes in between.
+
+        """
+
+        if match is not None:
+            raise redis.DataError("MATCH is not supported in memory")
+
+        set_ = self._get(name, set)
+        if not set_:
+            return 0, []
+
+        members = self._sorted_members.get(encode(name))
+        if members is None:
+            members = self._sorted_members[encode(name)] = sorted(set_)
+
+        start = 0 if cursor == 0 else bisect.bisect_right(members, encode(cursor))
+        batch = members[start:start + (count or 10)]
+        if start + len(batch) >= len(members):
+            return 0, batch
+        return batch[-1], batch
+
+    # Sorted sets.
+
+    def _zadd(self, name, mapping, nx=False, xx=False, ch=False):
+        if not mapping:
+            raise redis.DataError("ZADD requires at least one element/score pair")
+
+        zset = self._get(name, SortedSet, create=True)
+        added = changed = 0
+        for member, score in mapping.items():
+            member = encode(member)
+            score = float(score)
+            old = zset.scores.get(member)
+            if (nx and old is not None) or (xx and old is None) or old == score:
+                continue
+            added += old is None
+            changed += 1
+            zset.scores[member] = score
+
+        if changed:
+            self._sorted_members.pop(encode(name), None)
+            self._touch(name)
+        self._cleanup(name)
+        return changed if ch else added
+
+    def _zrem(self, name, *values):
+        zset = self._get(name, SortedSet) or SortedSet()
+        removed = 0
+        for value in values:
+            removed += zset.scores.pop(encode(value), None) is not None
+        if removed:
+            self._sorted_members.pop(encode(name), None)
+            self._touch(name)
+        self._cleanup(name)
+        return removed
+
+    def _zscore(self, name, value):
+        return (self._get(name, SortedSet) or SortedSet()).scores.get(encode(value))
+
+    def _zcard(self, name):
+        return len(self._get(name, SortedSet) or ())
+
+    def _zcount(self, name, min, max):
+        scores, _ = self._zordered(name)
+        first, last = _score_slice(scores, min, max)
+        return last - first if last > first else 0
+
+    def _zrevrank(self, name, value):
+        zset = self._get(name, SortedSet)
+        score = zset.scores.get(encode(value)) if zset else None
+        if score is None:
+            return None
+
+        scores, members = self._zordered(name)
+        first = bisect.bisect_left(scores, score)
+        last = bisect.bisect_right(scores, score)
+        index = first + bisect.bisect_left(members[first:last], encode(value))
+        return len(members) - 1 - index
+
+    def _zrangebyscore(self, name, min, max, start=None, num=None,
+                       withscores=False, score_cast_func=float):
+        members = self._zrange(name, min, max, start, num, reverse=False)
+        return _with_scores(members, withscores, score_cast_func)
+
+    def _zrevrangebyscore(self, name, max, min, start=None, num=None,
+                          withscores=False, score_cast_func=float):
+        members = self._zrange(name, min, max, start, num, reverse=True)
+        return _with_scores(members, withscores, score_cast_func)
+
+    def _zrange(self, name, min, max, start, num, reverse):
+        # (member, score) pairs by score, then member, within the bounds.
+        if (start is None) != (num is None):
+            raise redis.DataError("``start`` and ``num`` must both be specified")
+
+        scores, members = self._zordered(name)
+        first, last = _score_slice(scores, min, max)
+
+        selected = list(zip(members[first:last], scores[first:last]))
+        if reverse:
+            selected.reverse()
+        if start is not None:
+            selected = selected[start:start + num] if num >= 0 else selected[start:]
+        return selected
+
+    def _zordered(self, name):
+        # Scores and members, sorted by score then member.
+        zset = self._get(name, SortedSet)
+        if not zset:
+            return [], []
+
+        ordered = self._sorted_members.get(encode(name))
+        if ordered is None:
+            pairs = sorted((score, member) for member, score in zset.scores.items())
+            ordered = self._sorted_members[encode(name)] = (
+                [score for score, _ in pairs], [member for _, member in pairs])
+        return ordered
+
+    # Keys and server.
+
+    def _exists(self, *names):
+        return sum(encode(n) in self._data for n in names)
+
+    def _delete(self, *names):
+        deleted = 0
+        for n in names:
+            self._sorted_members.pop(encode(n), None)
+            if self._data.pop(encode(n), None) is not None:
+                self._touch(n)
+                deleted += 1
+        return deleted
+
+    def _type(self, name):
+        value = self._data.get(encode(name))
+        if value is None:
+            return b"none"
+        if isinstance(value, SortedSet):
+            return b"zset"
+        return b"hash" if isinstance(value, dict) else b"set"
+
+    def _flushall(self, asynchronous=False):
+        self._data.clear()
+        self._sorted_members.clear()
+        self._versions.clear()
+        self._flushes += 1
+        return True
+
+    def _ping(self):
+        return True
+
+    # Pub/sub.
+
+    def _publish(self, channel, message):
+        channel = encode(channel)
+        subscribers = self._subscribers.get(channel, ())
+        for pubsub in subscribers:
+            pubsub._messages.put((channel, encode(message)))
+        return len(subscribers)
+
+
+class SortedSet(object):
+    """A sorted set of the memory engine: member -> score."""
+
+    def __init__(self):
+        self.scores = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+
+def _score_bound(value):
+    # (score, exclusive) for a ZRANGEBYSCORE bound, e.g. 5, "-inf", "(5".
+    if isinstance(value, bytes):
+        value = value.decode("ascii")
+    if isinstance(value, text_type):
+        if value.startswith("("):
+            return float(value[1:]), True
+        return float(value), False
+    return float(value), False
+
+
+def _score_slice(scores, min, max):
+    # Where the scores within the bounds start and end.
+    low, low_open = _score_bound(min)
+    high, high_open = _score_bound(max)
+    first = (bisect.bisect_right if low_open else bisect.bisect_left)(scores, low)
+    last = (bisect.bisect_left if high_open else bisect.bisect_right)(scores, high)
+    return first, last
+
+
+def _with_scores(members, withscores, score_cast_func):
+    if withscores:
+        return [(member, score_cast_func(score)) for member, score in members]
+    return [member for member, _ in members]
+
+
+class MemoryPipeline(object):
+    """
+    Buffers commands, then applies them all under the backend lock.
+
+    Like redis-py's, `watch` makes `execute` fail with WatchError, applying
+    nothing, if any watched key changed in between. Commands are always
+    buffered though, never run right away while watching.
+
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.command_stack = []
+        self._watched = {}
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def watch(self, *names):
+        with self.backend._lock:
+            for name in names:
+                self._watched.setdefault(encode(name), self.backend._version(name))
+        return True
+
+    def multi(self):
+        pass
+
+    def execute(self, raise_on_error=True):
+        stack, self.command_stack = self.command_stack, []
+        watched, self._watched = self._watched, {}
+
+        results = []
+        with self.backend._lock:
+            for name, version in watched.items():
+                if self.backend._version(name) != version:
+                    raise redis.WatchError("Watched variable changed.")
+
+            for name, args, kwargs in stack:
+                try:
+                    results.append(getattr(self.backend, "_" + name)(*args, **kwargs))
+                except redis.ResponseError as e:
+                    # A failing command doesn't abort the others, like EXEC.
+                    results.append(e)
+
+        if raise_on_error:
+            for r in results:
+                if isinstance(r, Exception):
+                    raise r
+
+        return results
+
+    def reset(self):
+        self.command_stack = []
+        self._watched = {}
+
+
+def watched_reader(pipe, backend):
+    """
+    What to read from while `pipe` (of `backend`) holds WATCHes: the pipeline
+    itself with redis, the backend in memory, where there is no connection
+    to spare.
+
+    """
+
+    if isinstance(pipe, MemoryPipeline):
+        return backend
+    return WatchedReader(pipe)
+
+
+class WatchedReader(object):
+    """
+    Reads through a redis-py pipeline holding WATCHes, whose commands run
+    right away until MULTI. Pipelines off it run their commands one by one.
+
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+        return getattr(self.pipe, name)
+
+    def pipeline(self, transaction=True):
+        return ReadBatch(self)
+
+
+class ReadBatch(object):
+    """Pipeline of commands run one by one on a client at `execute`."""
+
+    def __init__(self, client):
+        self.client = client
+        self.command_stack = []
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.command_stack.append((name, args, kwargs))
+            return self
+        return queue
+
+    def multi(self):
+        pass
+
+    def execute(self, raise_on_error=True):
+        stack, self.command_stack = self.command_stack, []
+        results = []
+        for name, args, kwargs in stack:
+            try:
+                results.append(getattr(self.client, name)(*args, **kwargs))
+            except redis.ResponseError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+    def reset(self):
+        self.command_stack = []
+
+
+class MemoryPubSub(object):
+    """
+    Subscriber of a MemoryBackend. Only published messages are returned by
+    `get_message`, like a redis-py PubSub ignoring subscribe messages.
+
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.channels = set()
+        self._messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        with self.backend._lock:
+            for channel in channels:
+                channel = encode(channel)
+                self.backend._subscribers.setdefault(channel, set()).add(self)
+                self.channels.add(channel)
+
+    def unsubscribe(self, *channels):
+        with self.backend._lock:
+            for channel in channels or list(self.channels):
+                channel = encode(channel)
+                subscribers = self.backend._subscribers.get(channel, set())
+                subscribers.discard(self)
+                if not subscribers:
+                    self.backend._subscribers.pop(channel, None)
+                self.channels.discard(channel)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            channel, data = self._messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return {"type": "message", "pattern": None, "channel": channel, "data": data}
+
+    def close(self):
+        self.unsubscribe()
+
+
+class _Raw(object):
+    """Script-side view of the memory engine, i.e. lua's `redis.call`."""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self._backend, "_" + name)
+
+
+def _list_or_args(keys, args):
+    if isinstance(keys, (bytes, text_type)):
+        keys = [keys]
+    return list(keys) + list(args)
+
+
+def _backend_command(name):
+    def command(self, *args, **kwargs):
+        return self._execute(name, args, kwargs)
+    command.__name__ = name
+    return command
+
+
+def _pipeline_command(name):
+    def command(self, *args, **kwargs):
+        self.command_stack.append((name, args, kwargs))
+        return self
+    command.__name__ = name
+    return command
+
+
+for _name in COMMANDS:
+    setattr(MemoryBackend, _name, _backend_command(_name))
+    setattr(MemoryPipeline, _name, _pipeline_command(_name))
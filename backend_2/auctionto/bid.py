@@ -1,7 +1,7 @@
-import uuid
-from datetime import datetime
+import time
 
-import rmanager
+from . import rmanager
+from . import sharding
 
 
 class Bid(rmanager.ManagedObject):
@@ -14,14 +14,20 @@ class Bid(rmanager.ManagedObject):
 
     category = "bid"
     identifier = "id"
+    fields = ("id", "offer_price", "auction_id", "participant_id", "submitted_at")
+    indexes = ("auction_id", "participant_id")
+    # Each auction's bids are also kept in price order, its bid ladder.
+    sorted_indexes = (
+        "submitted_at", ("submitted_at", "auction_id"), ("offer_price", "auction_id"))
 
     def __init__(self, auction_id, offer_price, participant_id):
-        self.id = str(uuid.uuid4())
+        self.id = sharding.tagged_id(auction_id)
         self.offer_price = offer_price
         self.auction_id = auction_id
         self.participant_id = participant_id
 
-        self.submitted_at = str(datetime.now())
+        # Bids accepted by `Auction.accept_bid` get the server's time instead.
+        self.submitted_at = time.time()
 
     def __repr__(self):
         return "<Bid id:'{}' price:'{}'>".format(self.id, self.offer_price)
@@ -0,0 +1,420 @@
+import atexit
+import hashlib
+import itertools
+import math
+import multiprocessing
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import backends
+from . import rmanager
+from .auction import ACCEPT_BID_RETRY, ACCEPT_BID_SCRIPT, Auction
+from .bid import Bid
+from . import constants as const
+
+
+"""
+Bid processing over a pool of worker processes, each auction owned by
+exactly one of them.
+
+Bids are routed by auction id to their auction's worker, over one queue per
+worker, so that an auction's bids are handled one at a time in the order they
+were submitted, while other auctions' bids are handled alongside, by as many
+workers (and cores) as there are.
+
+A worker keeps the status and highest offer of the auctions it owns in
+memory, read on their first bid, and turns down the bids that can't win
+without going to storage. The others are persisted a batch at a time (up to
+"bid_batch_size" of those queued) by the same script as `Auction.accept_bid`,
+run once per bid, in order, in one round trip. The script still checks each
+bid against what is stored, so bids accepted some other way and auctions
+called meanwhile are honoured; the worker then reads the auction again. Bids
+it turned down for being below one that didn't go through are sent after all.
+
+    rmanager.configure(bid_workers=4)   # or AUCTIONTO_BID_WORKERS=4
+    participant.submit_bid_for_auction(auction_id, 120)
+
+goes through the process' pool (see `get_pool`), or use a `BidPool` directly.
+Workers connect with the storage settings current when the pool starts, which
+must be shared with the submitting process, i.e. not the memory backend.
+Their round trips are counted in their own stats (see stats.py).
+"""
+
+# What a closed (or gone) auction answers to every bid after it.
+CLOSED = ("missing", "not_in_progress")
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+class PendingBid(object):
+    """A submitted bid, answered once its auction's worker got to it."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _set(self, result, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        The same dict as `Auction.accept_bid`, waiting up to `timeout`; raises
+        what it would have raised.
+
+        """
+
+        if not self._done.wait(timeout):
+            raise Exception("Bid still unanswered after {} seconds.".format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class BidPool(object):
+    """
+    Worker processes, each the only one accepting bids for its auctions; see
+    above. Start it before submitting, and close it when done, e.g.
+    `with BidPool(workers=4) as pool:`.
+
+    """
+
+    def __init__(self, workers=None, batch_size=None, timeout=30):
+        settings = rmanager.current_settings()
+        self.workers = workers or settings["bid_workers"]
+        self.batch_size = batch_size or settings["bid_batch_size"]
+        # How long `submit_bid` waits for an answer.
+        self.timeout = timeout
+        if self.workers < 1:
+            raise Exception("A bid pool needs at least one worker.")
+
+        self._settings = settings
+        self._processes = []
+        self._requests = []
+        self._results = None
+        self._collector = None
+        # request id -> PendingBid
+        self._pending = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<BidPool workers:{}>".format(self.workers)
+
+    def start(self):
+        nodes = self._settings["shards"] or [{}]
+        if any(dict(self._settings, **node)["backend"] == "memory" for node in nodes):
+            raise Exception("Bid workers can't share the memory backend.")
+
+        self._results = multiprocessing.Queue()
+        for index in range(self.workers):
+            requests = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_serve,
+                args=(self._settings, requests, self._results, self.batch_size),
+                name="auctionto-bids-{}".format(index))
+            process.daemon = True
+            process.start()
+            self._requests.append(requests)
+            self._processes.append(process)
+
+        self._collector = threading.Thread(target=self._collect, name="auctionto-bids")
+        self._collector.daemon = True
+        self._collector.start()
+        return self
+
+    def owner(self, auction_id):
+        """Index of the worker the given auction's bids go to."""
+        if not isinstance(auction_id, bytes):
+            auction_id = auction_id.encode("utf-8")
+        return int(hashlib.md5(auction_id).hexdigest()[:8], 16) % self.workers
+
+    def submit(self, auction_id, bid_price, participant_id):
+        """Queue a bid to its auction's worker, returning a PendingBid."""
+
+        pending = PendingBid()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = pending
+        self._requests[self.owner(auction_id)].put(
+            (request_id, auction_id, bid_price, participant_id))
+        return pending
+
+    def submit_bid(self, auction_id, bid_price, participant_id):
+        """Same as `Auction.accept_bid`, through the auction's worker."""
+        return self.submit(auction_id, bid_price, participant_id).result(self.timeout)
+
+    def close(self):
+        """Stop the workers once they are done with the bids queued so far."""
+
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join(self.timeout)
+        if self._collector is not None:
+            self._results.put(None)
+            self._collector.join(self.timeout)
+
+        self._processes = []
+        self._requests = []
+        self._collector = None
+
+    def _collect(self):
+        while True:
+            answers = self._results.get()
+            if answers is None:
+                break
+            for request_id, result, error in answers:
+                with self._lock:
+                    pending = self._pending.pop(request_id, None)
+                if pending is not None:
+                    pending._set(result, error)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_pool():
+    """
+    The process' bid pool, started on first use and restarted whenever the
+    storage settings change; None while the "bid_workers" setting is 0.
+
+    """
+
+    global _pool, _pool_key
+    settings = rmanager.current_settings()
+    key = (settings["bid_workers"], settings["bid_batch_size"], rmanager._generation,
+           os.getpid())
+
+    with _pool_lock:
+        if _pool_key != key:
+            # A forked child leaves its parent's pool alone.
+            if _pool is not None and _pool_key[-1] == os.getpid():
+                _pool.close()
+            _pool = None
+            if settings["bid_workers"]:
+                _pool = BidPool().start()
+            _pool_key = key
+
+    return _pool
+
+
+@atexit.register
+def shutdown():
+    """Close the process' bid pool, if started."""
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is not None and _pool_key[-1] == os.getpid():
+            _pool.close()
+        _pool = None
+        _pool_key = None
+
+
+def _serve(settings, requests, results, batch_size):
+    # A worker's main loop.
+    rmanager.after_fork(settings)
+    owned = OwnedAuctions()
+    while True:
+        batch, stopping = _next_batch(requests, batch_size)
+        if batch:
+            try:
+                answers = owned.process(batch)
+            except Exception as error:
+                # Some of the batch may be stored, like an accept_bid call
+                # that raised; start over from what is.
+                owned.highest.clear()
+                answers = [(b[0], None, error) for b in batch]
+            results.put(answers)
+        if stopping:
+            break
+
+    rmanager.disconnect()
+
+
+def _next_batch(requests, batch_size):
+    # Waits for one request, then takes what else is queued, up to batch_size.
+    request = requests.get()
+    if request is None:
+        return [], True
+
+    batch = [request]
+    while len(batch) < batch_size:
+        try:
+            request = requests.get_nowait()
+        except queue.Empty:
+            break
+        if request is None:
+            return batch, True
+        batch.append(request)
+
+    return batch, False
+
+
+class OwnedAuctions(object):
+    """
+    A worker's view of the live auctions it owns: their highest offer (0 for
+    none yet), as of their last bid it handled.
+
+    """
+
+    def __init__(self):
+        self.highest = {}
+        # Item names, for their summary, and (id, offer, bidder) highest bids
+        # when read, for the ladder of auctions without one (see
+        # ACCEPT_BID_LUA).
+        self.item_names = {}
+        self.highest_bids = {}
+
+    def process(self, batch):
+        """
+        Accept or turn down a batch of (request id, auction id, price,
+        participant id) bids, in order; returns [(request id, result,
+        exception raised for it or None)].
+
+        """
+
+        codes = dict(self._load(set(b[1] for b in batch) - set(self.highest)))
+        # [request id, auction id, price, participant id, bid sent or None,
+        # code, exception or result]
+        outcomes = []
+        for request_id, auction_id, price, participant_id in batch:
+            outcome = [request_id, auction_id, price, participant_id, None, None]
+            outcomes.append(outcome)
+            if auction_id in codes:
+                outcome[5] = codes[auction_id]
+                continue
+
+            outcome[5] = self._check(auction_id, price)
+            if outcome[5] is None and self._prepare(outcome):
+                self.highest[auction_id] = float(price)
+        self._send(outcomes)
+
+        # Bids turned down as too low against one that didn't go through
+        # after all are sent too, to be checked against what is stored.
+        failed = set()
+        resent = []
+        for outcome in outcomes:
+            auction_id, bid, code = outcome[1], outcome[4], outcome[5]
+            if bid is not None and code != "ok":
+                failed.add(auction_id)
+            elif bid is None and code == "too_low" and auction_id in failed:
+                resent.append(outcome)
+        for outcome in resent:
+            self._prepare(outcome)
+        self._send(resent)
+
+        closed = {}
+        results = []
+        for request_id, auction_id, price, participant_id, bid, code in outcomes:
+            if isinstance(code, dict):
+                results.append((request_id, code, None))
+                continue
+            if isinstance(code, Exception):
+                results.append((request_id, None, code))
+                continue
+            if code != "ok" and auction_id in closed:
+                code = closed[auction_id]
+            elif code in CLOSED:
+                closed[auction_id] = code
+            results.append((request_id, Auction._accept_bid_result(bid, code), None))
+
+        for auction_id in closed:
+            self.highest.pop(auction_id, None)
+            self.item_names.pop(auction_id, None)
+            self.highest_bids.pop(auction_id, None)
+        return results
+
+    def _prepare(self, outcome):
+        # Sets the outcome's bid to send, or its error; True for the former.
+        _, auction_id, price, participant_id, _, _ = outcome
+        try:
+            bid, keys, args = Auction._accept_bid_call(
+                auction_id, price, participant_id, self.item_names[auction_id],
+                self.highest_bids.get(auction_id))
+            # Arguments redis can't take fail their bid, not the batch.
+            for arg in args:
+                backends.encode(arg)
+        except Exception as error:
+            outcome[5] = error
+            return False
+        outcome[4] = bid
+        outcome[5] = (keys, args)
+        return True
+
+    def _send(self, outcomes):
+        # Runs the script for the outcomes with a bid, in order, answering
+        # them with its replies. A run that fails fails its bid only.
+        sent = [o for o in outcomes if o[4] is not None and isinstance(o[5], tuple)]
+        replies = ACCEPT_BID_SCRIPT.run_many([o[5] for o in sent], raise_on_error=False)
+        for outcome, code in zip(sent, replies):
+            _, auction_id, price, participant_id, _, _ = outcome
+            if code != "ok":
+                # Changed behind our back (or failed): read it again next
+                # time.
+                self.highest.pop(auction_id, None)
+            if code in ACCEPT_BID_RETRY:
+                # Answered as `Auction.accept_bid` would, reading it again.
+                try:
+                    code = Auction.accept_bid(auction_id, price, participant_id)
+                except Exception as error:
+                    code = error
+            outcome[5] = code
+
+    def _check(self, auction_id, price):
+        # What the bid script would say, as far as we know.
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            return "invalid_price"
+        if math.isnan(price) or math.isinf(price) or price <= 0:
+            return "invalid_price"
+        if price <= self.highest[auction_id]:
+            return "too_low"
+        return None
+
+    def _load(self, auction_ids):
+        # Keeps the live ones, returns [(auction id, error)] for the others.
+        auction_ids = list(auction_ids)
+        if not auction_ids:
+            return []
+
+        auctions = rmanager.get_cached_records(
+            Auction.category, auction_ids, fields=["status", "highest_bid_id", "item_name"])
+
+        live = {}
+        closed = []
+        for auction_id, auction in zip(auction_ids, auctions):
+            if auction is None:
+                closed.append((auction_id, "missing"))
+            elif auction["status"] != const.AUCTION_STATUS_IN_PROGRESS:
+                closed.append((auction_id, "not_in_progress"))
+            else:
+                live[auction_id] = auction["highest_bid_id"]
+                self.item_names[auction_id] = auction["item_name"]
+
+        bid_ids = [b for b in live.values() if b]
+        bids = rmanager.get_cached_records(
+            Bid.category, bid_ids, fields=["offer_price", "participant_id"])
+        bids = dict(zip(bid_ids, bids))
+        for auction_id, bid_id in live.items():
+            bid = bids.get(bid_id)
+            self.highest[auction_id] = float(bid["offer_price"]) if bid else 0.0
+            self.highest_bids[auction_id] = Auction._accept_bid_context(
+                {"highest_bid_id": bid_id}, bid)[1]
+
+        return closed
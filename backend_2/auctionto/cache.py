@@ -0,0 +1,227 @@
+import threading
+import time
+import warnings
+from collections import OrderedDict
+
+import redis
+
+from . import stats
+
+
+"""
+Process-local read-through cache of decoded records, for `ManagedObject.one`,
+`one_many` and `get_fields` (see rmanager.configure, "cache" settings).
+
+Entries are evicted least recently used first once there are more than
+`max_records` of them or they take more than `max_bytes` (as stored), and
+expire `ttl` seconds after being read from storage.
+
+Writes made through this process drop the records they touch right away.
+Writes made by other processes are picked up from redis keyspace
+notifications (see KeyspaceListener), which the listener turns on for hash
+and generic commands if the server allows CONFIG SET. Notifications are
+fire and forget, so the listener drops everything whenever its connection
+is lost, and `ttl` bounds how stale a record can be if one still goes
+missing (e.g. after a FLUSHALL, which sends none).
+"""
+
+
+class RecordCache(object):
+
+    def __init__(self, max_records=10000, max_bytes=64 * 1024 * 1024, ttl=30):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # key -> (record, size, expires_at), least recently used first.
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # Reads in flight, see `reserve`.
+        self._pending = {}
+        # KeyspaceListeners feeding this cache, one per redis node.
+        self.listeners = []
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Cached record for the key (a copy), or None."""
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            record, size, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                self._bytes -= size
+                self.misses += 1
+                return None
+
+            # Back to the most recently used end.
+            self._entries[key] = entry
+            self.hits += 1
+            return dict(record)
+
+    def reserve(self, key):
+        """
+        Note that the key is about to be read from storage, and return a
+        token for `put`. Invalidating the key in between voids the token, so
+        that a read racing a write never caches the value from before it.
+
+        """
+
+        token = object()
+        with self._lock:
+            self._pending[key] = token
+        return token
+
+    def put(self, key, token, record):
+        """Cache what was read for the key (None: nothing, just the token)."""
+
+        if record is None:
+            with self._lock:
+                if self._pending.get(key) is token:
+                    del self._pending[key]
+            return
+
+        size = stats.payload_size(record)
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            if self._pending.get(key) is not token:
+                return
+            del self._pending[key]
+
+            if size > self.max_bytes:
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (dict(record), size, expires_at)
+            self._bytes += size
+
+            while (len(self._entries) > self.max_records
+                    or self._bytes > self.max_bytes):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._entries.clear()
+            self._bytes = 0
+
+    def close(self):
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
+        self.clear()
+
+    def info(self):
+        with self._lock:
+            return {
+                "records": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class KeyspaceListener(object):
+    """
+    Background thread dropping records from the cache as redis reports
+    them changed, by any process.
+
+    """
+
+    # Hash commands (h) and DEL/EXPIRE & co (g), as keyspace events (K).
+    EVENTS = "Khg"
+
+    def __init__(self, cache, client, db=0):
+        self.cache = cache
+        self.client = client
+        self.pattern = "__keyspace@{}__:*:rec:*".format(db)
+        self.prefix_length = len("__keyspace@{}__:".format(db))
+        self._stopped = threading.Event()
+
+        self._enable_events()
+        # Subscribed before anything gets cached, so nothing is missed.
+        self._pubsub = self._subscribe()
+        self._thread = threading.Thread(target=self._run, name="auctionto-cache")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _enable_events(self):
+        try:
+            events = self.client.config_get("notify-keyspace-events")
+            current = events.get("notify-keyspace-events", "")
+            if isinstance(current, bytes):
+                current = current.decode("ascii")
+            # "A" is an alias for all event classes, including h and g.
+            missing = [e for e in self.EVENTS if e not in current]
+            if "A" in current:
+                missing = [e for e in missing if e == "K"]
+            if missing:
+                self.client.config_set(
+                    "notify-keyspace-events", current + "".join(missing))
+        except redis.ResponseError as e:
+            warnings.warn(
+                "Cannot enable keyspace notifications ({}), cached records "
+                "written by other processes are only refreshed on expiry.".format(e))
+
+    def _subscribe(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self.pattern)
+        return pubsub
+
+    def _run(self):
+        pubsub = self._pubsub
+        while not self._stopped.is_set():
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe()
+                    # Whatever changed while we were not listening is unknown.
+                    self.cache.clear()
+
+                message = pubsub.get_message(timeout=0.25)
+                if message is None:
+                    continue
+                key = message["channel"][self.prefix_length:]
+                if isinstance(key, bytes):
+                    key = key.decode("utf-8")
+                self.cache.invalidate([key])
+            except redis.ConnectionError:
+                pubsub = self._close(pubsub)
+                self.cache.clear()
+                self._stopped.wait(1.0)
+
+        self._close(pubsub)
+
+    def _close(self, pubsub):
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except redis.RedisError:
+                pass
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join(5)
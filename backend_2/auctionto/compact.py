@@ -0,0 +1,30 @@
+"""
+Archives closed auctions and their bids (see archive.py).
+
+    python -m auctionto.compact                         # closed over 7 days ago
+    python -m auctionto.compact --retention-days 30
+
+Auctions are archived a batch at a time, each in its own transaction, so it
+can run alongside live traffic, and be stopped and run again at any point.
+"""
+
+import argparse
+
+from . import archive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--retention-days", type=float,
+                        default=archive.RETENTION_SECONDS / 86400.0,
+                        help="archive auctions closed longer ago than this")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="auctions archived per batch")
+    parser.add_argument("--pause", type=float, default=0.1,
+                        help="seconds to wait between batches")
+    options = parser.parse_args()
+
+    archived = archive.archive_closed_auctions(
+        retention=options.retention_days * 86400, batch_size=options.batch_size,
+        pause=options.pause)
+    print("{} auctions archived.".format(archived))
@@ -0,0 +1,135 @@
+"""
+Consistency checks of derived records against their sources.
+
+    python -m auctionto.consistency            # report
+    python -m auctionto.consistency --repair   # report, and rebuild
+
+Checks every item summary (see summary.py) against what the item, auction
+and bid records say, and summaries left without an item, and the aggregate
+counters (see aggregates.py) against the called auctions, live or archived.
+Repairs rebuild a summary, or the counters, from their sources; writes
+landing in between can still make them stale again, so run it while the
+library is quiet, or check again afterwards.
+"""
+
+import argparse
+
+from . import aggregates
+from . import archive
+from . import rmanager
+from . import summary
+from . import constants as const
+from .archive import ArchivedAuction
+from .auction import Auction
+from .bid import Bid
+from .item import Item
+from .user import compute_summary, summary_sources
+
+
+def materialized_summary(item_name):
+    record = rmanager.get_one_record(summary.CATEGORY, item_name)
+    if record is None:
+        return None
+    return summary.render_record(record)
+
+
+def rebuild_item_summary(item_name):
+    """Rewrite the item's summary from its sources (or drop it, if no item)."""
+
+    sources = summary_sources(item_name)
+    if sources is None:
+        return rmanager.delete_one_record(summary.CATEGORY, item_name)
+
+    return rmanager.set_many_records([summary.full_entry(*sources)])
+
+
+def check_item_summaries(repair=False, batch_size=100):
+    """
+    Return (item_name, materialized, expected) for every summary that
+    doesn't match its sources, where either side may be None. With `repair`,
+    those summaries are rebuilt.
+
+    """
+
+    mismatches = []
+    for item in Item.iter_all(batch_size=batch_size):
+        materialized = materialized_summary(item.name)
+        expected = compute_summary(item.name)
+        if materialized != expected:
+            mismatches.append((item.name, materialized, expected))
+
+    for record in rmanager.iter_records(summary.CATEGORY, batch_size=batch_size):
+        item_name = record["item"]["name"]
+        if Item.get_fields(item_name, "name") is None:
+            mismatches.append((item_name, summary.render_record(record), None))
+
+    if repair:
+        for item_name, _, _ in mismatches:
+            rebuild_item_summary(item_name)
+
+    return mismatches
+
+
+def expected_counters(batch_size=100):
+    """Aggregate counters recounted from the called auctions, live or archived."""
+
+    counters = {"called": 0, "sold": 0, "sold_volume": 0.0}
+
+    def count(status, sold_price):
+        counters["called"] += 1
+        if status == const.AUCTION_STATUS_CALLED_SUCCESS:
+            counters["sold"] += 1
+            counters["sold_volume"] += float(sold_price or 0)
+
+    for status in (const.AUCTION_STATUS_CALLED_SUCCESS, const.AUCTION_STATUS_CALLED_FAIL):
+        for auction in Auction.iter_all(batch_size=batch_size, status=status):
+            winning = auction.winning_bid_id and Bid.get_fields(
+                auction.winning_bid_id, "offer_price")
+            count(status, winning["offer_price"] if winning else None)
+
+    for archived in ArchivedAuction.iter_all(batch_size=batch_size):
+        _, winning = archive.sold_auction([archived])
+        count(archived.status, winning.offer_price if winning else None)
+
+    return counters
+
+
+def check_aggregates(repair=False, batch_size=100):
+    """
+    Return (counters, expected) if the aggregate counters don't match the
+    called auctions, None if they do. With `repair`, they are rebuilt.
+
+    """
+
+    counters = aggregates.get_counters()
+    expected = expected_counters(batch_size=batch_size)
+    if (counters["called"] == expected["called"]
+            and counters["sold"] == expected["sold"]
+            and abs(counters["sold_volume"] - expected["sold_volume"]) < 1e-6):
+        return None
+
+    if repair:
+        aggregates.set_counters(expected)
+    return counters, expected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repair", action="store_true",
+                        help="rebuild summaries and counters that don't match")
+    options = parser.parse_args()
+
+    mismatches = check_item_summaries(repair=options.repair)
+    for item_name, materialized, expected in mismatches:
+        print("{}:\n  summary:  {}\n  expected: {}".format(
+            item_name, materialized, expected))
+
+    print("{} item summaries out of date{}.".format(
+        len(mismatches), ", repaired" if options.repair and mismatches else ""))
+
+    mismatch = check_aggregates(repair=options.repair)
+    if mismatch:
+        print("aggregate counters:\n  stored:   {}\n  expected: {}".format(*mismatch))
+    print("Aggregate counters {}.".format(
+        "up to date" if mismatch is None
+        else "out of date, repaired" if options.repair else "out of date"))
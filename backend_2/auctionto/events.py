@@ -0,0 +1,284 @@
+import json
+import logging
+import threading
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import redis
+
+from . import constants as const
+
+
+"""
+Auction events, pushed to subscribers as they happen instead of polled for.
+
+    subscription = participant.subscribe(auction_ids=[auction_id])
+    event = subscription.get(timeout=5)    # or: for event in subscription
+    subscription.close()
+
+Events are dicts with a "type" and the "auction_id":
+
+    auction_started  item_name, started_at
+    bid_accepted     bid_id, offer_price, participant_id, submitted_at
+    auction_called   item_name, status, winning_bid_id, closed_at
+
+    outbid           same as bid_accepted, for the previous highest bidder
+    auction_won      same as auction_called, for the winner
+
+The first three are published on a channel per auction, "events:auction:<id>",
+the last two on the user's own channel, "events:user:<id>". Each goes out
+along with the write that causes it (from the bid script, or in the
+MULTI/EXEC saving the auction), so only for writes that happened, in order.
+
+Each process keeps a single subscriber connection (see Hub), however many
+subscriptions it serves: redis sends an event once per process, and the hub
+fans it out locally. Like any redis pub/sub this is at most once, events
+published while the hub is disconnected are lost; subscribers that can't
+miss one re-read the state they follow (e.g. the item summary) after
+subscribing.
+"""
+
+log = logging.getLogger(__name__)
+
+AUCTION_STARTED = "auction_started"
+BID_ACCEPTED = "bid_accepted"
+AUCTION_CALLED = "auction_called"
+OUTBID = "outbid"
+AUCTION_WON = "auction_won"
+
+
+def auction_channel(auction_id):
+    return "events:auction:{}".format(auction_id)
+
+
+def user_channel(user_id):
+    return "events:user:{}".format(user_id)
+
+
+def encode(event):
+    return json.dumps(event, sort_keys=True)
+
+
+def bid_events(bid):
+    """Encoded bid_accepted and outbid events for a bid (see the bid script)."""
+
+    event = {
+        "auction_id": bid.auction_id,
+        "bid_id": bid.id,
+        "offer_price": bid.offer_price,
+        "participant_id": bid.participant_id,
+        "submitted_at": bid.submitted_at,
+    }
+    return (encode(dict(event, type=BID_ACCEPTED)),
+            encode(dict(event, type=OUTBID)))
+
+
+def auction_events(auction, winner_id=None):
+    """(channel, message) pairs announcing the auction's current status."""
+
+    channel = auction_channel(auction.id)
+    if auction.status == const.AUCTION_STATUS_IN_PROGRESS:
+        return [(channel, encode({
+            "type": AUCTION_STARTED,
+            "auction_id": auction.id,
+            "item_name": auction.item_name,
+            "started_at": auction.started_at,
+        }))]
+
+    if auction.closed_at:
+        event = {
+            "auction_id": auction.id,
+            "item_name": auction.item_name,
+            "status": auction.status,
+            "winning_bid_id": auction.winning_bid_id,
+            "closed_at": auction.closed_at,
+        }
+        messages = [(channel, encode(dict(event, type=AUCTION_CALLED)))]
+        if winner_id:
+            messages.append(
+                (user_channel(winner_id), encode(dict(event, type=AUCTION_WON))))
+        return messages
+
+    return []
+
+
+def _text(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+
+class Hub(object):
+    """
+    One subscriber connection serving every subscription in the process.
+
+    A background thread reads events and hands each to the sinks (callables)
+    of its channel. Pub/sub connections aren't thread safe, so subscription
+    changes are queued for that thread, which `add` wakes up with a message
+    on the hub's own channel, and waits for.
+
+    """
+
+    POLL_SECONDS = 0.5
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.wake_channel = "events:hub:{}".format(uuid.uuid4().hex)
+        self._lock = threading.Lock()
+        # channel -> sinks
+        self._sinks = {}
+        self._changes = queue.Queue()
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name="auctionto-events")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, channels, sink):
+        with self._lock:
+            new = [c for c in channels if c not in self._sinks]
+            for channel in channels:
+                self._sinks.setdefault(channel, []).append(sink)
+        if new:
+            done = threading.Event()
+            self._changes.put(("subscribe", new, done))
+            self.backend.publish(self.wake_channel, "")
+            done.wait(5)
+
+    def remove(self, channels, sink):
+        # Unsubscribed lazily, on the next wake up.
+        with self._lock:
+            gone = []
+            for channel in channels:
+                sinks = self._sinks.get(channel, [])
+                if sink in sinks:
+                    sinks.remove(sink)
+                if not sinks and channel in self._sinks:
+                    del self._sinks[channel]
+                    gone.append(channel)
+        if gone:
+            self._changes.put(("unsubscribe", gone, None))
+
+    def _run(self):
+        pubsub = None
+        subscribed = set()
+        while not self._stopped.is_set():
+            try:
+                if pubsub is None:
+                    pubsub = self.backend.pubsub(ignore_subscribe_messages=True)
+                    subscribed = set()
+                    self._changes.put(("resubscribe", None, None))
+
+                self._apply_changes(pubsub, subscribed)
+                message = pubsub.get_message(timeout=self.POLL_SECONDS)
+                if message is None or message["type"] != "message":
+                    continue
+                channel = _text(message["channel"])
+                if channel != self.wake_channel:
+                    self._dispatch(channel, message["data"])
+            except redis.ConnectionError:
+                self._close(pubsub)
+                pubsub = None
+                self._stopped.wait(1.0)
+            except Exception:
+                # Anything else starts over too, rather than end the thread.
+                log.exception("Event hub failed, reconnecting.")
+                self._close(pubsub)
+                pubsub = None
+                self._stopped.wait(1.0)
+
+        self._close(pubsub)
+
+    def _apply_changes(self, pubsub, subscribed):
+        while True:
+            try:
+                change, channels, done = self._changes.get_nowait()
+            except queue.Empty:
+                return
+
+            with self._lock:
+                wanted = set(self._sinks)
+            wanted.add(self.wake_channel)
+            if change == "resubscribe":
+                channels = list(wanted)
+
+            # By now some may have been dropped again, or added back.
+            if change == "unsubscribe":
+                channels = [c for c in channels if c not in wanted and c in subscribed]
+                if channels:
+                    pubsub.unsubscribe(*channels)
+                    subscribed.difference_update(channels)
+            else:
+                channels = [c for c in channels if c in wanted and c not in subscribed]
+                if channels:
+                    pubsub.subscribe(*channels)
+                    subscribed.update(channels)
+
+            if done is not None:
+                done.set()
+
+    def _dispatch(self, channel, data):
+        # A bad message or sink is logged and skipped, the others still go.
+        try:
+            event = json.loads(_text(data))
+        except ValueError:
+            log.exception("Malformed event on %s: %r", channel, data)
+            return
+        with self._lock:
+            sinks = list(self._sinks.get(channel, ()))
+        for sink in sinks:
+            try:
+                sink(event)
+            except Exception:
+                log.exception("Event sink for %s failed.", channel)
+
+    def _close(self, pubsub):
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except redis.RedisError:
+                pass
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join(5)
+
+
+class Subscription(object):
+    """Events of some channels, queued until read; see rmanager.subscribe."""
+
+    def __init__(self, hub, channels):
+        self.hub = hub
+        self.channels = list(channels)
+        self._events = queue.Queue()
+        self._sink = self._events.put
+        hub.add(self.channels, self._sink)
+
+    def get(self, timeout=None):
+        """Next event, or None if none came within `timeout` seconds."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def __iter__(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self.hub.remove(self.channels, self._sink)
+        # Ends iterations in progress.
+        self._events.put(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
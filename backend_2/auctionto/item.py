@@ -1,7 +1,8 @@
-from datetime import datetime
+import time
 
-import rmanager
-import constants as const
+from . import rmanager
+from . import summary
+from . import constants as const
 
 
 class Item(rmanager.ManagedObject):
@@ -14,18 +15,23 @@ class Item(rmanager.ManagedObject):
 
     category = "item"
     identifier = "name"
+    fields = ("name", "reserved_price", "status", "created_at", "updated_at")
+    # Also what keeps counts per status (see aggregates.py).
+    indexes = ("status",)
 
     def __init__(self, name, reserved_price):
         self.name = name
         self.reserved_price = reserved_price
 
         self.status = const.ITEM_STATUS_AVAILABLE
-        self.created_at = str(datetime.now())
-        self.updated_at = str(datetime.now())
+        self.created_at = time.time()
+        self.updated_at = time.time()
 
     def __repr__(self):
         return "<Item name:'{}'>".format(self.name)
 
-    def save(self):
-        self.updated_at = str(datetime.now())
-        return super(Item, self).save()
+    def _before_save(self):
+        self.updated_at = time.time()
+
+    def _derived_entries(self):
+        return [summary.item_entry(self)]
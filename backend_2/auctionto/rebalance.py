@@ -0,0 +1,32 @@
+"""
+Moves keys to the shards they are routed to, after shards were added or
+drained (see sharding.py).
+
+    python -m auctionto.rebalance              # keys per shard
+    python -m auctionto.rebalance --move       # move keys, then count again
+
+Shards are the ones configured, e.g. by AUCTIONTO_SHARDS, listing the old and
+the new nodes alike (a node given weight 0 gets everything moved off it).
+Keys are copied then deleted, so run it while nothing writes.
+"""
+
+import argparse
+import json
+
+from . import rmanager
+from . import sharding
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--move", action="store_true",
+                        help="move keys to the shards they belong to")
+    options = parser.parse_args()
+
+    backend = rmanager.get_backend()
+    if not isinstance(backend, sharding.ShardedBackend):
+        parser.error("no shards configured (see AUCTIONTO_SHARDS)")
+
+    if options.move:
+        print("moved: {}".format(json.dumps(sharding.rebalance(backend), sort_keys=True)))
+    print("keys: {}".format(json.dumps(sharding.shard_sizes(backend), sort_keys=True)))
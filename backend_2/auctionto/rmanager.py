@@ -1,6 +1,413 @@
-import inspect
-import redis
+import atexit
+import functools
 import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import redis
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+from . import backends
+from . import cache
+from . import events
+from . import serializers
+from . import sharding
+from . import stats
+from .serializers import HEADER_FIELD
+
+
+"""
+Process-wide storage layer.
+
+Every helper below goes through one shared backend (see backends.py). By default
+that is a redis client over a single connection pool, instead of a fresh client
+per call. The pool hands out one connection per command (or per pipeline), so
+the shared client can safely be used from any number of threads, and it
+re-creates its connections after a fork.
+
+Call `configure` once at startup to point the library somewhere else than the
+default local redis-server, e.g.
+
+    rmanager.configure(unix_socket_path="/var/run/redis.sock", max_connections=200)
+
+or to run fully in process, without any redis-server:
+
+    rmanager.configure(backend="memory")
+
+The AUCTIONTO_BACKEND environment variable sets the default backend, so e.g.
+`AUCTIONTO_BACKEND=memory python testrun.py` runs the tests in memory.
+
+Hot records can also be kept in process (see cache.py), so that repeated
+`one`/`one_many`/`get_fields` reads don't leave it:
+
+    rmanager.configure(cache=True, cache_max_records=50000, cache_ttl=60)
+
+Records can be spread over several redis nodes (see sharding.py), each given
+as the settings that differ from the ones above:
+
+    rmanager.configure(shards=[{"host": "10.0.0.1"}, {"host": "10.0.0.2"}])
+
+or AUCTIONTO_SHARDS="10.0.0.1,10.0.0.2:6380/1" (or e.g. "memory,memory" for
+in-process stand-ins).
+
+"""
+
+DEFAULT_SETTINGS = {
+    # "redis" or "memory".
+    "backend": os.environ.get("AUCTIONTO_BACKEND", "redis"),
+    "host": "localhost",
+    "port": 6379,
+    "db": 0,
+    "password": None,
+    # When set, host/port are ignored and we connect over the unix socket.
+    "unix_socket_path": None,
+    # Pool sizing; callers block up to "pool_timeout" seconds for a free
+    # connection once "max_connections" are all checked out.
+    "max_connections": 50,
+    "pool_timeout": 5,
+    "socket_timeout": None,
+    "socket_connect_timeout": None,
+    # Idle connections are PINGed before reuse if unused for this long.
+    "health_check_interval": 30,
+    # Override the redis-py connection class, e.g. to instrument it.
+    "connection_class": None,
+    # Codec for records written from now on, "json" or "msgpack" (see
+    # serializers.py). Records are read with whatever codec they were
+    # written with.
+    "codec": os.environ.get("AUCTIONTO_CODEC", "json"),
+    # Process-local cache of managed object records (see cache.py), off by
+    # default. Bounded by record count and by size, each record kept at most
+    # "cache_ttl" seconds (None for no limit).
+    "cache": os.environ.get("AUCTIONTO_CACHE", "") not in ("", "0"),
+    "cache_max_records": 10000,
+    "cache_max_bytes": 64 * 1024 * 1024,
+    "cache_ttl": 30,
+    # Drop records written by other processes as redis reports them changed
+    # (keyspace notifications); without, they are only refreshed on expiry.
+    "cache_notifications": True,
+    # Nodes to spread records over (see sharding.py), None for just one. Each
+    # is a dict of the connection settings above that differ for the node,
+    # plus optionally its "name" on the hash ring (by default its address;
+    # keep it when the address changes, or its keys move) and "weight" (1 by
+    # default, 0 to drain it).
+    "shards": sharding.parse_nodes(os.environ.get("AUCTIONTO_SHARDS", "")) or None,
+    # Points per node on the hash ring.
+    "shard_replicas": sharding.REPLICAS,
+    # Worker processes bids are submitted through (see bidpool.py), 0 to
+    # accept them in the submitting process, and how many bids a worker
+    # persists per round trip at most.
+    "bid_workers": int(os.environ.get("AUCTIONTO_BID_WORKERS", "") or 0),
+    "bid_batch_size": 100,
+}
+
+# Settings a shard can override.
+SHARD_SETTINGS = (
+    "backend", "host", "port", "db", "password", "unix_socket_path",
+    "max_connections", "pool_timeout", "socket_timeout",
+    "socket_connect_timeout", "health_check_interval", "connection_class",
+)
+
+_settings = dict(DEFAULT_SETTINGS)
+_backend = None
+_backend_lock = threading.Lock()
+_cache = None
+_cache_pid = None
+_hub = None
+# Bumped whenever the backend is dropped, so that other clients built from the
+# same settings (see aio.py) know to rebuild theirs too.
+_generation = 0
+
+
+def configure(**settings):
+    """
+    Update storage settings, and drop the current backend so that the next
+    call picks up the new settings.
+
+    """
+
+    unknown = set(settings) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise Exception(
+            "Unknown storage setting(s): {}".format(", ".join(sorted(unknown)))
+        )
+
+    if "codec" in settings:
+        serializers.get_codec(settings["codec"])
+
+    with _backend_lock:
+        _settings.update(settings)
+        # Switching codecs, cache or bid worker settings doesn't need a new
+        # backend (nor drop memory data); bid pools pick up theirs by
+        # themselves.
+        cache_settings = set(s for s in settings if s.startswith("cache"))
+        bid_settings = set(s for s in settings if s.startswith("bid_"))
+        if set(settings) - set(["codec"]) - cache_settings - bid_settings:
+            _reset_backend()
+        elif cache_settings:
+            _reset_cache()
+
+
+def set_backend(backend):
+    """Use the given backend instance, e.g. a shared MemoryBackend."""
+    global _backend
+    with _backend_lock:
+        _reset_backend()
+        _backend = backend
+
+
+def disconnect():
+    """
+    Close every pooled connection; a new backend is built on next use.
+
+    Note this drops all data when running in memory.
+
+    """
+
+    with _backend_lock:
+        _reset_backend()
+
+
+def after_fork(settings=None):
+    """
+    In a child process, forget (without closing, the parent still uses them)
+    the backend and background services inherited from the parent, and take
+    the parent's `settings` if given.
+
+    """
+
+    global _backend, _backend_lock, _cache, _hub, _generation
+    # The child has just the one thread, but the lock may have been held by
+    # another of the parent's when forking.
+    _backend_lock = threading.Lock()
+    if settings is not None:
+        _settings.update(settings)
+    _backend = None
+    _cache = None
+    _hub = None
+    _generation += 1
+
+
+def current_settings():
+    """A copy of the current storage settings."""
+    return dict(_settings)
+
+
+def _reset_backend():
+    global _backend, _generation
+    _reset_cache()
+    _reset_hub()
+    if _backend is not None:
+        _backend.close()
+    _backend = None
+    _generation += 1
+
+
+@atexit.register
+def _stop_threads():
+    # Background threads (cache listener, event hub) stop before the
+    # interpreter tears down the modules they use.
+    with _backend_lock:
+        _reset_cache()
+        _reset_hub()
+
+
+def _reset_hub():
+    global _hub
+    if _hub is not None:
+        _hub.close()
+    _hub = None
+
+
+def _reset_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+def _make_backend():
+    if _settings["shards"]:
+        return _make_sharded_backend()
+    return _make_node_backend(_settings)
+
+
+def _make_node_backend(settings):
+    if settings["backend"] == "memory":
+        return backends.MemoryBackend()
+    elif settings["backend"] != "redis":
+        raise Exception("Unknown backend: {}".format(settings["backend"]))
+
+    kwargs = pool_kwargs(redis, settings)
+    if settings["connection_class"]:
+        kwargs["connection_class"] = settings["connection_class"]
+
+    pool = redis.BlockingConnectionPool(**kwargs)
+    return backends.RedisBackend(connection_pool=pool)
+
+
+def _make_sharded_backend():
+    shards = []
+    for i, node in enumerate(_settings["shards"]):
+        unknown = set(node) - set(SHARD_SETTINGS) - set(["name", "weight"])
+        if unknown:
+            raise Exception(
+                "Unknown shard setting(s): {}".format(", ".join(sorted(unknown))))
+
+        settings = dict(_settings)
+        settings.update(node)
+        shards.append(sharding.Shard(
+            node.get("name") or _node_name(settings, i),
+            _make_node_backend(settings),
+            weight=node.get("weight", 1),
+            db=settings["db"]))
+
+    return sharding.ShardedBackend(shards, replicas=_settings["shard_replicas"])
+
+
+def _node_name(settings, index):
+    if settings["backend"] == "memory":
+        return "memory-{}".format(index)
+    if settings["unix_socket_path"]:
+        return "{}/{}".format(settings["unix_socket_path"], settings["db"])
+    return "{}:{}/{}".format(settings["host"], settings["port"], settings["db"])
+
+
+def pool_kwargs(redis_module, settings=None):
+    """
+    Connection pool arguments for the current settings (or the given ones),
+    for the given redis-py flavour (`redis`, or `redis.asyncio`).
+
+    """
+
+    if settings is None:
+        settings = _settings
+
+    kwargs = {
+        "max_connections": settings["max_connections"],
+        "timeout": settings["pool_timeout"],
+        "db": settings["db"],
+        "password": settings["password"],
+        "socket_timeout": settings["socket_timeout"],
+        "health_check_interval": settings["health_check_interval"],
+    }
+
+    if settings["unix_socket_path"]:
+        kwargs["connection_class"] = redis_module.UnixDomainSocketConnection
+        kwargs["path"] = settings["unix_socket_path"]
+    else:
+        kwargs["host"] = settings["host"]
+        kwargs["port"] = settings["port"]
+        kwargs["socket_connect_timeout"] = settings["socket_connect_timeout"]
+
+    return kwargs
+
+
+def get_backend():
+    """Return the shared backend, building it on first use."""
+    global _backend
+    backend = _backend
+    if backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _make_backend()
+            backend = _backend
+
+    return backend
+
+
+def reader():
+    """
+    Backend to read from. Inside a unit of work holding WATCHes, that's over
+    the connection(s) holding them (see `UnitOfWork.reader`), not one more
+    from the pool.
+
+    """
+
+    unit = current_unit_of_work()
+    if unit is not None and unit._pipe is not None:
+        return unit.reader()
+    return get_backend()
+
+
+def get_cache():
+    """Return the shared record cache, or None if caching is off."""
+    global _cache, _cache_pid
+    if not _settings["cache"]:
+        return None
+
+    record_cache = _cache
+    # A forked child doesn't inherit the listener thread, so it starts over.
+    if record_cache is None or _cache_pid != os.getpid():
+        backend = get_backend()
+        with _backend_lock:
+            if _cache is None or _cache_pid != os.getpid():
+                _cache = _make_cache(backend)
+                _cache_pid = os.getpid()
+            record_cache = _cache
+
+    return record_cache
+
+
+def _make_cache(backend):
+    record_cache = cache.RecordCache(
+        max_records=_settings["cache_max_records"],
+        max_bytes=_settings["cache_max_bytes"],
+        ttl=_settings["cache_ttl"])
+
+    if not _settings["cache_notifications"]:
+        return record_cache
+
+    # In memory, every write goes through this process and is seen anyway.
+    if isinstance(backend, sharding.ShardedBackend):
+        nodes = [(shard.backend, shard.db) for shard in backend.shards]
+    else:
+        nodes = [(backend, _settings["db"])]
+    for client, db in nodes:
+        if isinstance(client, backends.RedisBackend):
+            record_cache.listeners.append(
+                cache.KeyspaceListener(record_cache, client, db=db))
+
+    return record_cache
+
+
+def get_hub():
+    """Return the process' event subscriber (see events.py)."""
+    global _hub
+    hub = _hub
+    if hub is None:
+        backend = get_backend()
+        with _backend_lock:
+            if _hub is None:
+                _hub = events.Hub(backend)
+            hub = _hub
+
+    return hub
+
+
+def subscribe(channels):
+    """
+    Subscription to the given event channels, e.g.
+    `rmanager.subscribe([events.auction_channel(auction_id)])`.
+
+    """
+
+    return events.Subscription(get_hub(), channels)
+
+
+def ping():
+    """Health check for the configured backend; raises if unreachable."""
+    return get_backend().ping()
+
+
+def get_codec():
+    """Codec new records (and records being rewritten) are written with."""
+    return serializers.get_codec(_settings["codec"])
 
 
 """
@@ -11,51 +418,941 @@ A few getter/setter api for interacting with redis.
 "second_key": unique string value for second level key-value data, to store
               information of each record.
 
+Each record is its own redis hash, "<first_key>:rec:<second_key>", with one
+hash field per attribute, so a record can be read and written field by field.
+"<first_key>:ids" is the set of all second keys in the category.
+
 NOTE:
-For second level, we will store as json string because it seems you can't
-really create nested structures with redis. :\
+Each field value is encoded on its own with the configured codec (json by
+default), so that numbers and None come back as they went in. The record's
+HEADER_FIELD says which codec that was; loaded records keep it under the same
+name so that partial updates encode new values to match.
 
 """
 
 
-def get_one_record(first_key, second_key):
-    r = redis.StrictRedis()
-    maybe_record = r.hgetall(str(first_key)).get(str(second_key), None)
-    if maybe_record:
-        maybe_record = json.loads(maybe_record)
+def record_key(first_key, second_key):
+    return "{}:rec:{}".format(first_key, second_key)
+
+
+def ids_key(first_key):
+    return "{}:ids".format(first_key)
+
+
+def encode_record(data, header=None):
+    """
+    Encode the given fields with the codec named by `header` (the current
+    codec by default), plus the header itself, ready for HSET.
+
+    """
+
+    if header is None:
+        codec = get_codec()
+    else:
+        codec = serializers.codec_for_header(header)
+
+    mapping = dict((f, codec.encode(v)) for f, v in data.items())
+    mapping[HEADER_FIELD] = codec.header
+    return mapping
+
+
+def _text(value):
+    # Keys, set members and script replies come back as bytes on python 3.
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+
+def _decode_record(raw_record):
+    raw_record = dict((_text(k), v) for k, v in raw_record.items())
+    codec = serializers.codec_for_header(raw_record.pop(HEADER_FIELD, None))
+    record = dict((k, codec.decode(v)) for k, v in raw_record.items())
+    record[HEADER_FIELD] = codec.header
+    return record
+
+
+def _decode_fields(fields, raw_values):
+    # HMGET gives None for missing fields, and all Nones for a missing record.
+    # The header was asked for last.
+    if all(v is None for v in raw_values):
+        return None
+
+    codec = serializers.codec_for_header(raw_values[-1])
+    return dict(
+        (f, codec.decode(v) if v is not None else None)
+        for f, v in zip(fields, raw_values[:-1])
+    )
+
+
+def get_one_record(first_key, second_key, fields=None):
+    """
+    Return the record as a dict, or None if it doesn't exist. With `fields`,
+    only those fields are read.
+
+    """
+
+    return get_many_records(first_key, [second_key], fields=fields)[0]
+
+
+def get_many_records(first_key, second_keys, fields=None):
+    """
+    Return records for all given second keys in one round trip, in the same
+    order, with None for each key that has no record.
+
+    """
+
+    if not second_keys:
+        return []
+
+    unit = current_unit_of_work()
+    if unit is not None:
+        unit.watch(first_key, [record_key(first_key, k) for k in second_keys])
+
+    r = reader()
+    pipe = r.pipeline(transaction=False)
+    queue_reads(pipe, first_key, second_keys, fields)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    results = pipe.execute()
+    records = decode_reads(results, fields)
+    stats.record(first_key, "read", started, sent, results, count_records(records))
+    return records
+
+
+"""
+The queue_*/decode_* helpers split each pipelined call above and below into
+the commands it sends and what it makes of the replies, so that clients other
+than the blocking one (see aio.py) send and decode exactly the same.
+"""
 
-    return maybe_record
+
+def queue_reads(pipe, first_key, second_keys, fields=None):
+    for second_key in second_keys:
+        if fields:
+            pipe.hmget(record_key(first_key, second_key), fields + [HEADER_FIELD])
+        else:
+            pipe.hgetall(record_key(first_key, second_key))
+
+
+def decode_reads(results, fields=None):
+    if fields:
+        return [_decode_fields(fields, raw) for raw in results]
+
+    return [_decode_record(raw) if raw else None for raw in results]
+
+
+def count_records(records):
+    return sum(1 for record in records if record is not None)
+
+
+def categories(entries):
+    # Stats category for writes that may span several categories.
+    return "+".join(sorted(set(entry[0] for entry in entries)))
+
+
+def get_cached_records(first_key, second_keys, fields=None):
+    """
+    Same as `get_many_records`, through the record cache when it's on: only
+    records missing from it are read, in one round trip, and cached.
+
+    """
+
+    record_cache = get_cache()
+    if record_cache is None:
+        return get_many_records(first_key, second_keys, fields=fields)
+
+    records, missing = cache_lookup(record_cache, first_key, second_keys)
+    if missing:
+        fetched = get_many_records(first_key, [second_keys[i] for i, _, _ in missing])
+        cache_fill(record_cache, records, missing, fetched)
+
+    return project_records(records, fields)
+
+
+def cache_lookup(record_cache, first_key, second_keys):
+    # Cached records (None where missing), and (index, key, token) for each
+    # missing one, reserved before it's read.
+    records = []
+    missing = []
+    for i, second_key in enumerate(second_keys):
+        key = record_key(first_key, second_key)
+        record = record_cache.get(key)
+        if record is None:
+            missing.append((i, key, record_cache.reserve(key)))
+        records.append(record)
+
+    return records, missing
+
+
+def cache_fill(record_cache, records, missing, fetched):
+    for (i, key, token), record in zip(missing, fetched):
+        record_cache.put(key, token, record)
+        records[i] = record
+
+
+def project_records(records, fields=None):
+    # What a read of only `fields` would have returned.
+    if not fields:
+        return records
+
+    return [
+        dict((f, record.get(f)) for f in fields) if record is not None else None
+        for record in records
+    ]
+
+
+def invalidate_cached(keys):
+    """Drop the given storage keys (e.g. just written) from the record cache."""
+    if _cache is not None:
+        _cache.invalidate(keys)
+
+
+def written_keys(entries):
+    # Record keys touched by set_many_records/delete_many_records entries.
+    return [record_key(entry[0], entry[1]) for entry in entries]
 
 
 def get_all_records(first_key, filter_func=None):
-    r = redis.StrictRedis()
-    records = r.hgetall(first_key).values()
-    records = [json.loads(record) for record in records]
-    # I'm sure you can do this with redis more efficiently.
-    if filter_func:
-        records = filter(filter_func, records)
+    return list(iter_records(first_key, filter_func=filter_func))
+
+
+def scan_records(first_key, cursor=0, count=100, set_key=None, filter_func=None):
+    """
+    One step of an incremental scan over the category (or over `set_key`,
+    e.g. an index set), reading about `count` records.
+
+    Returns (next_cursor, records); the scan is done once next_cursor is 0.
+    Like SSCAN, a record may show up twice if the set is resized mid-scan.
+
+    """
+
+    r = reader()
+    started = stats.clock()
+    cursor, second_keys = r.sscan(
+        set_key or ids_key(first_key), cursor=cursor, count=count)
+    cursor = scan_cursor(cursor)
+    stats.record(first_key, "scan", started, received=second_keys)
 
+    records = get_many_records(first_key, [_text(k) for k in second_keys])
+    return cursor, filter_records(records, filter_func)
+
+
+def filter_records(records, filter_func=None):
+    # Skip dangling set members, e.g. a record deleted outside of the api.
+    records = [record for record in records if record is not None]
+    if filter_func:
+        records = [record for record in records if filter_func(record)]
     return records
 
 
-def set_one_record(first_key, second_key, data):
-    r = redis.StrictRedis()
-    return r.hmset(first_key, {second_key: json.dumps(data)})
+def iter_records(first_key, batch_size=100, set_key=None, filter_func=None):
+    """
+    Generator over all records of the category (or of `set_key`), holding
+    only one batch in memory at a time.
+
+    """
+
+    cursor = 0
+    while True:
+        cursor, records = scan_records(
+            first_key, cursor=cursor, count=batch_size, set_key=set_key,
+            filter_func=filter_func)
+        for record in records:
+            yield record
+        if cursor == 0:
+            break
+
+
+def set_one_record(first_key, second_key, data, add_to=(), remove_from=()):
+    """
+    Save the given fields of the record, and move its key between index sets
+    in the same transaction so that lookups by index never see a
+    half-applied update.
+
+    """
+
+    return set_many_records(
+        [(first_key, second_key, data, add_to, remove_from, None)])
+
+
+def set_many_records(entries, messages=(), increments=()):
+    """
+    Save many records, possibly across categories, in one MULTI/EXEC round
+    trip. Each entry is (first_key, second_key, data, add_to, remove_from,
+    header), where data holds only the fields to write (other fields are left
+    as is) and header names the codec to write them with, None for current.
+    add_to and remove_from list index sets, or (sorted index, score) pairs.
+
+    `messages` are (channel, message) pairs to publish in the same
+    transaction, i.e. if and once the records are written, and `increments`
+    (key, field, amount) counters to add to (see `queue_increments`).
+
+    Inside a unit of work, the records are only written when it ends.
+
+    """
+
+    unit = current_unit_of_work()
+    if unit is not None:
+        unit.queue(queue_writes, entries)
+        unit.publish(messages)
+        unit.increment(increments)
+        return True
+
+    r = get_backend()
+    pipe = r.pipeline()
+    queue_writes(pipe, entries)
+    queue_increments(pipe, increments)
+    queue_publishes(pipe, messages)
+    if len(pipe):
+        started = stats.clock()
+        sent = pipe.command_stack
+        pipe.execute()
+        stats.record(categories(entries), "write", started, sent)
+        invalidate_cached(written_keys(entries))
+
+    return True
+
+
+def queue_writes(pipe, entries):
+    for first_key, second_key, data, add_to, remove_from, header in entries:
+        if data:
+            mapping = encode_record(data, header)
+            pipe.hset(record_key(first_key, second_key), mapping=mapping)
+            pipe.sadd(ids_key(first_key), second_key)
+        queue_index_removals(pipe, second_key, remove_from)
+        for index_key in add_to:
+            if isinstance(index_key, tuple):
+                index_key, score = index_key
+                pipe.zadd(index_key, {second_key: score})
+            else:
+                pipe.sadd(index_key, second_key)
+
+
+def queue_index_removals(pipe, second_key, remove_from):
+    for index_key in remove_from:
+        if isinstance(index_key, tuple):
+            pipe.zrem(index_key[0], second_key)
+        else:
+            pipe.srem(index_key, second_key)
+
+
+def queue_increments(pipe, increments):
+    # Counters are hash fields, integer or float by the amount's type.
+    for key, field, amount in increments:
+        if isinstance(amount, float):
+            pipe.hincrbyfloat(key, field, amount)
+        else:
+            pipe.hincrby(key, field, amount)
+
+
+def queue_publishes(pipe, messages):
+    for channel, message in messages:
+        pipe.publish(channel, message)
+
+
+def delete_one_record(first_key, second_key, remove_from=()):
+    return delete_many_records([(first_key, second_key, remove_from)])
+
+
+def delete_many_records(entries):
+    """
+    Delete many records in one MULTI/EXEC round trip, returning how many
+    existed. Each entry is (first_key, second_key, remove_from).
+
+    Inside a unit of work, the records are only deleted when it ends, and
+    all of them are counted.
+
+    """
+
+    if not entries:
+        return 0
+
+    unit = current_unit_of_work()
+    if unit is not None:
+        unit.queue(queue_deletes, entries)
+        return len(entries)
+
+    r = get_backend()
+    pipe = r.pipeline()
+    queue_deletes(pipe, entries)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    deleted = pipe.execute()[0]
+    stats.record(categories(entries), "delete", started, sent)
+    invalidate_cached(written_keys(entries))
+    return deleted
+
+
+def queue_deletes(pipe, entries):
+    # The DEL goes first, its reply is the number of records deleted.
+    pipe.delete(*[record_key(f, s) for f, s, _ in entries])
+
+    for first_key, second_key, remove_from in entries:
+        pipe.srem(ids_key(first_key), second_key)
+        queue_index_removals(pipe, second_key, remove_from)
+
+
+def get_legacy_records(first_key):
+    """
+    Records saved before the per-field layout, as json blobs in one hash per
+    category. Only used to migrate them.
+
+    """
+
+    r = get_backend()
+    started = stats.clock()
+    raw_records = r.hgetall(first_key)
+    stats.record(first_key, "legacy", started, received=raw_records,
+                 records=len(raw_records))
+    return [json.loads(record) for record in raw_records.values()]
+
+
+def delete_legacy_records(first_key):
+    r = get_backend()
+    return r.delete(first_key)
+
+
+"""
+Secondary indexes.
+
+For each indexed field we keep one redis set per distinct value, holding the
+second keys of every record with that value, e.g. "auction:idx:status:1".
+Values are json encoded in the key so that 1 and "1" don't collide.
+"""
+
+
+def index_key(first_key, field, value):
+    return "{}:idx:{}:{}".format(first_key, field, json.dumps(value))
+
+
+def get_indexed_records(first_key, index_keys):
+    """
+    Return records whose second keys are members of all given index sets,
+    without touching any other record in the category.
+
+    """
+
+    r = reader()
+    started = stats.clock()
+    second_keys = [_text(k) for k in r.sinter(index_keys)]
+    stats.record(first_key, "index", started, index_keys, second_keys)
+    return filter_records(get_many_records(first_key, second_keys))
+
+
+def count_indexed(first_key, index_keys):
+    """
+    How many second keys are members of all given index sets (or of the ids
+    set), without reading any record.
+
+    """
+
+    r = reader()
+    started = stats.clock()
+    if len(index_keys) == 1:
+        count = r.scard(index_keys[0])
+    else:
+        count = len(r.sinter(index_keys))
+    stats.record(first_key, "count", started, index_keys)
+    return count
+
+
+"""
+Sorted indexes.
+
+Numeric fields (e.g. timestamps, as epoch seconds) can be kept in a redis
+sorted set per field, scored by the field's value, e.g.
+"auction:zidx:closed_at", so that records within a range come back in order
+without a scan. A sorted index can also be kept per value of another field,
+e.g. "auction:zidx:created_at:status:0" for unstarted auctions by age.
+Records whose field is None are left out.
+"""
+
+
+def sorted_index_key(first_key, field, by=None, value=None):
+    if by is None:
+        return "{}:zidx:{}".format(first_key, field)
+    return "{}:zidx:{}:{}:{}".format(first_key, field, by, json.dumps(value))
+
+
+def range_records(first_key, set_key, start=None, end=None, cursor=0, count=100,
+                  reverse=False, filter_func=None):
+    """
+    One page of about `count` records from a sorted index, with scores from
+    `start` to `end` (None for no bound), lowest first or, with `reverse`,
+    highest first.
+
+    Returns (next_cursor, records); the range is done once next_cursor is 0.
+    Cursors are the last score read and how many members with that score
+    were, so pages hold up even as records are added.
+
+    """
+
+    low, high, offset = range_bounds(start, end, cursor, reverse)
+
+    r = reader()
+    started = stats.clock()
+    if reverse:
+        members = r.zrevrangebyscore(
+            set_key, high, low, start=offset, num=count, withscores=True)
+    else:
+        members = r.zrangebyscore(
+            set_key, low, high, start=offset, num=count, withscores=True)
+    stats.record(first_key, "range", started, received=members)
+
+    records = get_many_records(first_key, [_text(m) for m, _ in members])
+    return range_cursor(members, count, cursor), filter_records(records, filter_func)
+
+
+def scan_cursor(cursor):
+    """
+    SSCAN cursor as handed out, the same whatever the backend: 0 once the
+    scan is done, text otherwise (like range cursors), e.g. to go in JSON.
+
+    """
+
+    if not cursor or cursor in (b"0", "0"):
+        return 0
+    if isinstance(cursor, bytes):
+        return cursor.decode("utf-8")
+    return backends.text_type(cursor)
+
+
+def range_bounds(start, end, cursor, reverse):
+    # ZRANGEBYSCORE bounds, and offset, of the page at the cursor.
+    low = "-inf" if start is None else start
+    high = "+inf" if end is None else end
+    score, offset = _split_range_cursor(cursor)
+    if score is not None:
+        if reverse:
+            high = score
+        else:
+            low = score
+    return low, high, offset
+
+
+def range_cursor(members, count, cursor):
+    # Cursor of the page after the (member, score) pairs just read.
+    if len(members) < count:
+        return 0
+
+    last = members[-1][1]
+    ties = sum(1 for _, score in members if score == last)
+    score, offset = _split_range_cursor(cursor)
+    if last == score:
+        ties += offset
+    return "{!r}:{}".format(last, ties)
+
+
+def _split_range_cursor(cursor):
+    if not cursor:
+        return None, 0
+    score, offset = cursor.rsplit(":", 1)
+    return float(score), int(offset)
+
+
+def get_rank(first_key, set_key, member):
+    """
+    (rank, score, size) of a member of a sorted set in one round trip, ranked
+    from the highest score (1 for it), with rank and score None if it isn't
+    a member.
+
+    """
+
+    r = reader()
+    pipe = r.pipeline(transaction=False)
+    queue_rank(pipe, set_key, member)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    results = pipe.execute()
+    stats.record(first_key, "rank", started, sent, results)
+    return decode_rank(results)
+
+
+def queue_rank(pipe, set_key, member):
+    pipe.zrevrank(set_key, member)
+    pipe.zscore(set_key, member)
+    pipe.zcard(set_key)
+
+
+def decode_rank(results):
+    rank, score, size = results
+    return (None if rank is None else rank + 1), score, size
+
+
+def sorted_members(first_key, set_key, reverse=False):
+    """Every member of a sorted set, lowest score first (highest with `reverse`)."""
 
+    r = reader()
+    started = stats.clock()
+    if reverse:
+        members = r.zrevrangebyscore(set_key, "+inf", "-inf")
+    else:
+        members = r.zrangebyscore(set_key, "-inf", "+inf")
+    stats.record(first_key, "range", started, received=members)
+    return [_text(m) for m in members]
 
-def delete_one_record(first_key, second_key):
-    r = redis.StrictRedis()
-    return r.hdel(first_key, second_key)
+
+def scored_members(first_key, set_key, start=None, end=None, limit=None):
+    """
+    (member, score) pairs of a sorted set with scores from `start` to `end`
+    (None for no bound), lowest first, at most `limit` of them.
+
+    """
+
+    r = reader()
+    low = "-inf" if start is None else start
+    high = "+inf" if end is None else end
+    page = {"start": 0, "num": limit} if limit else {}
+
+    started = stats.clock()
+    members = r.zrangebyscore(set_key, low, high, withscores=True, **page)
+    stats.record(first_key, "range", started, received=members)
+    return [(_text(m), score) for m, score in members]
+
+
+def set_sorted(first_key, set_key, mapping):
+    """Replace a sorted set with the given {member: score} mapping."""
+
+    r = get_backend()
+    pipe = r.pipeline()
+    pipe.delete(set_key)
+    if mapping:
+        pipe.zadd(set_key, mapping)
+
+    started = stats.clock()
+    sent = pipe.command_stack
+    pipe.execute()
+    stats.record(first_key, "write", started, sent)
+
+
+def epoch(value):
+    """
+    Seconds since the epoch for a timestamp field, including the
+    `str(datetime.now())` strings records were saved with before.
+
+    """
+
+    if value is None or isinstance(value, (int, float)):
+        return value
+
+    for layout in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            parsed = datetime.strptime(value, layout)
+        except ValueError:
+            continue
+        return time.mktime(parsed.timetuple()) + parsed.microsecond / 1e6
+
+    raise Exception("Not a timestamp: {!r}".format(value))
 
 
 def flushall():
-    r = redis.StrictRedis()
-    return r.flushall()
+    r = get_backend()
+    ret = r.flushall()
+    if _cache is not None:
+        _cache.clear()
+    return ret
+
+
+class Script(object):
+    """
+    Script that runs atomically in one round trip.
+
+    On redis the lua source is loaded lazily and invoked by sha afterwards
+    (falling back to a plain EVAL if the server lost its script cache, e.g.
+    after a restart). The memory backend runs the python twin instead, which
+    gets a client-like object standing in for `redis.call` and must implement
+    the exact same logic.
+
+    """
+
+    def __init__(self, lua, python, name="script"):
+        self.lua = lua
+        self.python = python
+        # Category the script's round trips are counted under in stats.
+        self.name = name
+
+    def __call__(self, keys=(), args=()):
+        started = stats.clock()
+        ret = _text(get_backend().run_script(self, list(keys), list(args)))
+        stats.record(self.name, "script", started, [keys, args], ret)
+        # Any cached record a script writes is among its KEYS.
+        invalidate_cached(keys)
+        return ret
+
+    def run_many(self, calls, raise_on_error=True):
+        """
+        Run the script once per (keys, args) in `calls`, in that order, in
+        one round trip (per shard). Each run is atomic on its own, not the
+        lot; returns their replies in order, with the exception a run raised
+        in place of its reply unless `raise_on_error`.
+
+        """
+
+        calls = [(list(keys), list(args)) for keys, args in calls]
+        if not calls:
+            return []
+
+        started = stats.clock()
+        ret = [_text(r) for r in get_backend().run_scripts(self, calls, raise_on_error)]
+        stats.record(self.name, "script", started, calls, ret)
+        invalidate_cached([k for keys, _ in calls for k in keys])
+        return ret
+
+
+"""
+Units of work.
+
+Composite operations (e.g. registering an item and starting its auction) run
+in a unit of work, so that all their writes go out together at the end, in
+one MULTI/EXEC round trip, and apply all or nothing:
+
+    with rmanager.unit_of_work():
+        item = Item.one(item_name)
+        ...
+        item.save()
+
+Within a unit, saves and deletes are queued until it ends, and `one`,
+`one_many`, `get_fields` and `find` go through an identity map: each record
+is read at most once, as the same object, and pending changes are seen.
+
+Conflicts are detected optimistically: every record the unit reads is
+WATCHed first (one more round trip per read), and if any of them changes
+before the unit ends, nothing is written and ConflictError is raised.
+`atomic` runs a function in a unit, retrying it on conflicts. Index sets are
+not watched, many are too busy (e.g. auctions by status): a record that only
+starts matching a `find` after it ran goes unnoticed, so units that must not
+miss one also read a record that every such change writes (e.g. creating an
+auction stages its item).
+
+Scans, summaries and scripts bypass the unit and see (or, for scripts,
+change) storage right away. Units nest: inner ones join the outermost.
+"""
+
+ATOMIC_RETRIES = 10
+
+
+class ConflictError(Exception):
+    """What a unit of work read changed before it could write."""
+
+
+# The unit of work in progress; follows threads and asyncio tasks alike.
+if contextvars is not None:
+    _unit = contextvars.ContextVar("auctionto_unit_of_work", default=None)
+else:
+    class _ThreadUnit(threading.local):
+        value = None
+
+        def get(self):
+            return self.value
+
+        def set(self, value):
+            previous, self.value = self.value, value
+            return previous
+
+        def reset(self, previous):
+            self.value = previous
+
+    _unit = _ThreadUnit()
+
+
+def current_unit_of_work():
+    return _unit.get()
+
+
+def unit_of_work():
+    """Context manager running its block in a unit of work (see above)."""
+    return UnitOfWork()
+
+
+def atomic(func):
+    """
+    Decorator running the function in a unit of work, from scratch again
+    (up to ATOMIC_RETRIES times in all) whenever it conflicts.
+
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current_unit_of_work() is not None:
+            return func(*args, **kwargs)
+
+        for attempt in range(ATOMIC_RETRIES):
+            try:
+                with UnitOfWork():
+                    return func(*args, **kwargs)
+            except ConflictError:
+                if attempt == ATOMIC_RETRIES - 1:
+                    raise
+
+    return wrapper
+
+
+class UnitOfWork(object):
+
+    def __init__(self):
+        # (category, unique key) -> object, None for records known missing.
+        self._objects = {}
+        self._watched = set()
+        # Pipeline holding the WATCHes, on its own connection until the end.
+        self._pipe = None
+        # (queue_writes or queue_deletes, entries), in order.
+        self._writes = []
+        # Events to publish along with them, and counters to add to.
+        self._messages = []
+        self._increments = []
+        self._token = None
+        self._outer = None
+
+    def __enter__(self):
+        self._outer = _unit.get()
+        if self._outer is not None:
+            return self._outer
+        self._token = _unit.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._outer is not None:
+            return False
+
+        _unit.reset(self._token)
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    def _to_watch(self, keys):
+        keys = [k for k in keys if k not in self._watched]
+        self._watched.update(keys)
+        return keys
+
+    def watch(self, first_key, keys):
+        keys = self._to_watch(keys)
+        if not keys:
+            return
+
+        if self._pipe is None:
+            self._pipe = get_backend().pipeline()
+        started = stats.clock()
+        self._pipe.watch(*keys)
+        stats.record(first_key, "watch", started, keys)
+
+    def reader(self):
+        # Until MULTI, a watching pipeline runs commands right away on its
+        # connection, which reads in the unit then go over.
+        if isinstance(self._pipe, sharding.ShardedPipeline):
+            return self._pipe.reader()
+        return backends.watched_reader(self._pipe, get_backend())
+
+    def queue(self, queue_func, entries):
+        self._writes.append((queue_func, entries))
+
+    def publish(self, messages):
+        self._messages += messages
+
+    def increment(self, increments):
+        self._increments += increments
+
+    def _pending(self):
+        return self._writes or self._messages or self._increments
+
+    def _queue_writes(self, pipe):
+        # Every pending write, after MULTI; returns their entries.
+        pipe.multi()
+        entries = []
+        for queue_func, batch in self._writes:
+            queue_func(pipe, batch)
+            entries += batch
+        queue_increments(pipe, self._increments)
+        queue_publishes(pipe, self._messages)
+        return entries
+
+    def flush(self):
+        """Write everything queued, or raise ConflictError."""
+
+        pipe, self._pipe = self._pipe, None
+        try:
+            if not self._pending():
+                return
+            if pipe is None:
+                pipe = get_backend().pipeline()
+
+            entries = self._queue_writes(pipe)
+            started = stats.clock()
+            sent = pipe.command_stack
+            try:
+                pipe.execute()
+            except redis.WatchError:
+                raise ConflictError("Records read in this unit of work changed.")
+            stats.record(categories(entries), "write", started, sent)
+            invalidate_cached(written_keys(entries))
+        finally:
+            self._writes = []
+            self._messages = []
+            self._increments = []
+            if pipe is not None:
+                pipe.reset()
+
+    def discard(self):
+        self._writes = []
+        self._messages = []
+        self._increments = []
+        if self._pipe is not None:
+            self._pipe.reset()
+            self._pipe = None
+
+    # Identity map.
+
+    def lookup(self, cls, unique_keys):
+        """
+        Objects already known for the given keys (None if known missing), as
+        a dict, and the keys still to be read.
+
+        """
+
+        found = {}
+        missing = []
+        for unique_key in unique_keys:
+            ident = (cls.category, unique_key)
+            if ident in self._objects:
+                found[unique_key] = self._objects[ident]
+            else:
+                missing.append(unique_key)
+        return found, missing
+
+    def adopt(self, cls, unique_key, record):
+        # Object for a record just read, unless one is known already.
+        ident = (cls.category, unique_key)
+        if ident not in self._objects:
+            self._objects[ident] = (
+                cls._make_object_from_record(record) if record is not None else None)
+        return self._objects[ident]
+
+    def add(self, obj):
+        self._objects[(obj.category, getattr(obj, obj.identifier))] = obj
+
+    def remove(self, obj):
+        self._objects[(obj.category, getattr(obj, obj.identifier))] = None
+
+    def matching(self, cls, criteria):
+        """Known objects of the class' category with the given field values."""
+
+        return [
+            o for (category, _), o in self._objects.items()
+            if category == cls.category and o is not None
+            and all(getattr(o, f, None) == v for f, v in criteria.items())
+        ]
 
 
 """
 Base managed object class for our library that uses the above functions to help
 manage our objects easier.
+
+Objects remember the state they were last loaded or saved with, so `save` only
+writes the fields that changed since (see `dirty_fields`).
 """
 
 
@@ -64,46 +1361,537 @@ class ManagedObject(object):
     category = "placeholder"
     identifier = "placeholder"
 
+    # Persisted attributes. Loaded objects get exactly these (plus anything
+    # else found in the record), without running __init__.
+    fields = ()
+
+    # Attributes to keep secondary indexes on, so that records can be looked
+    # up by value with `find` instead of scanning the whole category.
+    indexes = ()
+
+    # Numeric attributes (e.g. timestamps) to keep sorted indexes on, for
+    # range queries with `between`; a (field, other_field) pair keeps one per
+    # value of the other field instead (see sorted_index_key).
+    sorted_indexes = ()
+
     def __init__(self, *args, **kwargs):
         pass
 
+    @classmethod
+    def _load_plan(cls):
+        """
+        Work out once per class what a freshly loaded instance starts from: a
+        blank state with every field, None unless found in the record.
+
+        """
+
+        plan = cls.__dict__.get("_plan")
+        if plan is None:
+            plan = cls._plan = dict.fromkeys(cls.fields)
+
+        return plan
+
     @classmethod
     def _make_object_from_record(cls, record):
         """
         Construct and return an instance of class based on the existing data
         saved in redis.
 
-        """
+        __init__ is for creating new objects and may have side effects (e.g.
+        Auction staging its item), so it is skipped entirely: the instance is
+        allocated and its state set directly from the record.
 
-        # First create an instance of this class by figuring out what args we
-        # need for __init__ method.
-        args = inspect.getargspec(cls.__init__).args[1:]  # First arg "self"
-        args = [record.get(x) for x in args]
-        instance = cls(*args)
+        """
 
-        # Then update the instance for all attributes based on existing data.
-        for key, val in record.items():
-            setattr(instance, key, val)
+        instance = cls.__new__(cls)
+        state = instance.__dict__
+        state.update(cls._load_plan())
+        state.update(record)
+        state["_saved_state"] = instance._record()
 
         return instance
 
+    def _record(self):
+        # Private attributes are bookkeeping only, never persisted.
+        return dict(
+            (k, v) for k, v in self.__dict__.items() if not k.startswith("_")
+        )
+
+    def dirty_fields(self):
+        """
+        Names of the fields changed since the object was loaded or last saved;
+        all of them for an object that was never saved.
+
+        """
+
+        saved_state = getattr(self, "_saved_state", None)
+        record = self._record()
+        if saved_state is None:
+            return set(record)
+
+        return set(
+            f for f, v in record.items()
+            if f not in saved_state or saved_state[f] != v
+        ) | (getattr(self, "_marked_dirty", set()) & set(record))
+
+    def mark_dirty(self, field):
+        """
+        Have the field saved (and indexed) by the next save even if it is
+        unchanged since loaded, e.g. when a script already stored it.
+
+        """
+
+        self._marked_dirty = getattr(self, "_marked_dirty", set()) | set([field])
+
     @classmethod
+    @stats.tracked
     def one(cls, unique_key):
-        maybe_record = get_one_record(cls.category, unique_key)
-        if maybe_record is None:
-            return
-        return cls._make_object_from_record(maybe_record)
+        return cls._load([unique_key])[0]
+
+    @classmethod
+    @stats.tracked
+    def one_many(cls, unique_keys):
+        """
+        Bulk version of `one`, loading all given keys in one round trip.
+        Returns objects in the same order, with None for missing keys.
+
+        """
+
+        return cls._load(list(unique_keys))
+
+    @classmethod
+    def _load(cls, unique_keys):
+        unit = current_unit_of_work()
+        if unit is None:
+            records = get_cached_records(cls.category, unique_keys)
+            return [
+                cls._make_object_from_record(r) if r is not None else None
+                for r in records
+            ]
+
+        found, missing = unit.lookup(cls, unique_keys)
+        records = get_many_records(cls.category, missing)
+        for unique_key, record in zip(missing, records):
+            found[unique_key] = unit.adopt(cls, unique_key, record)
+        return [found[k] for k in unique_keys]
+
+    @classmethod
+    @stats.tracked
+    def get_fields(cls, unique_key, *fields):
+        """
+        Read only the given fields of one record, e.g.
+        `Auction.get_fields(auction_id, "status", "highest_bid_id")`.
+
+        Returns a dict of those fields, or None if the record doesn't exist.
+
+        """
+
+        if current_unit_of_work() is not None:
+            return cls._fields_of(cls._load([unique_key])[0], fields)
+
+        return get_cached_records(cls.category, [unique_key], fields=list(fields))[0]
+
+    @staticmethod
+    def _fields_of(obj, fields):
+        # `get_fields` answer from a loaded object.
+        if obj is None:
+            return None
+        return dict((f, getattr(obj, f, None)) for f in fields)
 
     @classmethod
+    @stats.tracked
     def all(cls, filter_func=None):
-        records = get_all_records(cls.category, filter_func=filter_func)
-        objects = [cls._make_object_from_record(r) for r in records]
+        # Scans may repeat a record, which is fine for a stream but not here.
+        seen = set()
+        objects = []
+        for o in cls.iter_all(filter_func=filter_func):
+            unique_key = getattr(o, cls.identifier)
+            if unique_key not in seen:
+                seen.add(unique_key)
+                objects.append(o)
+
         return objects
 
-    def save(self):
+    @classmethod
+    def _scan_plan(cls, criteria, filter_func):
+        """
+        Which set to scan for the given criteria, and how to filter what comes
+        back: the index set of one criterion (the others are checked per
+        record), or the whole category if there are none.
+
+        """
+
+        if not criteria:
+            return None, filter_func
+
+        cls._check_indexed(criteria)
+        field = sorted(criteria)[0]
+        set_key = index_key(cls.category, field, criteria[field])
+
+        def record_filter(record):
+            if any(record.get(f) != v for f, v in criteria.items()):
+                return False
+            return filter_func is None or filter_func(record)
+
+        return set_key, record_filter
+
+    @classmethod
+    def iter_all(cls, batch_size=100, filter_func=None, **criteria):
+        """
+        Stream objects of this class, reading `batch_size` records at a time,
+        optionally only those matching indexed field values (see `find`).
+
+        """
+
+        set_key, record_filter = cls._scan_plan(criteria, filter_func)
+        records = iter_records(
+            cls.category, batch_size=batch_size, set_key=set_key,
+            filter_func=record_filter)
+        for record in records:
+            yield cls._make_object_from_record(record)
+
+    @classmethod
+    @stats.tracked
+    def page(cls, cursor=0, page_size=100, filter_func=None, **criteria):
+        """
+        One page of `iter_all`, for callers that come back for the next page
+        later. Returns (objects, next_cursor), with next_cursor 0 at the end.
+
+        Pages hold at most about `page_size` objects, fewer once filtered.
+
+        """
+
+        set_key, record_filter = cls._scan_plan(criteria, filter_func)
+        cursor, records = scan_records(
+            cls.category, cursor=cursor, count=page_size, set_key=set_key,
+            filter_func=record_filter)
+
+        return [cls._make_object_from_record(r) for r in records], cursor
+
+    @classmethod
+    def _check_indexed(cls, criteria):
+        not_indexed = set(criteria) - set(cls.indexes)
+        if not_indexed:
+            raise Exception(
+                "Cannot find by non-indexed field(s): {}".format(
+                    ", ".join(sorted(not_indexed)))
+            )
+
+    @classmethod
+    @stats.tracked
+    def find(cls, **criteria):
+        """
+        Return objects matching all given field values, e.g.
+        `Auction.find(item_name="iphone", status=1)`, reading only those.
+
+        Every field must be listed in `indexes`.
+
+        """
+
+        records = get_indexed_records(cls.category, cls._find_plan(criteria))
+        return cls._found(records, criteria)
+
+    @classmethod
+    def _found(cls, records, criteria):
+        unit = current_unit_of_work()
+        if unit is None:
+            return [cls._make_object_from_record(r) for r in records]
+
+        # Pending changes win over what was read.
+        for record in records:
+            unit.adopt(cls, record[cls.identifier], record)
+        return unit.matching(cls, criteria)
+
+    @classmethod
+    @stats.tracked
+    def between(cls, field, start=None, end=None, reverse=False, limit=None,
+                **criteria):
+        """
+        Objects whose `field` is from `start` to `end` (None for no bound), in
+        order of it (highest first with `reverse`), at most `limit` of them,
+        e.g. `Auction.between("closed_at", start=time.time() - 3600)`.
+
+        `field` must have a sorted index. Criteria narrow the range to a
+        sorted index kept per value of one of them if there is one, and are
+        checked per record otherwise.
+
+        """
+
+        objects = []
+        cursor = 0
+        while limit is None or len(objects) < limit:
+            page, cursor = cls.page_between(
+                field, start, end, cursor=cursor, reverse=reverse,
+                page_size=min(100, limit - len(objects)) if limit else 100,
+                **criteria)
+            objects += page
+            if cursor == 0:
+                break
+
+        return objects[:limit] if limit else objects
+
+    @classmethod
+    @stats.tracked
+    def page_between(cls, field, start=None, end=None, cursor=0, page_size=100,
+                     reverse=False, **criteria):
+        """
+        One page of `between`, for callers that come back for the next page
+        later. Returns (objects, next_cursor), with next_cursor 0 at the end.
+
+        """
+
+        set_key, record_filter = cls._range_plan(field, criteria)
+        cursor, records = range_records(
+            cls.category, set_key, start, end, cursor=cursor, count=page_size,
+            reverse=reverse, filter_func=record_filter)
+
+        return [cls._make_object_from_record(r) for r in records], cursor
+
+    @classmethod
+    def _range_plan(cls, field, criteria):
+        # Sorted index to read for `between`, and the filter for the rest.
+        set_key = None
+        for spec in cls.sorted_indexes:
+            if spec == field and set_key is None:
+                set_key = sorted_index_key(cls.category, field)
+            elif isinstance(spec, tuple) and spec[0] == field and spec[1] in criteria:
+                set_key = sorted_index_key(cls.category, field, spec[1], criteria[spec[1]])
+                break
+        if set_key is None:
+            raise Exception("Cannot range over non-sorted-indexed field: {}".format(field))
+
+        def record_filter(record):
+            return all(record.get(f) == v for f, v in criteria.items())
+
+        return set_key, record_filter if criteria else None
+
+    @classmethod
+    @stats.tracked
+    def count(cls, **criteria):
+        """
+        How many objects there are, or with criteria, how many have the given
+        indexed field values (see `find`), without loading any of them.
+
+        """
+
+        return count_indexed(cls.category, cls._count_plan(criteria))
+
+    @classmethod
+    def _count_plan(cls, criteria):
+        # Sets to intersect for `count`.
+        if not criteria:
+            return [ids_key(cls.category)]
+        return cls._find_plan(criteria)
+
+    @classmethod
+    def _find_plan(cls, criteria):
+        # Index sets to intersect for `find`.
+        cls._check_indexed(criteria)
+        return [
+            index_key(cls.category, field, value)
+            for field, value in criteria.items()
+        ]
+
+    @classmethod
+    def rebuild_indexes(cls):
+        """
+        (Re-)index every saved record, e.g. for data saved before an index
+        was added to the class.
+
+        """
+
+        objects = cls.all()
+        for o in objects:
+            o._saved_state = {}
+            # Sorted indexes need numbers, timestamps used to be strings.
+            for field in cls._sorted_fields():
+                setattr(o, field, epoch(getattr(o, field, None)))
+        cls.save_many(objects)
+
+    @classmethod
+    def migrate_legacy_records(cls):
+        """
+        Move records saved as json blobs in the category hash, before the
+        per-field layout, over to the current layout.
+
+        """
+
+        objects = [
+            cls._make_object_from_record(r)
+            for r in get_legacy_records(cls.category)
+        ]
+        for o in objects:
+            o._saved_state = None
+        cls.save_many(objects)
+        delete_legacy_records(cls.category)
+
+    def _index_changes(self, dirty_fields):
+        saved_state = getattr(self, "_saved_state", None) or {}
+
+        add_to = []
+        remove_from = []
+        for field in self.indexes:
+            if field not in dirty_fields:
+                continue
+            if field in saved_state:
+                remove_from.append(
+                    index_key(self.category, field, saved_state[field]))
+            add_to.append(index_key(self.category, field, getattr(self, field, None)))
+
+        for spec in self.sorted_indexes:
+            field, by = spec if isinstance(spec, tuple) else (spec, None)
+            if field not in dirty_fields and by not in dirty_fields:
+                continue
+            old_key = self._sorted_index_key(field, by, saved_state)
+            new_key = self._sorted_index_key(field, by, self.__dict__)
+            value = getattr(self, field, None)
+            if saved_state.get(field) is not None and (old_key != new_key or value is None):
+                remove_from.append((old_key, None))
+            if value is not None:
+                add_to.append((new_key, value))
+
+        return add_to, remove_from
+
+    def _sorted_index_key(self, field, by, state):
+        if by is None:
+            return sorted_index_key(self.category, field)
+        return sorted_index_key(self.category, field, by, state.get(by))
+
+    @classmethod
+    def _sorted_fields(cls):
+        return set(s[0] if isinstance(s, tuple) else s for s in cls.sorted_indexes)
+
+    def _before_save(self):
+        """Hook for subclasses to update derived fields right before saving."""
+        pass
+
+    def _derived_entries(self):
+        """
+        Hook for subclasses to write derived records (see summary.py) in the
+        same transaction as themselves; set_many_records entries, called
+        right after `_save_entry`.
+
+        """
+
+        return []
+
+    def _events(self):
+        """
+        Hook for subclasses to publish events (see events.py) along with the
+        save; (channel, message) pairs, called right after `_save_entry`.
+
+        """
+
+        return []
+
+    def _increments(self):
+        """
+        Hook for subclasses to add to counters (e.g. aggregates.py) along
+        with the save; (key, field, amount) triples, called right after
+        `_save_entry`.
+
+        """
+
+        return []
+
+    def _save_entry(self):
+        self._before_save()
         unique_key = getattr(self, self.identifier)
-        return set_one_record(self.category, unique_key, self.__dict__)
+        dirty_fields = self.dirty_fields()
 
-    def delete(self):
+        header = getattr(self, HEADER_FIELD, None)
+        if header == get_codec().header:
+            data = dict((f, getattr(self, f)) for f in dirty_fields)
+        else:
+            # New, or stored with another codec: write it whole with the
+            # current one, which migrates old records as they get updated.
+            header = get_codec().header
+            data = self._record()
+
+        add_to, remove_from = self._index_changes(dirty_fields)
+        return (self.category, unique_key, data, add_to, remove_from, header)
+
+    def _delete_entry(self):
         unique_key = getattr(self, self.identifier)
-        return delete_one_record(self.category, unique_key)
+        # Remove from indexes by the values last saved, falling back to the
+        # current ones for an object that was never loaded or saved.
+        saved_state = getattr(self, "_saved_state", None) or self._record()
+        remove_from = [
+            index_key(self.category, field, saved_state.get(field))
+            for field in self.indexes
+        ]
+        for spec in self.sorted_indexes:
+            field, by = spec if isinstance(spec, tuple) else (spec, None)
+            remove_from.append((self._sorted_index_key(field, by, saved_state), None))
+        return (self.category, unique_key, remove_from)
+
+    @stats.tracked
+    def save(self):
+        return ManagedObject.save_many([self])
+
+    @stats.tracked
+    def delete(self):
+        return ManagedObject.delete_many([self])
+
+    @staticmethod
+    def save_many(objects):
+        """
+        Save any number of objects, of any managed class, together in one
+        MULTI/EXEC round trip. Only dirty fields are written.
+
+        """
+
+        with stats.operation("ManagedObject.save_many"):
+            entries, derived, messages, increments = ManagedObject._save_entries(objects)
+            ret = set_many_records(entries + derived, messages, increments)
+            for o, entry in zip(objects, entries):
+                o._mark_saved(entry)
+
+        return ret
+
+    @staticmethod
+    def _save_entries(objects):
+        # Entries of the objects themselves, of their derived records, and
+        # the events and counter increments to go with them.
+        entries = []
+        derived = []
+        messages = []
+        increments = []
+        for o in objects:
+            entries.append(o._save_entry())
+            derived += o._derived_entries()
+            messages += o._events()
+            increments += o._increments()
+        return entries, derived, messages, increments
+
+    def _mark_saved(self, entry):
+        # Once the entry from `_save_entry` is stored (or queued in the unit
+        # of work), nothing is dirty.
+        self._saved_state = self._record()
+        self._marked_dirty = set()
+        setattr(self, HEADER_FIELD, entry[-1])
+
+        unit = current_unit_of_work()
+        if unit is not None:
+            unit.add(self)
+
+    @staticmethod
+    def _mark_deleted(objects):
+        unit = current_unit_of_work()
+        if unit is not None:
+            for o in objects:
+                unit.remove(o)
+
+    @staticmethod
+    def delete_many(objects):
+        """
+        Delete any number of objects, of any managed class, together in one
+        MULTI/EXEC round trip. Returns how many of them existed.
+
+        """
+
+        with stats.operation("ManagedObject.delete_many"):
+            ret = delete_many_records([o._delete_entry() for o in objects])
+            ManagedObject._mark_deleted(objects)
+
+        return ret
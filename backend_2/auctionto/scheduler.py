@@ -0,0 +1,98 @@
+"""
+Calls timed auctions once their end time has passed.
+
+    python -m auctionto.scheduler              # until stopped
+    python -m auctionto.scheduler --once       # those due now, then exits
+
+Timed auctions in progress are kept ordered by end time (see
+auction.deadlines_key), so the ones due are read a batch at a time off the
+front of that index, however many auctions there are, and nothing is
+scanned. Each is called by `Auction.call`, which checks again that it's still
+due as it stops the auction's bids: an auction a bid extended, or an
+auctioneer called, in the meantime is left alone. Calls in a batch run on a
+few threads, as each takes several round trips; more schedulers can run
+alongside, any auction only ever being called by one of them.
+"""
+
+import argparse
+import time
+from multiprocessing.pool import ThreadPool
+
+from . import rmanager
+from .auction import Auction, deadlines_key
+
+BATCH_SIZE = 500
+THREADS = 8
+
+
+def due_auctions(now=None, limit=BATCH_SIZE):
+    """Ids of the timed auctions in progress due at `now`, earliest first."""
+    now = time.time() if now is None else now
+    due = rmanager.scored_members(Auction.category, deadlines_key(), end=now, limit=limit)
+    return [auction_id for auction_id, _ in due]
+
+
+def next_deadline():
+    """The earliest end time of a timed auction in progress, or None."""
+    first = rmanager.scored_members(Auction.category, deadlines_key(), limit=1)
+    return first[0][1] if first else None
+
+
+def call_if_due(auction_id, now=None):
+    """Call the auction if it's in progress and due at `now`; whether it was."""
+    now = time.time() if now is None else now
+    return Auction.call(auction_id, due_at=now)["status"] == "success"
+
+
+def call_due_auctions(now=None, batch_size=BATCH_SIZE, threads=THREADS):
+    """
+    Call the timed auctions due at `now` (by default, now), `batch_size` at a
+    time over `threads` threads. Returns how many were called.
+
+    """
+
+    now = time.time() if now is None else now
+    pool = ThreadPool(threads) if threads > 1 else None
+    called = 0
+    try:
+        while True:
+            auction_ids = due_auctions(now, batch_size)
+            if pool is not None:
+                done = pool.map(lambda a: call_if_due(a, now), auction_ids)
+            else:
+                done = [call_if_due(a, now) for a in auction_ids]
+            called += sum(done)
+            # Those not called were by someone else, and are gone too.
+            if len(auction_ids) < batch_size or not any(done):
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return called
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--once", action="store_true",
+                        help="call the auctions due now, then exit")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="auctions read per batch")
+    parser.add_argument("--threads", type=int, default=THREADS,
+                        help="auctions called at once")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between looks for auctions due, at most")
+    options = parser.parse_args()
+
+    while True:
+        called = call_due_auctions(batch_size=options.batch_size, threads=options.threads)
+        if called or options.once:
+            print("{} auctions called.".format(called))
+        if options.once:
+            break
+
+        deadline = next_deadline()
+        wait = options.interval
+        if deadline is not None:
+            wait = max(0, min(wait, deadline - time.time()))
+        time.sleep(wait)
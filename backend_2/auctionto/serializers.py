@@ -0,0 +1,106 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+"""
+Codecs for record field values.
+
+Every record carries a small header in its hash, HEADER_FIELD, naming the codec
+(and codec version) its fields were written with, e.g. "msgpack:1". Readers
+pick the codec per record, so records written with different codecs can be
+read side by side while data is being migrated. Records without a header
+predate it and are json.
+
+Scripts decode fields on the server too, so a codec is only usable here if
+redis lua can handle it (cjson and cmsgpack are both built in).
+"""
+
+HEADER_FIELD = "_codec"
+
+
+class JsonCodec(object):
+
+    header = "json:1"
+
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, raw_value):
+        return json.loads(raw_value)
+
+
+class MsgpackCodec(object):
+    """
+    Compact binary codec; needs the optional msgpack package.
+
+    Strings are packed as msgpack "str" (never "bin") and come back as text,
+    same as with json.
+
+    """
+
+    header = "msgpack:1"
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=False)
+
+    def decode(self, raw_value):
+        return msgpack.unpackb(raw_value, raw=False)
+
+
+LEGACY_HEADER = JsonCodec.header
+
+CODECS = {
+    "json": JsonCodec(),
+}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+_by_header = dict((c.header, c) for c in CODECS.values())
+
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if codec is None:
+        raise Exception(
+            "Unknown or unavailable codec: {} (available: {})".format(
+                name, ", ".join(sorted(CODECS)))
+        )
+    return codec
+
+
+def codec_for_header(header):
+    """Codec a record was written with, given its (maybe missing) header."""
+    if header is None:
+        return _by_header[LEGACY_HEADER]
+
+    if isinstance(header, bytes):
+        header = header.decode("ascii")
+
+    codec = _by_header.get(header)
+    if codec is None:
+        raise Exception("Cannot decode record written with codec: {}".format(header))
+    return codec
+
+
+# Lua counterparts of the codecs above, for scripts that read or write fields
+# on the server. `header` is a record's HEADER_FIELD value, or false if the
+# record has none.
+LUA_HELPERS = """
+local function decode_field(header, value)
+    if header == "msgpack:1" then
+        return cmsgpack.unpack(value)
+    end
+    return cjson.decode(value)
+end
+
+local function encode_field(header, value)
+    if header == "msgpack:1" then
+        return cmsgpack.pack(value)
+    end
+    return cjson.encode(value)
+end
+"""
@@ -0,0 +1,610 @@
+import bisect
+import copy
+import hashlib
+import time
+import uuid
+
+from . import backends
+
+
+"""
+Records spread over several backends ("shards"), e.g. several redis nodes, or
+several MemoryBackends standing in for them (see rmanager.configure,
+"shards").
+
+Each key goes to a shard picked by consistent hashing (see HashRing) of its
+routing id: the second key for a record ("<first_key>:rec:<second_key>"), the
+key itself otherwise. Only the id's hash tag counts, if it has one: the part
+between the first "{" and the next "}", like redis cluster (see `tag_of`, which
+also keeps other braces out of it). Auctions are
+tagged with their item's name and bids with their auction's tag (see
+`tagged_id`), so that an item, its summary, its auctions and their bids all
+live on one shard, and the bid script and auctioneer units of work only ever
+touch one shard.
+
+Category-wide sets (ids, index and sorted index sets, "<first_key>:ids",
+"<first_key>:idx:..." and "<first_key>:zidx:...") are spread too: each shard
+keeps the members whose records it holds, in a set of the same name, so a
+record and its set memberships are still written together. Reading such a set
+(SSCAN, SINTER, SMEMBERS, SCARD, ZRANGEBYSCORE...) gathers it from every
+shard, so `all()`, `find` and `between` work as before.
+
+Pipelines are split per shard, each still atomic on its own: a unit of work
+writing records of several shards commits on each separately (watched shards
+first), and a conflict detected on a later shard can't undo the earlier ones.
+Events published from a pipeline go out on the shard of its first write, and
+subscribers listen on every shard.
+
+After adding (or, with weight 0, draining) nodes, move what the ring now
+routes elsewhere with `python -m auctionto.rebalance` (see rebalance.py),
+while no writes are going on.
+"""
+
+# Points per node on the ring (times its weight).
+REPLICAS = 64
+
+
+def tag_of(id_):
+    """
+    Part of an id (or key) that decides its shard. Never has braces, so that
+    it can tag other ids as it is: one that would (e.g. the whole of an item
+    name like "a}b") is replaced by its digest.
+
+    """
+
+    tag = id_ = _text(id_)
+    start = id_.find("{")
+    if start != -1:
+        end = id_.find("}", start + 1)
+        if end > start + 1:
+            tag = id_[start + 1:end]
+    if "{" in tag or "}" in tag:
+        if isinstance(tag, backends.text_type):
+            tag = tag.encode("utf-8")
+        tag = hashlib.md5(tag).hexdigest()
+    return tag
+
+
+def tagged_id(tag):
+    """New unique id stored on the same shard as `tag` (an id, or its tag)."""
+    return "{{{}}}{}".format(tag_of(tag), uuid.uuid4())
+
+
+def routing_id(key):
+    key = _text(key)
+    parts = key.split(":", 2)
+    if len(parts) == 3 and parts[1] == "rec":
+        return tag_of(parts[2])
+    return tag_of(key)
+
+
+def is_spread(key):
+    """Whether the key is a category-wide set, kept in part on each shard."""
+    parts = _text(key).split(":", 2)
+    return len(parts) > 1 and parts[1] in ("ids", "idx", "zidx")
+
+
+def _text(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+
+def _hash(text):
+    if isinstance(text, backends.text_type):
+        text = text.encode("utf-8")
+    return int(hashlib.md5(text).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing over named nodes: adding a node only moves the keys
+    it takes over, about 1/n of them.
+
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        # nodes: [(name, weight)], looked up by index.
+        points = []
+        for index, (name, weight) in enumerate(nodes):
+            for i in range(int(replicas * weight)):
+                points.append((_hash("{}#{}".format(name, i)), index))
+        if not points:
+            raise Exception("No shard to store anything on.")
+
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._nodes = [index for _, index in points]
+
+    def lookup(self, routing_id):
+        i = bisect.bisect(self._hashes, _hash(routing_id)) % len(self._hashes)
+        return self._nodes[i]
+
+
+class Shard(object):
+
+    def __init__(self, name, backend, weight=1, db=0):
+        self.name = name
+        self.backend = backend
+        # 0 to drain the shard, i.e. route nothing to it.
+        self.weight = weight
+        self.db = db
+
+    def __repr__(self):
+        return "<Shard name:'{}'>".format(self.name)
+
+
+class ShardedBackend(object):
+    """Backend (see backends.py) spreading keys over shards."""
+
+    def __init__(self, shards, replicas=REPLICAS):
+        self.shards = list(shards)
+        self.ring = HashRing([(s.name, s.weight) for s in self.shards], replicas)
+
+    def shard_for(self, key):
+        return self.ring.lookup(routing_id(key))
+
+    def shard_for_member(self, member):
+        # Members of spread sets are second keys.
+        return self.ring.lookup(tag_of(member))
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return ShardedPubSub(self)
+
+    def run_script(self, script, keys, args):
+        return self._script_shard(keys).backend.run_script(script, keys, args)
+
+    def run_scripts(self, script, calls, raise_on_error=True):
+        # One round trip per shard, replies in the order of the calls.
+        positions = {}
+        for position, (keys, args) in enumerate(calls):
+            positions.setdefault(self._script_shard(keys), []).append(position)
+
+        results = [None] * len(calls)
+        for shard, group in positions.items():
+            replies = shard.backend.run_scripts(
+                script, [calls[p] for p in group], raise_on_error)
+            for position, reply in zip(group, replies):
+                results[position] = reply
+        return results
+
+    def _script_shard(self, keys):
+        # The shard of a script's first record; everything else it touches
+        # must live there too.
+        routed = [k for k in keys if not is_spread(k)] or keys
+        return self.shards[self.shard_for(routed[0])]
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        """
+        SSCAN, shard after shard for spread sets. Cursors are then
+        "<shard>:<cursor>", or "<shard>" to start on that shard.
+
+        """
+
+        if not is_spread(name):
+            backend = self.shards[self.shard_for(name)].backend
+            return backend.sscan(name, cursor=cursor, match=match, count=count)
+
+        index, cursor = _split_cursor(cursor)
+        cursor, members = self.shards[index].backend.sscan(
+            name, cursor=cursor, match=match, count=count)
+        if cursor != 0:
+            return "{}:{}".format(index, _text(cursor)), members
+        if index + 1 < len(self.shards):
+            return str(index + 1), members
+        return 0, members
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        return self._zrange(
+            "zrangebyscore", name, min, max, start, num, withscores, score_cast_func)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False, score_cast_func=float):
+        return self._zrange(
+            "zrevrangebyscore", name, max, min, start, num, withscores, score_cast_func)
+
+    def _zrange(self, command, name, first, last, start, num, withscores,
+                score_cast_func):
+        if not is_spread(name):
+            backend = self.shards[self.shard_for(name)].backend
+            return getattr(backend, command)(
+                name, first, last, start=start, num=num, withscores=withscores,
+                score_cast_func=score_cast_func)
+
+        # Enough of each shard's to cover the page, merged in order.
+        limit = start + num if start is not None and num >= 0 else None
+        merged = []
+        for shard in self.shards:
+            merged += getattr(shard.backend, command)(
+                name, first, last, start=0 if limit is not None else None,
+                num=limit, withscores=True)
+
+        reverse = command == "zrevrangebyscore"
+        merged.sort(key=lambda pair: (pair[1], pair[0]), reverse=reverse)
+        if start is not None:
+            merged = merged[start:limit]
+
+        if withscores:
+            return [(member, score_cast_func(score)) for member, score in merged]
+        return [member for member, _ in merged]
+
+    def close(self):
+        for shard in self.shards:
+            shard.backend.close()
+
+    def _execute(self, name, args, kwargs):
+        parts, combine = self._plan(name, args, kwargs)
+        return combine([
+            getattr(self.shards[index].backend, name)(*a, **kw)
+            for index, a, kw in parts
+        ])
+
+    def _plan(self, name, args, kwargs):
+        """
+        How to run a command: as [(shard index, args, kwargs)], and a
+        function combining their replies into the command's.
+
+        """
+
+        everywhere = range(len(self.shards))
+        if name in ("flushall", "ping"):
+            return [(i, args, kwargs) for i in everywhere], all
+
+        if name in ("delete", "exists"):
+            return [(i, keys, kwargs) for i, keys in self._group(args, self.shard_for)], sum
+
+        if name in ("sadd", "srem", "zrem") and is_spread(args[0]):
+            groups = self._group(args[1:], self.shard_for_member)
+            return [(i, (args[0],) + members, kwargs) for i, members in groups], sum
+
+        if name == "zadd" and is_spread(args[0]):
+            kwargs = dict(kwargs)
+            mapping = kwargs.pop("mapping") if len(args) < 2 else args[1]
+            groups = self._group(list(mapping), self.shard_for_member)
+            return [
+                (i, (args[0], dict((m, mapping[m]) for m in members)), kwargs)
+                for i, members in groups
+            ], sum
+
+        if name == "zscore" and is_spread(args[0]):
+            return [(self.shard_for_member(args[1]), args, kwargs)], _single
+
+        if name in ("smembers", "scard", "zcard", "zcount") and is_spread(args[0]):
+            combine = _union if name == "smembers" else sum
+            return [(i, args, kwargs) for i in everywhere], combine
+
+        if name in ("sscan", "zrangebyscore", "zrevrangebyscore") and is_spread(args[0]):
+            raise Exception("Cannot pipeline {} over shards.".format(name))
+
+        if name == "zrevrank" and is_spread(args[0]):
+            raise Exception("Cannot rank members of {} over shards.".format(args[0]))
+
+        if name == "sinter":
+            keys = _list_or_args(args[0], args[1:])
+            if any(is_spread(k) for k in keys):
+                return [(i, args, kwargs) for i in everywhere], _union
+            return [(self.shard_for(keys[0]), args, kwargs)], _single
+
+        return [(self.shard_for(args[0]), args, kwargs)], _single
+
+    def _group(self, values, route):
+        # [(shard index, values routed there)], in order of first appearance.
+        groups = []
+        by_index = {}
+        for value in values:
+            index = route(value)
+            if index not in by_index:
+                by_index[index] = []
+                groups.append((index, by_index[index]))
+            by_index[index].append(value)
+        return [(index, tuple(group)) for index, group in groups]
+
+
+def _split_cursor(cursor):
+    if cursor == 0:
+        return 0, 0
+    if not isinstance(cursor, (bytes, backends.text_type)):
+        cursor = str(cursor)
+    index, _, cursor = _text(cursor).partition(":")
+    return int(index), cursor or 0
+
+
+def _union(results):
+    return set().union(*results)
+
+
+def _single(results):
+    return results[0]
+
+
+def _list_or_args(keys, args):
+    if isinstance(keys, (bytes, backends.text_type)):
+        keys = [keys]
+    return list(keys) + list(args)
+
+
+class ShardedPipeline(object):
+    """
+    Pipeline split into one per shard, run one after the other; replies come
+    back in the order the commands were queued, as from a single pipeline.
+
+    """
+
+    def __init__(self, backend, transaction=True):
+        self.backend = backend
+        self.transaction = transaction
+        # The commands as queued, (name, args, kwargs).
+        self.command_stack = []
+        # shard index -> pipeline, and how many commands it has.
+        self._pipes = {}
+        self._counts = {}
+        self._watching = set()
+        # Per command: [(shard index, position in its pipeline)], combine.
+        self._replies = []
+        self._multi = False
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def _pipe(self, index):
+        pipe = self._pipes.get(index)
+        if pipe is None:
+            shard = self.backend.shards[index]
+            pipe = self._pipes[index] = shard.backend.pipeline(self.transaction)
+            self._counts[index] = 0
+            if self._multi:
+                pipe.multi()
+        return pipe
+
+    def watch(self, *names):
+        for index, group in self.backend._group(names, self.backend.shard_for):
+            self._pipe(index).watch(*group)
+            self._watching.add(index)
+        return True
+
+    def multi(self):
+        self._multi = True
+        for pipe in self._pipes.values():
+            pipe.multi()
+
+    def _queue(self, name, args, kwargs):
+        if name == "publish" and self._replies:
+            # Along with the first write, in its transaction.
+            parts, combine = [(self._replies[0][0][0][0], args, kwargs)], _single
+        else:
+            parts, combine = self.backend._plan(name, args, kwargs)
+
+        positions = []
+        for index, a, kw in parts:
+            getattr(self._pipe(index), name)(*a, **kw)
+            positions.append((index, self._counts[index]))
+            self._counts[index] += 1
+
+        self._replies.append((positions, combine))
+        self.command_stack.append((name, args, kwargs))
+        return self
+
+    def execute(self, raise_on_error=True):
+        # Watched shards first: a conflict there stops before anything is
+        # written anywhere.
+        order = sorted(self._pipes, key=lambda index: index not in self._watching)
+        replies = self._replies
+        results = {}
+        try:
+            for index in order:
+                if self._counts[index] or index in self._watching:
+                    results[index] = self._pipes[index].execute(raise_on_error)
+        finally:
+            self.reset()
+
+        return [
+            combine([results[index][position] for index, position in positions])
+            for positions, combine in replies
+        ]
+
+    def reader(self):
+        """
+        The backend as seen from within this pipeline's WATCHes: commands for
+        watched shards go over their watching connections (see
+        backends.watched_reader), the others as usual.
+
+        """
+
+        view = copy.copy(self.backend)
+        view.shards = [
+            Shard(shard.name, backends.watched_reader(self._pipes[index], shard.backend)
+                  if index in self._watching else shard.backend,
+                  weight=shard.weight, db=shard.db)
+            for index, shard in enumerate(self.backend.shards)
+        ]
+        return view
+
+    def reset(self):
+        for pipe in self._pipes.values():
+            pipe.reset()
+        self.command_stack = []
+        self._pipes = {}
+        self._counts = {}
+        self._watching = set()
+        self._replies = []
+        self._multi = False
+
+
+class ShardedPubSub(object):
+    """
+    Subscriber listening on every shard, since any of them may publish; once
+    per server, as pub/sub ignores the db (shards may be dbs of one server).
+
+    """
+
+    # Pause between rounds over the shards while nothing comes in.
+    POLL_SECONDS = 0.005
+
+    def __init__(self, backend):
+        servers = {}
+        for shard in backend.shards:
+            servers.setdefault(_server(shard.backend), shard.backend)
+        self.pubsubs = [
+            b.pubsub(ignore_subscribe_messages=True) for b in servers.values()
+        ]
+        self._next = 0
+
+    def subscribe(self, *channels):
+        for pubsub in self.pubsubs:
+            pubsub.subscribe(*channels)
+
+    def unsubscribe(self, *channels):
+        for pubsub in self.pubsubs:
+            pubsub.unsubscribe(*channels)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            # Starting from a different shard each time, so none starves.
+            for _ in range(len(self.pubsubs)):
+                pubsub = self.pubsubs[self._next]
+                self._next = (self._next + 1) % len(self.pubsubs)
+                message = pubsub.get_message(timeout=0)
+                if message is not None:
+                    return message
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.POLL_SECONDS)
+
+    def close(self):
+        for pubsub in self.pubsubs:
+            pubsub.close()
+
+
+def _server(backend):
+    kwargs = getattr(getattr(backend, "connection_pool", None), "connection_kwargs", None)
+    if kwargs is None:
+        return id(backend)
+    return (kwargs.get("host"), kwargs.get("port"), kwargs.get("path"))
+
+
+def _backend_command(name):
+    def command(self, *args, **kwargs):
+        return self._execute(name, args, kwargs)
+    command.__name__ = name
+    return command
+
+
+def _pipeline_command(name):
+    def command(self, *args, **kwargs):
+        return self._queue(name, args, kwargs)
+    command.__name__ = name
+    return command
+
+
+for _name in backends.COMMANDS:
+    if not hasattr(ShardedBackend, _name):
+        setattr(ShardedBackend, _name, _backend_command(_name))
+    setattr(ShardedPipeline, _name, _pipeline_command(_name))
+
+
+"""
+Rebalancing.
+"""
+
+
+def parse_nodes(spec):
+    """
+    Shard settings from a comma separated list of "memory" or
+    "host[:port][/db]" nodes, e.g. AUCTIONTO_SHARDS.
+
+    """
+
+    nodes = []
+    for node in spec.split(","):
+        node = node.strip()
+        if not node:
+            continue
+        if node == "memory":
+            nodes.append({"backend": "memory"})
+            continue
+
+        address, _, db = node.partition("/")
+        host, _, port = address.partition(":")
+        nodes.append({
+            "backend": "redis",
+            "host": host or "localhost",
+            "port": int(port or 6379),
+            "db": int(db or 0),
+        })
+    return nodes
+
+
+def rebalance(backend, batch_size=500):
+    """
+    Move every key (and spread set member) to the shard the ring routes it
+    to now. Keys are copied then deleted, so this must run while nothing
+    else writes. Returns how many keys and members moved.
+
+    """
+
+    moved = {"keys": 0, "members": 0}
+    for index, shard in enumerate(backend.shards):
+        for key in list(shard.backend.scan_iter(count=batch_size)):
+            key = _text(key)
+            kind = _text(shard.backend.type(key))
+            if kind in ("set", "zset") and is_spread(key):
+                moved["members"] += _move_members(backend, index, key, kind, batch_size)
+            elif backend.shard_for(key) != index:
+                target = backend.shards[backend.shard_for(key)]
+                _move_key(shard.backend, target.backend, key, kind)
+                moved["keys"] += 1
+
+    return moved
+
+
+def _move_key(source, target, key, kind):
+    if kind == "hash":
+        target.hset(key, mapping=source.hgetall(key))
+    elif kind == "set":
+        target.sadd(key, *source.smembers(key))
+    elif kind == "zset":
+        target.zadd(key, dict(source.zrangebyscore(key, "-inf", "+inf", withscores=True)))
+    else:
+        raise Exception("Cannot move {} key '{}'.".format(kind, key))
+    source.delete(key)
+
+
+def _move_members(backend, index, key, kind, batch_size):
+    source = backend.shards[index].backend
+    stray = []
+    if kind == "zset":
+        scores = dict(source.zrangebyscore(key, "-inf", "+inf", withscores=True))
+        stray = [m for m in scores if backend.shard_for_member(m) != index]
+    else:
+        cursor = 0
+        while True:
+            cursor, members = source.sscan(key, cursor=cursor, count=batch_size)
+            stray += [m for m in members if backend.shard_for_member(m) != index]
+            if cursor == 0:
+                break
+
+    for target, members in backend._group(stray, backend.shard_for_member):
+        target = backend.shards[target].backend
+        for i in range(0, len(members), batch_size):
+            batch = members[i:i + batch_size]
+            if kind == "zset":
+                target.zadd(key, dict((m, scores[m]) for m in batch))
+                source.zrem(key, *batch)
+            else:
+                target.sadd(key, *batch)
+                source.srem(key, *batch)
+
+    return len(stray)
+
+
+def shard_sizes(backend):
+    """{shard name: number of keys}."""
+    return dict(
+        (shard.name, sum(1 for _ in shard.backend.scan_iter()))
+        for shard in backend.shards
+    )
@@ -0,0 +1,313 @@
+import functools
+import threading
+import time
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+try:
+    string_types = (bytes, unicode)
+except NameError:
+    string_types = (bytes, str)
+
+
+"""
+Storage stats.
+
+Every storage round trip made through rmanager (or aio) is counted against
+the category it touched, the kind of access, and the operation that caused
+it, i.e. the outermost user or managed object method on the call stack, e.g.
+("Participant.submit_bid_for_auction", "accept_bid", "script"). For each we
+keep round trips, bytes sent and received, records decoded and a latency
+histogram; operations themselves get calls and a latency histogram.
+
+    stats.snapshot()         # everything so far, json friendly
+    stats.reset()
+    stats.add_hook(func)     # func(event) after every round trip/operation
+    stats.disable()          # back to zero overhead, e.g. for benchmarks
+
+Collection is on by default and cheap: a few dict updates under one lock per
+round trip. Sizing payloads is the expensive part, so bytes are measured on
+one in `bytes_every` round trips (per operation/category/kind) and scaled up;
+`stats.enable(bytes_every=1)` measures every one. Hooks run inline, so they
+should be just as cheap (e.g. push to a statsd client, or sample); while any
+are set, every round trip is sized for them.
+"""
+
+# Upper bounds of the latency histogram buckets, in milliseconds; the last
+# bucket takes everything slower.
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+NO_OPERATION = "-"
+
+clock = getattr(time, "perf_counter", time.time)
+
+_enabled = True
+_bytes_every = 16
+_lock = threading.Lock()
+_operations = {}
+_commands = {}
+_hooks = []
+
+# Name of the operation in progress; follows threads and asyncio tasks alike.
+if contextvars is not None:
+    _current = contextvars.ContextVar("auctionto_operation", default=None)
+else:
+    class _ThreadCurrent(threading.local):
+        value = None
+
+        def get(self):
+            return self.value
+
+        def set(self, value):
+            previous, self.value = self.value, value
+            return previous
+
+        def reset(self, previous):
+            self.value = previous
+
+    _current = _ThreadCurrent()
+
+
+def enable(bytes_every=None):
+    global _enabled, _bytes_every
+    _enabled = True
+    if bytes_every is not None:
+        _bytes_every = max(int(bytes_every), 1)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def add_hook(func):
+    """
+    Call `func(event)` after every round trip and every operation. Events
+    are dicts with "operation", "category", "kind" and "seconds", plus
+    "bytes_sent", "bytes_received" and "records" for round trips.
+
+    """
+
+    _hooks.append(func)
+
+
+def remove_hook(func):
+    _hooks.remove(func)
+
+
+def current_operation():
+    return _current.get()
+
+
+def begin(name):
+    """
+    Enter operation `name`, unless one is in progress already (the outermost
+    one gets the credit). Returns a token for `end`, None if nothing to do.
+
+    """
+
+    if not _enabled or _current.get() is not None:
+        return None
+    return (name, clock(), _current.set(name))
+
+
+def end(token):
+    if token is None:
+        return
+
+    name, started, reset_token = token
+    _current.reset(reset_token)
+    seconds = clock() - started
+
+    with _lock:
+        entry = _operations.get(name)
+        if entry is None:
+            entry = _operations[name] = {
+                "calls": 0, "seconds": 0.0, "histogram": [0] * (len(BUCKETS_MS) + 1),
+            }
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["histogram"][_bucket(seconds)] += 1
+
+    if _hooks:
+        _emit({
+            "operation": name, "category": None, "kind": "operation",
+            "seconds": seconds,
+        })
+
+
+class operation(object):
+    """Context manager version of begin/end."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.token = begin(self.name)
+
+    def __exit__(self, *exc_info):
+        end(self.token)
+
+
+def tracked(func):
+    """Decorator making a method an operation, named "<Class>.<method>"."""
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(owner, *args, **kwargs):
+        if not _enabled or _current.get() is not None:
+            return func(owner, *args, **kwargs)
+
+        cls = owner if isinstance(owner, type) else type(owner)
+        token = begin("{}.{}".format(cls.__name__, name))
+        try:
+            return func(owner, *args, **kwargs)
+        finally:
+            end(token)
+
+    return wrapper
+
+
+def record(category, kind, started, sent=None, received=None, records=0):
+    """
+    Count one round trip that started at `started` (see `clock`). `sent` and
+    `received` are the payloads (e.g. mappings written, raw replies), only
+    measured while stats are on.
+
+    """
+
+    if not _enabled:
+        return
+
+    seconds = clock() - started
+    operation_name = _current.get() or NO_OPERATION
+    key = (operation_name, category, kind)
+
+    with _lock:
+        entry = _commands.get(key)
+        if entry is None:
+            entry = _commands[key] = {
+                "round_trips": 0, "bytes_sent": 0, "bytes_received": 0,
+                "records": 0, "seconds": 0.0,
+                "histogram": [0] * (len(BUCKETS_MS) + 1),
+            }
+        sampled = entry["round_trips"] % _bytes_every == 0
+        entry["round_trips"] += 1
+        entry["records"] += records
+        entry["seconds"] += seconds
+        entry["histogram"][_bucket(seconds)] += 1
+
+    if not (sampled or _hooks):
+        return
+
+    # Sized outside the lock, it's the slow part.
+    bytes_sent = payload_size(sent)
+    bytes_received = payload_size(received)
+    if sampled:
+        with _lock:
+            entry["bytes_sent"] += bytes_sent * _bytes_every
+            entry["bytes_received"] += bytes_received * _bytes_every
+
+    if _hooks:
+        _emit({
+            "operation": operation_name, "category": category, "kind": kind,
+            "seconds": seconds, "bytes_sent": bytes_sent,
+            "bytes_received": bytes_received, "records": records,
+        })
+
+
+def payload_size(value):
+    """Rough size in bytes of keys/values going to or coming from storage."""
+
+    # Strings are by far the most common leaves, so they are sized inline
+    # rather than with a call each.
+    if isinstance(value, string_types):
+        return len(value)
+    elif isinstance(value, dict):
+        size = 0
+        for k, v in value.items():
+            size += len(k) if isinstance(k, string_types) else payload_size(k)
+            size += len(v) if isinstance(v, string_types) else payload_size(v)
+        return size
+    elif isinstance(value, (list, tuple, set)):
+        size = 0
+        for v in value:
+            size += len(v) if isinstance(v, string_types) else payload_size(v)
+        return size
+    elif value is None:
+        return 0
+    # Numbers, as sent in their decimal form.
+    return len(repr(value))
+
+
+def snapshot():
+    """
+    All stats collected since the last reset:
+
+        {
+            "operations": {name: {"calls", "seconds", "histogram"}},
+            "commands": [{"operation", "category", "kind", "round_trips",
+                          "bytes_sent", "bytes_received", "records",
+                          "seconds", "histogram"}],
+            "buckets_ms": BUCKETS_MS,
+        }
+
+    Histograms count calls per latency bucket, see BUCKETS_MS.
+
+    """
+
+    with _lock:
+        operations = dict((name, dict(entry, histogram=list(entry["histogram"])))
+                          for name, entry in _operations.items())
+        commands = []
+        for (operation_name, category, kind), entry in sorted(_commands.items()):
+            command = dict(entry, histogram=list(entry["histogram"]))
+            command.update(operation=operation_name, category=category, kind=kind)
+            commands.append(command)
+
+    return {
+        "operations": operations,
+        "commands": commands,
+        "buckets_ms": list(BUCKETS_MS),
+    }
+
+
+def by_operation():
+    """Round trips, bytes and records summed per operation."""
+
+    totals = {}
+    for command in snapshot()["commands"]:
+        total = totals.setdefault(command["operation"], {
+            "round_trips": 0, "bytes_sent": 0, "bytes_received": 0, "records": 0,
+        })
+        for field in total:
+            total[field] += command[field]
+
+    return totals
+
+
+def reset():
+    with _lock:
+        _operations.clear()
+        _commands.clear()
+
+
+def _bucket(seconds):
+    ms = seconds * 1000
+    for i, bound in enumerate(BUCKETS_MS):
+        if ms <= bound:
+            return i
+    return len(BUCKETS_MS)
+
+
+def _emit(event):
+    for hook in list(_hooks):
+        hook(event)
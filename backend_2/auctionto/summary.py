@@ -0,0 +1,177 @@
+from . import constants as const
+from . import serializers
+
+
+"""
+Materialized item summaries.
+
+`query_latest_summary_for_item` used to load the item, find its auctions and
+load the prevailing bid. Instead every item keeps a summary record,
+"summary:rec:<item name>", with one field per part of the answer:
+
+    item            the item's fields
+    auction         the auction shown in the summary (not a failed one), or None
+    highest_bid_id  that auction's highest bid id, kept apart from "auction"
+                    so the bid script can update it alone
+    prevailing_bid  that auction's highest (or winning) bid, or None
+
+Item and auction saves write their part in the same transaction as the
+record itself (see `ManagedObject._derived_entries`), and the bid script
+updates the bid parts along with the auction, so a summary is always as
+current as its sources and takes a single read.
+
+Summaries are derived data, always written as json whatever the configured
+codec, so that partial writes from python and lua never mix codecs in one
+record. consistency.py checks them against their sources, and rebuilds them.
+"""
+
+CATEGORY = "summary"
+HEADER = serializers.JsonCodec.header
+
+ITEM_FIELDS = ("name", "reserved_price", "status", "created_at", "updated_at")
+AUCTION_FIELDS = ("id", "status", "winning_bid_id", "created_at", "started_at", "closed_at")
+BID_FIELDS = ("id", "offer_price", "participant_id", "submitted_at")
+
+
+def encode(value):
+    """Encode a summary field value, e.g. for scripts to write."""
+    return serializers.codec_for_header(HEADER).encode(value)
+
+
+def _part(obj, fields):
+    return dict((f, getattr(obj, f, None)) for f in fields)
+
+
+def item_part(item):
+    return _part(item, ITEM_FIELDS)
+
+
+def auction_part(auction):
+    return _part(auction, AUCTION_FIELDS)
+
+
+def bid_part(bid):
+    return _part(bid, BID_FIELDS)
+
+
+def entry(item_name, data):
+    # A set_many_records entry for (part of) a summary.
+    return (CATEGORY, item_name, data, (), (), HEADER)
+
+
+def item_entry(item):
+    data = {"item": item_part(item)}
+    if item.status == const.ITEM_STATUS_AVAILABLE:
+        # Back on the shelf (or never auctioned): no auction to show.
+        data.update(auction=None, highest_bid_id=None, prevailing_bid=None)
+    return entry(item.name, data)
+
+
+def auction_entry(auction, dirty_fields=None):
+    # A failed auction leaves the summary alone; its item going back to
+    # available clears it in the same transaction.
+    if auction.status == const.AUCTION_STATUS_CALLED_FAIL:
+        return None
+
+    data = {"auction": auction_part(auction)}
+
+    # Bids are written by the bid script, so the bid parts are only touched
+    # when this object changed them, never from a stale copy.
+    if dirty_fields is None or "highest_bid_id" in dirty_fields:
+        data["highest_bid_id"] = auction.highest_bid_id
+        if auction.highest_bid_id is None:
+            data["prevailing_bid"] = None
+
+    return entry(auction.item_name, data)
+
+
+def full_entry(item, auction, prevailing_bid):
+    """Entry rewriting a whole summary from its sources."""
+
+    _, item_name, data, _, _, _ = item_entry(item)
+    data.update(auction=None, highest_bid_id=None, prevailing_bid=None)
+    if auction is not None:
+        data.update(auction_entry(auction)[2])
+    if prevailing_bid is not None:
+        data["prevailing_bid"] = bid_part(prevailing_bid)
+    return entry(item_name, data)
+
+
+def summary_auction(auctions):
+    # We will exclude any past failed auctions in summary because
+    # presumably that's not good for auction.
+    for auction in auctions:
+        if auction.status != const.AUCTION_STATUS_CALLED_FAIL:
+            return auction
+
+
+def prevailing_bid_id(auction):
+    if auction and auction.winning_bid_id:
+        return auction.winning_bid_id
+    elif auction and auction.highest_bid_id:
+        return auction.highest_bid_id
+
+
+def render(item, auction=None, highest_bid_id=None, prevailing_bid=None):
+    """
+    The `query_latest_summary_for_item` answer, from the parts above (as
+    plain dicts, e.g. straight from a summary record).
+
+    """
+
+    item_info = {
+        "name": item["name"],
+        "reserved_price": item["reserved_price"],
+        "status_code": item["status"],
+        "status_name": const.ITEM_STATUS_NAMES[item["status"]],
+        "created_at": item["created_at"],
+        "updated_at": item["updated_at"],
+    }
+
+    if item["status"] == const.ITEM_STATUS_AVAILABLE:
+        auction = None
+
+    auction_info = None
+    if auction:
+        auction_info = {
+            "id": auction["id"],
+            "status_code": auction["status"],
+            "status_name": const.AUCTION_STATUS_NAMES[auction["status"]],
+            "highest_bid_id": highest_bid_id,
+            "winning_bid_id": auction["winning_bid_id"],
+            "created_at": auction["created_at"],
+            "started_at": auction["started_at"],
+            "closed_at": auction["closed_at"],
+        }
+
+    bid_info = None
+    if auction and prevailing_bid:
+        bid_info = {
+            "id": prevailing_bid["id"],
+            "offer_price": prevailing_bid["offer_price"],
+            "participant_id": prevailing_bid["participant_id"],
+            "submitted_at": prevailing_bid["submitted_at"],
+        }
+
+    return {
+        "status": "success",
+        "item": item_info,
+        "auction": auction_info,
+        "prevailing_bid": bid_info,
+    }
+
+
+def render_record(record):
+    return render(
+        record["item"], record.get("auction"), record.get("highest_bid_id"),
+        record.get("prevailing_bid"))
+
+
+def render_objects(item, auction, prevailing_bid):
+    """Same as `render`, from loaded objects."""
+
+    return render(
+        item_part(item),
+        auction_part(auction) if auction else None,
+        auction.highest_bid_id if auction else None,
+        bid_part(prevailing_bid) if prevailing_bid else None)
@@ -1,11 +1,92 @@
+import time
 import uuid
-from datetime import datetime
 
-import rmanager
-import constants as const
-from auction import Auction
-from item import Item
-from bid import Bid
+from . import aggregates
+from . import archive
+from . import bidpool
+from . import events
+from . import rmanager
+from . import stats
+from . import summary
+from . import constants as const
+from .archive import ArchivedAuction
+from .auction import Auction
+from .item import Item
+from .bid import Bid
+
+
+class Read(object):
+    """
+    One read `summary_steps` asks for: a ManagedObject classmethod, e.g.
+    `one`, with its arguments. `run` does it; the aio api awaits its own
+    function of the same name instead.
+
+    """
+
+    def __init__(self, method, cls, *args, **criteria):
+        self.method = method
+        self.cls = cls
+        self.args = args
+        self.criteria = criteria
+
+    def run(self):
+        return getattr(self.cls, self.method)(*self.args, **self.criteria)
+
+
+def summary_steps(item_name):
+    """
+    `summary_sources` as a generator, for either api to drive: yields each
+    Read it needs, to be sent its result back, then the sources (or None).
+
+    """
+
+    item = yield Read("one", Item, item_name)
+    if item is None:
+        yield None
+        return
+
+    auction = None
+    if item.status > const.ITEM_STATUS_AVAILABLE:
+        auction = summary.summary_auction((yield Read("find", Auction, item_name=item_name)))
+
+    # A sold item's auction may have been archived since (see archive.py).
+    if auction is None and item.status == const.ITEM_STATUS_SOLD:
+        auction, prevailing_bid = archive.sold_auction(
+            (yield Read("find", ArchivedAuction, item_name=item_name)))
+        yield item, auction, prevailing_bid
+        return
+
+    bid_id = summary.prevailing_bid_id(auction)
+    prevailing_bid = (yield Read("one", Bid, bid_id)) if bid_id else None
+
+    yield item, auction, prevailing_bid
+
+
+def summary_sources(item_name):
+    """
+    The item, summary auction and prevailing bid an item summary is made
+    of, loaded from their own records; None if the item doesn't exist.
+
+    """
+
+    steps = summary_steps(item_name)
+    step = next(steps)
+    while isinstance(step, Read):
+        step = steps.send(step.run())
+    return step
+
+
+def compute_summary(item_name):
+    """
+    Item summary worked out from its sources instead of the summary record,
+    e.g. for items saved before summaries existed. None if no such item.
+
+    """
+
+    sources = summary_sources(item_name)
+    if sources is None:
+        return None
+    return summary.render_objects(*sources)
 
 
 class BaseUser(rmanager.ManagedObject):
@@ -16,6 +97,12 @@ class BaseUser(rmanager.ManagedObject):
 
     category = "user"
     identifier = "id"
+    fields = ("type", "id", "created_at")
+    # Auctioneers and participants share the category, told apart by type.
+    indexes = ("type",)
+
+    # Type of the subclass' users; scans and counts only cover those.
+    user_type = None
 
     def __init__(self, user_type, save=False):
         if user_type not in const.USER_TYPES:
@@ -23,117 +110,222 @@ class BaseUser(rmanager.ManagedObject):
 
         self.type = user_type
         self.id = str(uuid.uuid4())
-        self.created_at = str(datetime.now())
+        self.created_at = time.time()
 
         if save:
             self.save()
 
+    @classmethod
+    def _of_type(cls, criteria):
+        if cls.user_type is None:
+            return criteria
+        return dict(criteria, type=cls.user_type)
+
+    @classmethod
+    def _scan_plan(cls, criteria, filter_func):
+        # Scans of a subclass go over its type's index set only, so
+        # `all`, `iter_all` and `page` never decode the other users.
+        return super(BaseUser, cls)._scan_plan(cls._of_type(criteria), filter_func)
+
+    @classmethod
+    def _count_plan(cls, criteria):
+        return super(BaseUser, cls)._count_plan(cls._of_type(criteria))
+
+    def subscribe(self, auction_ids=()):
+        """
+        Subscription to the events (see events.py) of the given auctions, and
+        to this user's own, e.g. being outbid. Close it when done.
+
+        """
+
+        channels = [events.auction_channel(a) for a in auction_ids]
+        return rmanager.subscribe(channels + [events.user_channel(self.id)])
+
+    @stats.tracked
     def query_latest_summary_for_item(self, item_name):
-        item = Item.one(item_name)
-        if item is None:
+        # One read of the materialized summary (see summary.py).
+        record = rmanager.get_one_record(summary.CATEGORY, item_name)
+        if record is not None:
+            return summary.render_record(record)
+
+        ret = compute_summary(item_name)
+        if ret is None:
             return {
                 "status": "error",
                 "errors": ["Item does not exist."],
             }
 
-        item_info = {
-            "name": item.name,
-            "reserved_price": item.reserved_price,
-            "status_code": item.status,
-            "status_name": const.ITEM_STATUS_NAMES[item.status],
-            "created_at": item.created_at,
-            "updated_at": item.updated_at,
+        return ret
+
+    @stats.tracked
+    def query_auctions_between(self, field, start=None, end=None, status_code=None,
+                               newest_first=False, page_size=None, cursor=0):
+        """
+        Auctions whose `field` ("created_at", "started_at" or "closed_at",
+        in epoch seconds) is from `start` to `end` (None for no bound), oldest
+        first, e.g. those closed in the last hour:
+
+            query_auctions_between("closed_at", start=time.time() - 3600)
+
+        or the 10 oldest unstarted ones:
+
+            query_auctions_between("created_at", page_size=10,
+                                   status_code=const.AUCTION_STATUS_CREATED)
+
+        Paged the same way as `Auctioneer.query_all_items`.
+
+        """
+
+        if field not in Auction._sorted_fields():
+            return {
+                "status": "error",
+                "errors": ["Cannot order auctions by {}.".format(field)],
+            }
+
+        criteria = {}
+        if status_code is not None:
+            criteria["status"] = status_code
+
+        if page_size is None:
+            return Auction.between(field, start, end, reverse=newest_first, **criteria)
+
+        auctions, cursor = Auction.page_between(
+            field, start, end, cursor=cursor, page_size=page_size,
+            reverse=newest_first, **criteria)
+        return {
+            "status": "success",
+            "auctions": auctions,
+            "cursor": cursor,
         }
 
-        auction = None
-        auction_info = None
-        if item.status > const.ITEM_STATUS_AVAILABLE:
-
-            # We will exclude any past failed auctions in summary because
-            # presumably that's not good for auction.
-            def filter_func(auc_record):
-                item_name_met = auc_record.get("item_name") == item_name
-                auc_status_met = auc_record.get("status") != const.AUCTION_STATUS_CALLED_FAIL
-                return item_name_met and auc_status_met
-
-            ret = Auction.all(filter_func)
-            if ret:
-                auction = ret[0]
-                auction_info = {
-                    "id": auction.id,
-                    "status_code": auction.status,
-                    "status_name": const.AUCTION_STATUS_NAMES[auction.status],
-                    "highest_bid_id": auction.highest_bid_id,
-                    "winning_bid_id": auction.winning_bid_id,
-                    "created_at": auction.created_at,
-                    "started_at": auction.started_at,
-                    "closed_at": auction.closed_at,
-                }
-
-        bid_id = None
-        if auction and auction.winning_bid_id:
-            bid_id = auction.winning_bid_id
-        elif auction and auction.highest_bid_id:
-            bid_id = auction.highest_bid_id
-
-        bid_info = None
-        if bid_id:
-            prevailing_bid = Bid.one(bid_id)
-            if prevailing_bid:
-                bid_info = {
-                    "id": prevailing_bid.id,
-                    "offer_price": prevailing_bid.offer_price,
-                    "participant_id": prevailing_bid.participant_id,
-                    "submitted_at": prevailing_bid.submitted_at,
-                }
+    @stats.tracked
+    def query_bids_between(self, start=None, end=None, auction_id=None,
+                           newest_first=False, page_size=None, cursor=0):
+        """
+        Bids submitted from `start` to `end` (epoch seconds, None for no
+        bound), to any auction or just the given one, oldest first. Paged
+        like `query_auctions_between`.
+
+        """
+
+        criteria = {}
+        if auction_id is not None:
+            criteria["auction_id"] = auction_id
 
+        if page_size is None:
+            return Bid.between("submitted_at", start, end, reverse=newest_first, **criteria)
+
+        bids, cursor = Bid.page_between(
+            "submitted_at", start, end, cursor=cursor, page_size=page_size,
+            reverse=newest_first, **criteria)
         return {
             "status": "success",
-            "item": item_info,
-            "auction": auction_info,
-            "prevailing_bid": bid_info,
+            "bids": bids,
+            "cursor": cursor,
         }
 
 
 class Auctioneer(BaseUser):
 
+    user_type = const.USER_TYPE_AUCTIONEER
+
     def __init__(self, save=False):
         super(Auctioneer, self).__init__(const.USER_TYPE_AUCTIONEER, save=save)
 
     def __repr__(self):
         return "<Auctioneer id:'{}'>".format(self.id)
 
-    @classmethod
-    def all(cls, filter_func=None):
-        # Make sure we only return auctioneer objects, because we share the
-        # same category namespace "user".
-        objects = super(Auctioneer, cls).all()
-        return [o for o in objects if o.type == const.USER_TYPE_AUCTIONEER]
+    @stats.tracked
+    def query_all_items(self, status_code=None, page_size=None, cursor=0):
+        """
+        Return all items, or with `page_size` just one page of them along
+        with the cursor for the next page (0 once there are no more pages),
+        so that callers can walk any number of items in constant memory.
 
-    def query_all_items(self, status_code=None):
-        items = Item.all()
-        if status_code:
-            items = [i for i in items if i.status == status_code]
+        """
 
-        return items
+        criteria = {}
+        if status_code is not None:
+            criteria["status"] = status_code
 
-    def query_all_auctions(self, status_code=None):
-        auctions = Auction.all()
-        if status_code:
-            auctions = [a for a in auctions if a.status == status_code]
+        if page_size is None:
+            if criteria:
+                return Item.find(**criteria)
+            return Item.all()
 
-        return auctions
+        items, cursor = Item.page(cursor, page_size, **criteria)
+        return {
+            "status": "success",
+            "items": items,
+            "cursor": cursor,
+        }
 
-    def query_all_bids_for_auction(self, auction_id):
-        auction = Auction.one(auction_id)
-        if auction is None:
+    @stats.tracked
+    def query_all_auctions(self, status_code=None, page_size=None, cursor=0):
+        """Same as `query_all_items`, for auctions."""
+
+        criteria = {}
+        if status_code is not None:
+            criteria["status"] = status_code
+
+        if page_size is None:
+            if criteria:
+                return Auction.find(**criteria)
+            return Auction.all()
+
+        auctions, cursor = Auction.page(cursor, page_size, **criteria)
+        return {
+            "status": "success",
+            "auctions": auctions,
+            "cursor": cursor,
+        }
+
+    @stats.tracked
+    def query_all_bids_for_auction(self, auction_id, page_size=None, cursor=0):
+        """
+        The auction's bids, highest offer first, from its bid ladder. Paged
+        the same way as `query_all_items`.
+
+        """
+
+        # Only need to know the auction exists.
+        if Auction.get_fields(auction_id, "id") is None:
             return {
                 "status": "error",
                 "errors": ["This auction does not exist."],
             }
 
-        return auction.get_all_submitted_bids()
+        if page_size is None:
+            return Bid.between("offer_price", reverse=True, auction_id=auction_id)
 
+        bids, cursor = Bid.page_between(
+            "offer_price", cursor=cursor, page_size=page_size, reverse=True,
+            auction_id=auction_id)
+        return {
+            "status": "success",
+            "bids": bids,
+            "cursor": cursor,
+        }
+
+    @stats.tracked
+    def query_aggregates(self):
+        """
+        Items and auctions per status code, and how many auctions were
+        called and sold, for how much, and the sell-through rate, e.g.
+
+            {"status": "success",
+             "items": {0: 12, 1: 3, 2: 40}, "auctions": {0: 1, 1: 2, 2: 40, 3: 9},
+             "called": 49, "sold": 40, "sold_volume": 12500.0,
+             "sell_through_rate": 0.816...}
+
+        without loading any record (see aggregates.py).
+
+        """
+
+        return dict(aggregates.get_aggregates(), status="success")
+
+    @stats.tracked
+    @rmanager.atomic
     def register_item(self, item_name, reserved_price):
         if Item.one(item_name) is not None:
             return {
@@ -149,7 +341,21 @@ class Auctioneer(BaseUser):
             "item_name": item.name,
         }
 
-    def create_auction(self, item_name):
+    @stats.tracked
+    @rmanager.atomic
+    def create_auction(self, item_name, ends_at=None, extension=None):
+        """
+        Create an auction for the given item, to be started. A timed one is
+        called by the scheduler once past `ends_at` (epoch seconds), unless
+        called before; with an `extension`, a bid less than that many seconds
+        before the end pushes it back to that long after the bid.
+
+        """
+
+        error = Auction._deadline_error(ends_at, extension)
+        if error:
+            return error
+
         item = Item.one(item_name)
         if item is None:
             return {
@@ -157,23 +363,27 @@ class Auctioneer(BaseUser):
                 "errors": ["Item does not exist."],
             }
 
-        def filter_func(auc_record):
-            return auc_record.get("status") != const.AUCTION_STATUS_CALLED_FAIL
-
-        if Auction.all(filter_func):
+        # Only one auction per item can be open (or have succeeded) at a time;
+        # a sold item's auction may have been archived since.
+        auctions = Auction.find(item_name=item_name)
+        if item.status == const.ITEM_STATUS_SOLD or [
+                a for a in auctions if a.status != const.AUCTION_STATUS_CALLED_FAIL]:
             return {
                 "status": "error",
                 "errors": ["Auction already exists for this item."],
             }
 
-        auction = Auction(item_name)
-        auction.save()
+        # The item is staged by the new auction; both are saved together.
+        auction = Auction(item_name, item=item, ends_at=ends_at, extension=extension)
+        auction.save_many([auction, item])
 
         return {
             "status": "success",
             "auction_id": auction.id,
         }
 
+    @stats.tracked
+    @rmanager.atomic
     def start_auction(self, auction_id):
         auction = Auction.one(auction_id)
         if auction is None:
@@ -184,18 +394,25 @@ class Auctioneer(BaseUser):
 
         return auction.start()
 
-    def register_item_and_start_auction(self, item_name, reserved_price):
+    @stats.tracked
+    @rmanager.atomic
+    def register_item_and_start_auction(self, item_name, reserved_price, ends_at=None,
+                                        extension=None):
         """
         Shortcut method to register an item, create an auction, and start the
         auction in one go.
 
         """
 
+        error = Auction._deadline_error(ends_at, extension)
+        if error:
+            return error
+
         ret = self.register_item(item_name, reserved_price)
         if ret["status"] != "success":
             return ret
 
-        ret = self.create_auction(ret["item_name"])
+        ret = self.create_auction(ret["item_name"], ends_at=ends_at, extension=extension)
         if ret["status"] != "success":
             return ret
 
@@ -203,16 +420,12 @@ class Auctioneer(BaseUser):
 
         return ret
 
+    @stats.tracked
     def call_auction(self, auction_id):
-        auction = Auction.one(auction_id)
-        if auction is None:
-            return {
-                "status": "error",
-                "errors": ["This auction does not exist."],
-            }
-
-        return auction.end()
+        return Auction.call(auction_id)
 
+    @stats.tracked
+    @rmanager.atomic
     def update_item_reserved_price(self, item_name, reserved_price):
         item = Item.one(item_name)
         if item is None:
@@ -238,6 +451,8 @@ class Auctioneer(BaseUser):
             "item_name": item.name,
         }
 
+    @stats.tracked
+    @rmanager.atomic
     def unstage_item_from_auction(self, item_name):
         item = Item.one(item_name)
         if item is None:
@@ -252,13 +467,8 @@ class Auctioneer(BaseUser):
                 "errors": ["Item is not staged for auction."],
             }
 
-        def filter_func(auc_record):
-            item_name_met = auc_record.get("item_name") == item_name
-            auc_status_met = auc_record.get("status") == const.AUCTION_STATUS_CREATED
-
-            return item_name_met and auc_status_met
-
-        ret = Auction.all(filter_func)
+        ret = Auction.find(
+            item_name=item_name, status=const.AUCTION_STATUS_CREATED)
         if ret:
             auction = ret[0]
             auction.delete()
@@ -282,39 +492,70 @@ class Auctioneer(BaseUser):
 
 class Participant(BaseUser):
 
+    user_type = const.USER_TYPE_PARTICIPANT
+
     def __init__(self, save=False):
         super(Participant, self).__init__(const.USER_TYPE_PARTICIPANT, save=save)
 
     def __repr__(self):
         return "<Participant id:'{}'>".format(self.id)
 
-    @classmethod
-    def all(cls, filter_func=None):
-        # Make sure we only return participant objects, because we share the
-        # same category namespace "user".
-        objects = super(Participant, cls).all()
-        return [o for o in objects if o.type == const.USER_TYPE_PARTICIPANT]
-
-    def query_all_live_auctions(self, involved_only=False):
+    @stats.tracked
+    def query_all_live_auctions(self, involved_only=False, page_size=None, cursor=0):
+        # Paged the same way as `Auctioneer.query_all_auctions`. Involved
+        # ones come from the participant's joined auctions, so they cost as
+        # much as the auctions joined, whatever else is going on.
+        if page_size is None:
+            if involved_only:
+                return Auction.joined_by(self.id)
+            return Auction.find(status=const.AUCTION_STATUS_IN_PROGRESS)
 
-        def filter_func(auc_record):
-            return auc_record.get("status") == const.AUCTION_STATUS_IN_PROGRESS
+        if involved_only:
+            auctions, cursor = Auction.page_joined_by(self.id, cursor, page_size)
+        else:
+            auctions, cursor = Auction.page(
+                cursor, page_size, status=const.AUCTION_STATUS_IN_PROGRESS)
 
-        auctions = Auction.all(filter_func)
+        return {
+            "status": "success",
+            "auctions": auctions,
+            "cursor": cursor,
+        }
 
-        if involved_only:
-            bids = Bid.all(lambda x: x["participant_id"] == self.id)
-            involved_auction_ids = set([b.auction_id for b in bids])
-            auctions = [a for a in auctions if a.id in involved_auction_ids]
+    @stats.tracked
+    def query_rank_for_auction(self, auction_id):
+        """
+        Where the participant stands on the auction: their rank among its
+        bidders by best offer (1 for the highest bidder), how many bidders
+        there are, and their best offer.
 
-        return auctions
+        """
 
-    def submit_bid_for_auction(self, auction_id, bid_price):
-        auction = Auction.one(auction_id)
-        if auction is None:
+        if Auction.get_fields(auction_id, "id") is None:
             return {
                 "status": "error",
                 "errors": ["This auction does not exist."],
             }
 
-        return auction.process_bid(bid_price, self.id)
+        rank, best_offer, bidders = Auction.bidder_rank(auction_id, self.id)
+        if rank is None:
+            return {
+                "status": "error",
+                "errors": ["You have not bid on this auction."],
+            }
+
+        return {
+            "status": "success",
+            "auction_id": auction_id,
+            "rank": rank,
+            "bidders": bidders,
+            "best_offer": best_offer,
+        }
+
+    @stats.tracked
+    def submit_bid_for_auction(self, auction_id, bid_price):
+        # Through the auction's bid worker if there are any (see bidpool.py).
+        pool = bidpool.get_pool()
+        if pool is not None:
+            return pool.submit_bid(auction_id, bid_price, self.id)
+        return Auction.accept_bid(auction_id, bid_price, self.id)
@@ -0,0 +1,132 @@
+import threading
+import time
+
+import redis
+
+from auctionto import rmanager, serializers
+from auctionto.auction import Auction
+from auctionto.bid import Bid
+from auctionto.item import Item
+from auctionto.user import Participant
+
+
+class CountingConnection(redis.Connection):
+    """
+    Connection that counts every request sent, i.e. every round trip, in
+    total and per thread (see `thread_round_trips`).
+
+    """
+
+    round_trips = 0
+    _local = threading.local()
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        local = CountingConnection._local
+        local.round_trips = getattr(local, "round_trips", 0) + 1
+        return super(CountingConnection, self).send_packed_command(
+            command, check_health=check_health)
+
+    @classmethod
+    def thread_round_trips(cls):
+        return getattr(cls._local, "round_trips", 0)
+
+
+def measure(func):
+    # Round trips are only counted against redis; in memory there are none.
+    CountingConnection.round_trips = 0
+    started = time.time()
+    func()
+    return CountingConnection.round_trips, time.time() - started
+
+
+def bench_bulk_api(count):
+    """Round trips and wall time of per-object calls vs their bulk versions."""
+
+    items = [Item("item-{}".format(i), 100 + i) for i in range(count)]
+    names = [i.name for i in items]
+
+    rows = []
+
+    def save_each():
+        for item in items:
+            item.save()
+    rows.append(("save", measure(save_each)))
+    rows.append(("save_many", measure(lambda: Item.save_many(items))))
+
+    def one_each():
+        for name in names:
+            Item.one(name)
+    rows.append(("one", measure(one_each)))
+    rows.append(("one_many", measure(lambda: Item.one_many(names))))
+
+    def delete_each():
+        for item in items:
+            item.delete()
+    rows.append(("delete", measure(delete_each)))
+    Item.save_many(items)
+    rows.append(("delete_many", measure(lambda: Item.delete_many(items))))
+
+    print("Bulk api, {} items ({}):".format(
+        count, rmanager.get_backend().__class__.__name__))
+    print("{:<14}{:>12}{:>14}{:>12}".format("operation", "round trips", "per object", "ms"))
+    for name, (round_trips, seconds) in rows:
+        print("{:<14}{:>12}{:>14.3f}{:>12.1f}".format(
+            name, round_trips, float(round_trips) / count, seconds * 1000))
+
+
+def bench_load_auctions(count):
+    """Loading auctions should not touch their items (or anything else)."""
+
+    items = [Item("lot-{}".format(i), 100) for i in range(count)]
+    Item.save_many(items)
+    Auction.save_many([Auction(i.name) for i in items])
+
+    round_trips, seconds = measure(Auction.all)
+
+    print("Auction.all, {} auctions: {} round trip(s), {:.1f} ms".format(
+        count, round_trips, seconds * 1000))
+
+
+def bench_codecs(count):
+    """Encode/decode throughput and stored bytes per record, per codec."""
+
+    item = Item("macbook pro 13-inch", 800)
+    item.save()
+    auction = Auction(item.name)
+    bid = Bid(auction.id, 850, Participant().id)
+
+    print("Codecs, {} records each:".format(count))
+    print("{:<10}{:<10}{:>8}{:>14}{:>14}".format(
+        "codec", "record", "bytes", "encode/s", "decode/s"))
+
+    for name in sorted(serializers.CODECS):
+        codec = serializers.CODECS[name]
+        for obj in [item, auction, bid]:
+            record = obj._record()
+
+            started = time.time()
+            for _ in range(count):
+                encoded = rmanager.encode_record(record, codec.header)
+            encode_seconds = time.time() - started
+
+            started = time.time()
+            for _ in range(count):
+                rmanager._decode_record(dict(encoded))
+            decode_seconds = time.time() - started
+
+            stored_bytes = sum(len(k) + len(v) for k, v in encoded.items())
+            print("{:<10}{:<10}{:>8}{:>14.0f}{:>14.0f}".format(
+                name, obj.category, stored_bytes,
+                count / encode_seconds, count / decode_seconds))
+
+
+if __name__ == "__main__":
+    rmanager.configure(connection_class=CountingConnection)
+    rmanager.flushall()
+
+    bench_bulk_api(1000)
+    bench_load_auctions(2000)
+    bench_codecs(20000)
+
+    rmanager.flushall()
@@ -0,0 +1,373 @@
+"""
+Load generator for the auction library.
+
+Simulates auctioneers registering items and running auctions while
+participants browse and bid from many threads, ending with a bid storm on
+every live auction right as it is called. Reports ops/sec, p50/p99 latency
+and round trips per call for each public user method, e.g.
+
+    python loadrun.py --participants 200 --auctions 50 --threads 16 \\
+        --output after.json --compare before.json
+
+Round trips are only counted against redis; in memory there are none.
+"""
+
+import argparse
+import json
+import platform
+import random
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from auctionto import Auctioneer, Participant, rmanager, stats
+from benchrun import CountingConnection
+
+
+class Recorder(object):
+    """Latency, round trips and outcome of every timed call, per method."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.methods = {}
+
+    def call(self, name, func, *args, **kwargs):
+        round_trips = CountingConnection.thread_round_trips()
+        started = time.time()
+        ret = func(*args, **kwargs)
+        ended = time.time()
+        round_trips = CountingConnection.thread_round_trips() - round_trips
+
+        error = isinstance(ret, dict) and ret.get("status") == "error"
+        with self._lock:
+            m = self.methods.get(name)
+            if m is None:
+                m = self.methods[name] = {
+                    "latencies": [], "round_trips": 0, "errors": 0,
+                    "first_start": started, "last_end": ended,
+                }
+            m["latencies"].append(ended - started)
+            m["round_trips"] += round_trips
+            m["errors"] += error
+            m["first_start"] = min(m["first_start"], started)
+            m["last_end"] = max(m["last_end"], ended)
+
+        return ret
+
+    def results(self):
+        results = {}
+        for name, m in self.methods.items():
+            latencies = sorted(m["latencies"])
+            calls = len(latencies)
+            # Throughput over the window the method was being called in,
+            # across all threads.
+            window = max(m["last_end"] - m["first_start"], 1e-9)
+            results[name] = {
+                "calls": calls,
+                "errors": m["errors"],
+                "ops_per_sec": calls / window,
+                "mean_ms": sum(latencies) / calls * 1000,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "round_trips_per_call": float(m["round_trips"]) / calls,
+            }
+        return results
+
+
+def percentile(sorted_values, p):
+    # Nearest rank.
+    index = int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+def run_parallel(tasks, threads):
+    """Run callables from `threads` worker threads, in order of submission."""
+
+    pending = queue.Queue()
+    for task in tasks:
+        pending.put(task)
+
+    failures = []
+
+    def worker():
+        while True:
+            try:
+                task = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                task()
+            except Exception as e:
+                failures.append(e)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    if failures:
+        raise failures[0]
+
+
+class Simulation(object):
+
+    def __init__(self, options, recorder):
+        self.options = options
+        self.recorder = recorder
+        self.rng = random.Random(options.seed)
+        self.auctioneers = []
+        self.participants = []
+        self.items = []
+        # Live auctions, as (auction_id, item_name, reserved_price).
+        self.live_auctions = []
+        self._lock = threading.Lock()
+
+    def call(self, name, user, *args, **kwargs):
+        return self.recorder.call(name, getattr(user, name), *args, **kwargs)
+
+    def setup(self):
+        o = self.options
+        self.auctioneers = [Auctioneer(save=True) for _ in range(o.auctioneers)]
+        self.participants = [Participant(save=True) for _ in range(o.participants)]
+
+        tasks = []
+        for i in range(o.items):
+            auctioneer = self.auctioneers[i % o.auctioneers]
+            name = "item-{}".format(i)
+            reserved_price = self.rng.randint(100, 1000)
+            self.items.append(name)
+            if i < o.auctions:
+                tasks.append(self._open_auction_task(auctioneer, i, name, reserved_price))
+            else:
+                tasks.append(self._shelve_item_task(auctioneer, i, name, reserved_price))
+
+        run_parallel(tasks, o.threads)
+        # Same order whichever thread got there first, so seeds reproduce.
+        self.live_auctions.sort(key=lambda a: a[1])
+
+    def _open_auction_task(self, auctioneer, i, name, reserved_price):
+        def task():
+            if i % 2:
+                ret = self.call(
+                    "register_item_and_start_auction", auctioneer, name, reserved_price)
+            else:
+                self.call("register_item", auctioneer, name, reserved_price)
+                ret = self.call("create_auction", auctioneer, name)
+                ret = self.call("start_auction", auctioneer, ret["auction_id"])
+
+            with self._lock:
+                self.live_auctions.append((ret["auction_id"], name, reserved_price))
+        return task
+
+    def _shelve_item_task(self, auctioneer, i, name, reserved_price):
+        # Items not up for auction; some get staged, pulled and re-priced.
+        def task():
+            self.call("register_item", auctioneer, name, reserved_price)
+            if i % 4 == 0:
+                self.call("create_auction", auctioneer, name)
+                self.call("unstage_item_from_auction", auctioneer, name)
+                self.call("update_item_reserved_price", auctioneer, name, reserved_price + 10)
+        return task
+
+    def bidding(self):
+        """Participants bid on random live auctions, browsing in between."""
+
+        o = self.options
+        tasks = []
+        for _ in range(o.bids):
+            participant = self.rng.choice(self.participants)
+            auction_id, name, reserved_price = self.rng.choice(self.live_auctions)
+            if self.rng.random() < o.read_ratio:
+                tasks.append(self._browse_task(participant, name))
+            else:
+                price = self.rng.randint(1, int(reserved_price * 0.8))
+                tasks.append(lambda p=participant, a=auction_id, price=price: self.call(
+                    "submit_bid_for_auction", p, a, price))
+
+        self.rng.shuffle(tasks)
+        run_parallel(tasks, o.threads)
+
+    def _browse_task(self, participant, item_name):
+        choice = self.rng.randint(0, 2)
+
+        def task():
+            if choice == 0:
+                self.call("query_latest_summary_for_item", participant, item_name)
+            elif choice == 1:
+                self.recorder.call(
+                    "query_all_live_auctions(involved_only)",
+                    participant.query_all_live_auctions, involved_only=True,
+                    page_size=self.options.page_size)
+            else:
+                self.call(
+                    "query_all_live_auctions", participant,
+                    page_size=self.options.page_size)
+        return task
+
+    def storm(self):
+        """
+        Bursts of ever higher bids on every live auction at once, with the
+        auction called while its burst is still coming in.
+
+        """
+
+        o = self.options
+        tasks = []
+        for auction_id, name, reserved_price in self.live_auctions:
+            auctioneer = self.rng.choice(self.auctioneers)
+            burst = []
+            for n in range(o.storm_bids):
+                participant = self.rng.choice(self.participants)
+                price = reserved_price * 0.8 + n * reserved_price * 0.5 / o.storm_bids
+                burst.append(lambda p=participant, a=auction_id, price=price: self.call(
+                    "submit_bid_for_auction", p, a, round(price, 2)))
+
+            call_at = int(len(burst) * 0.9)
+            burst.insert(call_at, lambda u=auctioneer, a=auction_id: self.call(
+                "call_auction", u, a))
+            tasks.append(burst)
+
+        # Interleave the bursts so that all auctions storm together.
+        interleaved = []
+        for n in range(o.storm_bids + 1):
+            interleaved += [burst[n] for burst in tasks if n < len(burst)]
+
+        run_parallel(interleaved, o.threads)
+
+    def wrap_up(self):
+        """Everyone checks the results."""
+
+        o = self.options
+        tasks = []
+        for auction_id, name, _ in self.live_auctions:
+            auctioneer = self.rng.choice(self.auctioneers)
+            participant = self.rng.choice(self.participants)
+            tasks.append(lambda u=participant, n=name: self.call(
+                "query_latest_summary_for_item", u, n))
+            tasks.append(lambda u=auctioneer, a=auction_id: self.call(
+                "query_all_bids_for_auction", u, a))
+
+        for auctioneer in self.auctioneers:
+            tasks.append(lambda u=auctioneer: self.call("query_all_items", u))
+            tasks.append(lambda u=auctioneer: self.call("query_all_auctions", u))
+            tasks.append(lambda u=auctioneer: self._walk_pages(u))
+
+        run_parallel(tasks, o.threads)
+
+    def _walk_pages(self, auctioneer):
+        cursor = 0
+        while True:
+            ret = self.recorder.call(
+                "query_all_items(page)", auctioneer.query_all_items,
+                page_size=self.options.page_size, cursor=cursor)
+            cursor = ret["cursor"]
+            if cursor == 0:
+                break
+
+
+def print_results(results, baseline=None):
+    header = "{:<40}{:>8}{:>8}{:>12}{:>10}{:>10}{:>8}".format(
+        "method", "calls", "errors", "ops/s", "p50 ms", "p99 ms", "rt/call")
+    if baseline:
+        header += "{:>10}{:>10}".format("ops/s +-", "p99 +-")
+    print(header)
+
+    for name in sorted(results):
+        r = results[name]
+        line = "{:<40}{:>8}{:>8}{:>12.0f}{:>10.2f}{:>10.2f}{:>8.2f}".format(
+            name, r["calls"], r["errors"], r["ops_per_sec"], r["p50_ms"],
+            r["p99_ms"], r["round_trips_per_call"])
+        b = (baseline or {}).get(name)
+        if b:
+            line += "{:>9.0f}%{:>9.0f}%".format(
+                change(b["ops_per_sec"], r["ops_per_sec"]),
+                change(b["p99_ms"], r["p99_ms"]))
+        print(line)
+
+
+def change(before, after):
+    return (after - before) * 100.0 / before if before else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--auctioneers", type=int, default=5)
+    parser.add_argument("--participants", type=int, default=100)
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--auctions", type=int, default=50,
+                        help="items put up for auction at the same time")
+    parser.add_argument("--bids", type=int, default=5000,
+                        help="bids (and browsing calls) before the storm")
+    parser.add_argument("--storm-bids", type=int, default=50,
+                        help="bids per auction in the storm around its call")
+    parser.add_argument("--read-ratio", type=float, default=0.2,
+                        help="share of browsing calls among the bids")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cache", action="store_true",
+                        help="read managed objects through the record cache")
+    parser.add_argument("--bid-workers", type=int, default=0,
+                        help="submit bids through this many worker processes "
+                             "(their round trips aren't counted)")
+    parser.add_argument("--output", help="write results as json to this file")
+    parser.add_argument("--compare", help="json results of an earlier run")
+
+    options = parser.parse_args()
+    options.auctions = min(options.auctions, options.items)
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_args()
+
+    rmanager.configure(connection_class=CountingConnection, cache=options.cache,
+                       bid_workers=options.bid_workers)
+    rmanager.flushall()
+    stats.reset()
+
+    recorder = Recorder()
+    simulation = Simulation(options, recorder)
+
+    phases = []
+    for phase in [simulation.setup, simulation.bidding, simulation.storm, simulation.wrap_up]:
+        started = time.time()
+        phase()
+        phases.append((phase.__name__, time.time() - started))
+
+    results = recorder.results()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)["methods"]
+
+    print("Load run ({}, {} threads{}):".format(
+        rmanager.get_backend().__class__.__name__, options.threads,
+        ", {} bid workers".format(options.bid_workers) if options.bid_workers else ""))
+    print(", ".join("{} {:.2f}s".format(n, s) for n, s in phases))
+    print_results(results, baseline)
+    if options.cache:
+        print("Record cache: {}".format(rmanager.get_cache().info()))
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({
+                "options": vars(options),
+                "backend": rmanager.get_backend().__class__.__name__,
+                "codec": rmanager.get_codec().header,
+                "python": platform.python_version(),
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "phases": dict(phases),
+                "methods": results,
+                # Round trips, bytes and latencies per method and category.
+                "storage": stats.snapshot(),
+                "cache": rmanager.get_cache().info() if options.cache else None,
+            }, f, indent=2, sort_keys=True)
+
+    rmanager.flushall()
@@ -1,4 +1,13 @@
+import threading
+import time
+
 from auctionto import Auctioneer, Participant, rmanager, constants as const
+from auctionto import aggregates, archive, bidpool, consistency, events, scheduler, summary
+from auctionto.archive import ArchivedAuction
+from auctionto.bid import Bid
+from auctionto.auction import Auction, CLOSE_AUCTION_SCRIPT, deadlines_key, joined_key
+from auctionto.item import Item
+from auctionto.user import BaseUser
 
 
 if __name__ == "__main__":
@@ -13,6 +22,15 @@ if __name__ == "__main__":
     assert len(Auctioneer.all()) == 1
     assert len(Participant.all()) == 2
 
+    # Counted and paged per type, without loading the other type.
+    assert (Auctioneer.count(), Participant.count(), BaseUser.count()) == (1, 2, 3)
+    users, cursor = Participant.page(page_size=1)
+    while cursor != 0:
+        more, cursor = Participant.page(cursor, page_size=1)
+        users += more
+    assert sorted(u.id for u in users) == sorted([participant_one.id, participant_two.id])
+    assert Participant.all(lambda record: record["id"] == participant_two.id)[0].id == participant_two.id
+
     # Test we currently have no auctions or items, observable by all users.
     assert len(auctioneer_one.query_all_items()) == 0
     assert len(auctioneer_one.query_all_auctions()) == 0
@@ -73,6 +91,22 @@ if __name__ == "__main__":
 
     auction_id = ret["auction_id"]
 
+    # participant_one follows the auction as it goes.
+    subscription = participant_one.subscribe(auction_ids=[auction_id])
+
+    # A malformed event, or a failing subscriber, doesn't stop the others.
+    def fail(event):
+        raise Exception("Failing subscriber.")
+
+    events.log.disabled = True
+    subscription.hub.add(subscription.channels, fail)
+    rmanager.get_backend().publish(events.auction_channel(auction_id), "not json")
+
+    # Should not be able to open a second auction for the same item.
+    ret = auctioneer_one.create_auction("iphone")
+    assert ret["status"] == "error"
+    assert "Auction already exists for this item." in ret["errors"]
+
     # Check there are two items and one auction visible to auctioneer.
     # There should be one live action visible to participants, but none involved.
     assert len(auctioneer_one.query_all_items()) == 2
@@ -91,12 +125,25 @@ if __name__ == "__main__":
     assert ret["status"] == "error"
     assert "Not a valid bid price for submission." in ret["errors"]
 
+    for price in (float("nan"), float("inf"), float("-inf")):
+        ret = participant_one.submit_bid_for_auction(auction_id, price)
+        assert "Not a valid bid price for submission." in ret["errors"]
+
     # Have participant_one submit a bid, with a valid price this time.
     ret = participant_one.submit_bid_for_auction(auction_id, 100)
     assert ret["status"] == "success"
 
     first_bid_id = ret["bid_id"]
 
+    event = subscription.get(timeout=5)
+    assert event["type"] == events.BID_ACCEPTED
+    assert event["bid_id"] == first_bid_id
+    assert event["participant_id"] == participant_one.id
+    # Stamped by the server, the same in the bid and its event.
+    assert event["submitted_at"] == Bid.one(first_bid_id).submitted_at
+    subscription.hub.remove(subscription.channels, fail)
+    events.log.disabled = False
+
     # Check participants involved live auctions.
     assert len(participant_one.query_all_live_auctions(involved_only=True)) == 1
     assert len(participant_two.query_all_live_auctions(involved_only=True)) == 0
@@ -121,9 +168,23 @@ if __name__ == "__main__":
 
     second_bid_id = ret["bid_id"]
 
+    # Both the auction and participant_one's own channel tell of it.
+    received = [subscription.get(timeout=5), subscription.get(timeout=5)]
+    assert sorted(e["type"] for e in received) == [events.BID_ACCEPTED, events.OUTBID]
+    assert all(e["bid_id"] == second_bid_id for e in received)
+
     # Check now both participants are involved in one live auction.
     assert len(participant_one.query_all_live_auctions(involved_only=True)) == 1
     assert len(participant_two.query_all_live_auctions(involved_only=True)) == 1
+    involved, cursor = [], 0
+    while True:
+        ret = participant_one.query_all_live_auctions(
+            involved_only=True, page_size=10, cursor=cursor)
+        involved += [a.id for a in ret["auctions"]]
+        cursor = ret["cursor"]
+        if cursor == 0:
+            break
+    assert involved == [auction_id]
 
     # Check item summary again, should have updated info.
     ret = participant_one.query_latest_summary_for_item("iphone")
@@ -135,6 +196,7 @@ if __name__ == "__main__":
     assert ret["prevailing_bid"]["id"] == second_bid_id
     assert ret["prevailing_bid"]["offer_price"] == 200
     assert ret["prevailing_bid"]["participant_id"] == participant_two.id
+    assert ret["prevailing_bid"]["submitted_at"] == Bid.one(second_bid_id).submitted_at
 
     # Have participant_one submit another bid, but lower than the current
     # highest bid, which should be rejected.
@@ -142,13 +204,42 @@ if __name__ == "__main__":
     assert ret["status"] == "error"
     assert "Bid must be higher than the current highest bid." in ret["errors"]
 
+    # Still so for auctions live since before the bidders ladder.
+    Auction.drop_bidders(auction_id)
+    ret = participant_one.submit_bid_for_auction(auction_id, 150)
+    assert "Bid must be higher than the current highest bid." in ret["errors"]
+    Auction.rebuild_bidders()
+
     # Confirm currently accepted bid for this auction, should be only two.
     assert len(auctioneer_one.query_all_bids_for_auction(auction_id)) == 2
 
+    # Bid ladder: highest offer first, one page at a time too.
+    bids = auctioneer_one.query_all_bids_for_auction(auction_id)
+    assert [b.id for b in bids] == [second_bid_id, first_bid_id]
+    ret = auctioneer_one.query_all_bids_for_auction(auction_id, page_size=1)
+    assert [b.id for b in ret["bids"]] == [second_bid_id]
+    ret = auctioneer_one.query_all_bids_for_auction(
+        auction_id, page_size=1, cursor=ret["cursor"])
+    assert [b.id for b in ret["bids"]] == [first_bid_id]
+    assert [b.id for b in Auction.top_bids(auction_id, 1)] == [second_bid_id]
+
+    ret = participant_one.query_rank_for_auction(auction_id)
+    assert ret["status"] == "success"
+    assert (ret["rank"], ret["bidders"], ret["best_offer"]) == (2, 2, 100)
+    assert participant_two.query_rank_for_auction(auction_id)["rank"] == 1
+    ret = Participant().query_rank_for_auction(auction_id)
+    assert "You have not bid on this auction." in ret["errors"]
+
     # Have auctioneer call the auction, while reserved price is not met.
     ret = auctioneer_one.call_auction(auction_id)
     assert ret["status"] == "success"
 
+    event = subscription.get(timeout=5)
+    assert event["type"] == events.AUCTION_CALLED
+    assert event["status"] == const.AUCTION_STATUS_CALLED_FAIL
+    assert subscription.get(timeout=0.1) is None
+    subscription.close()
+
     # Check item summary again, which should be available for auction again.
     ret = auctioneer_one.query_latest_summary_for_item("iphone")
     assert ret["item"]["name"] == "iphone"
@@ -163,6 +254,10 @@ if __name__ == "__main__":
     assert len(participant_two.query_all_live_auctions()) == 0
     assert len(participant_two.query_all_live_auctions(involved_only=True)) == 0
 
+    # Called, the auction left its bidders' joined auctions.
+    for participant in (participant_one, participant_two):
+        assert not rmanager.get_backend().smembers(joined_key(participant.id))
+
     # Have auctioneer lower the reserved price on this item.
     ret = auctioneer_one.update_item_reserved_price("iphone", 200)
     assert ret["status"] == "success"
@@ -206,3 +301,346 @@ if __name__ == "__main__":
 
     # Lastly confirm we have no live auction anymore.
     assert len(participant_one.query_all_live_auctions()) == 0
+
+    # Counts per status and sales, without loading any record.
+    ret = auctioneer_one.query_aggregates()
+    assert ret["items"] == {
+        const.ITEM_STATUS_AVAILABLE: 1, const.ITEM_STATUS_STAGED: 0, const.ITEM_STATUS_SOLD: 1}
+    assert ret["auctions"] == {
+        const.AUCTION_STATUS_CREATED: 0, const.AUCTION_STATUS_IN_PROGRESS: 0,
+        const.AUCTION_STATUS_CALLED_SUCCESS: 1, const.AUCTION_STATUS_CALLED_FAIL: 1}
+    assert (ret["called"], ret["sold"], ret["sold_volume"]) == (2, 1, 250.0)
+    assert ret["sell_through_rate"] == 0.5
+    assert len(auctioneer_one.query_all_items(status_code=const.ITEM_STATUS_SOLD)) == 1
+    assert len(auctioneer_one.query_all_items(status_code=const.ITEM_STATUS_AVAILABLE)) == 1
+
+    # Walk all items one page at a time, should see both exactly once.
+    item_names = []
+    cursor = 0
+    while True:
+        ret = auctioneer_one.query_all_items(page_size=1, cursor=cursor)
+        assert ret["status"] == "success"
+        item_names += [i.name for i in ret["items"]]
+        cursor = ret["cursor"]
+        if cursor == 0:
+            break
+        # Opaque text, whatever the backend.
+        assert isinstance(cursor, type(u""))
+
+    assert sorted(item_names) == ["iphone", "macbook"]
+
+    # Item summaries should match what the items, auctions and bids say.
+    assert consistency.check_item_summaries() == []
+
+    # Without its summary record, an item's summary is worked out from the
+    # records themselves; the check flags it and repair puts it back.
+    expected = auctioneer_one.query_latest_summary_for_item("iphone")
+    rmanager.delete_one_record(summary.CATEGORY, "iphone")
+    assert auctioneer_one.query_latest_summary_for_item("iphone") == expected
+    assert len(consistency.check_item_summaries(repair=True)) == 1
+    assert consistency.check_item_summaries() == []
+    assert auctioneer_one.query_latest_summary_for_item("iphone") == expected
+
+    # A unit of work sees its own pending changes, writes nothing until it
+    # ends, and nothing at all if a record it read changed in between.
+    def bump_reserved_price():
+        other = Item.one("macbook")
+        other.reserved_price += 100
+        other.save()
+
+    reserved_price = Item.one("macbook").reserved_price
+    try:
+        with rmanager.unit_of_work():
+            item = Item.one("macbook")
+            item.reserved_price += 1
+            item.save()
+            assert Item.one("macbook") is item
+            assert Item.get_fields("macbook", "reserved_price") == {
+                "reserved_price": reserved_price + 1}
+
+            # Another client, in another thread, gets there first.
+            other_client = threading.Thread(target=bump_reserved_price)
+            other_client.start()
+            other_client.join()
+        assert False, "expected a conflict"
+    except rmanager.ConflictError:
+        pass
+
+    assert Item.one("macbook").reserved_price == reserved_price + 100
+
+    # With the record cache on, repeated reads stay in process, and saves
+    # are seen right away.
+    rmanager.configure(cache=True)
+    item = Item.one("macbook")
+    assert Item.one("macbook").reserved_price == item.reserved_price
+    assert rmanager.get_cache().info()["hits"] == 1
+    item.reserved_price += 1
+    item.save()
+    assert Item.one("macbook").reserved_price == item.reserved_price
+    assert Item.get_fields("macbook", "reserved_price") == {
+        "reserved_price": item.reserved_price}
+    rmanager.configure(cache=False)
+
+    # Timestamps are epoch seconds, with sorted indexes for time ranges.
+    started = time.time()
+    unstarted_ids = []
+    for i in range(3):
+        ret = auctioneer_one.register_item("watch-{}".format(i), 100)
+        unstarted_ids.append(auctioneer_one.create_auction("watch-{}".format(i))["auction_id"])
+    ret = auctioneer_one.register_item_and_start_auction("ipad", 300)
+    ipad_auction_id = ret["auction_id"]
+    bid_ids = []
+    for price in (310, 320, 330):
+        ret = participant_one.submit_bid_for_auction(ipad_auction_id, price)
+        bid_ids.append(ret["bid_id"])
+    auctioneer_one.call_auction(ipad_auction_id)
+
+    unstarted = auctioneer_one.query_auctions_between(
+        "created_at", status_code=const.AUCTION_STATUS_CREATED)
+    assert [a.id for a in unstarted][-3:] == unstarted_ids
+    assert [a.id for a in auctioneer_one.query_auctions_between(
+        "closed_at", start=started)] == [ipad_auction_id]
+    assert auctioneer_one.query_auctions_between("item_name")["status"] == "error"
+    assert [b.id for b in participant_two.query_bids_between(start=started)] == bid_ids
+    assert [b.id for b in participant_two.query_bids_between(
+        auction_id=ipad_auction_id, newest_first=True)] == bid_ids[::-1]
+    earlier = participant_two.query_bids_between(end=started)
+    assert earlier and all(b.submitted_at <= started for b in earlier)
+    assert not set(b.id for b in earlier) & set(bid_ids)
+
+    # Paged by time, one bid at a time.
+    paged, cursor = [], 0
+    while True:
+        ret = participant_two.query_bids_between(start=started, page_size=1, cursor=cursor)
+        paged += [b.id for b in ret["bids"]]
+        cursor = ret["cursor"]
+        if cursor == 0:
+            break
+    assert paged == bid_ids
+
+    # Once started, an auction leaves the unstarted ones.
+    auctioneer_one.start_auction(unstarted_ids[0])
+    assert unstarted_ids[0] not in [a.id for a in auctioneer_one.query_auctions_between(
+        "created_at", status_code=const.AUCTION_STATUS_CREATED)]
+    auctioneer_one.call_auction(unstarted_ids[0])
+
+    # Closed auctions move to the archive with their bids, out of the live
+    # records and indexes; summaries, even worked out anew, stay the same.
+    expected = auctioneer_one.query_latest_summary_for_item("iphone")
+    assert archive.archive_closed_auctions(retention=3600) == 0
+    assert archive.archive_closed_auctions(retention=0, batch_size=2, pause=0) == 4
+    assert Auction.one(ipad_auction_id) is None
+    assert not participant_two.query_bids_between(auction_id=ipad_auction_id)
+    assert auctioneer_one.query_auctions_between("closed_at") == []
+    archived = ArchivedAuction.one(ipad_auction_id)
+    assert archived.auction().id == ipad_auction_id
+    assert [b.id for b in archived.bids()] == bid_ids[::-1]
+    assert auctioneer_one.query_latest_summary_for_item("iphone") == expected
+    rmanager.delete_one_record(summary.CATEGORY, "iphone")
+    assert auctioneer_one.query_latest_summary_for_item("iphone") == expected
+    assert len(consistency.check_item_summaries(repair=True)) == 1
+    assert consistency.check_item_summaries() == []
+    ret = auctioneer_one.create_auction("iphone")
+    assert "Auction already exists for this item." in ret["errors"]
+
+    # Archived auctions leave the counts per status, not the sales.
+    ret = auctioneer_one.query_aggregates()
+    assert ret["auctions"][const.AUCTION_STATUS_CALLED_SUCCESS] == 0
+    assert (ret["called"], ret["sold"], ret["sold_volume"]) == (4, 2, 580.0)
+    assert consistency.check_aggregates() is None
+    aggregates.set_counters({"called": 0, "sold": 0, "sold_volume": 0})
+    assert consistency.check_aggregates(repair=True)
+    assert consistency.check_aggregates() is None
+
+    # Timed auctions are called by the scheduler once due; bids in their last
+    # seconds extend them.
+    auctioneer = Auctioneer(save=True)
+    ret = auctioneer.register_item_and_start_auction("timed-0", 100, ends_at=time.time() - 1)
+    assert "Auction end time must be in the future." in ret["errors"]
+    ret = auctioneer.create_auction("macbook", extension=10)
+    assert "Only timed auctions can be extended." in ret["errors"]
+
+    ends_at = time.time() + 0.5
+    timed_ids = [
+        auctioneer.register_item_and_start_auction(
+            "timed-{}".format(i), 100, ends_at=ends_at, extension=30)["auction_id"]
+        for i in range(3)]
+    assert scheduler.due_auctions() == []
+    assert scheduler.next_deadline() == ends_at
+
+    ret = participant_one.submit_bid_for_auction(timed_ids[1], 150)
+    assert ret["status"] == "success"
+    extended = Auction.one(timed_ids[1]).ends_at
+    assert extended >= ends_at + 29
+    assert rmanager.scored_members("auction", deadlines_key())[-1] == (timed_ids[1], extended)
+    assert participant_two.submit_bid_for_auction(timed_ids[2], 120)["status"] == "success"
+    assert auctioneer.call_auction(timed_ids[2])["status"] == "success"
+
+    time.sleep(0.6)
+    ret = participant_one.submit_bid_for_auction(timed_ids[0], 150)
+    assert "This auction is currently not in progress." in ret["errors"]
+    assert scheduler.due_auctions() == [timed_ids[0]]
+    assert scheduler.call_due_auctions(batch_size=1) == 1
+    assert Auction.one(timed_ids[0]).status == const.AUCTION_STATUS_CALLED_FAIL
+    assert Auction.one(timed_ids[1]).status == const.AUCTION_STATUS_IN_PROGRESS
+    assert participant_two.submit_bid_for_auction(timed_ids[1], 160)["status"] == "success"
+
+    assert scheduler.call_due_auctions(now=extended + 60, threads=1) == 1
+    assert scheduler.call_due_auctions(now=extended + 60) == 0
+    ret = auctioneer.query_latest_summary_for_item("timed-1")
+    assert ret["item"]["status_code"] == const.ITEM_STATUS_SOLD
+    assert ret["prevailing_bid"]["participant_id"] == participant_two.id
+    assert scheduler.next_deadline() is None
+
+    # Calling an auction stops its bids first, so bids coming in can't hold
+    # it up; one stopped by a caller gone before closing it takes no more
+    # bids, and the next call closes it.
+    auction_id = auctioneer.register_item_and_start_auction("busy", 100)["auction_id"]
+    bidding = threading.Event()
+    bidding.set()
+
+    assert participant_two.submit_bid_for_auction(auction_id, 100)["status"] == "success"
+
+    def keep_bidding(price=100):
+        while bidding.is_set():
+            price += 1
+            participant_one.submit_bid_for_auction(auction_id, price)
+
+    bidder = threading.Thread(target=keep_bidding)
+    bidder.start()
+    assert auctioneer.call_auction(auction_id)["status"] == "success"
+    bidding.clear()
+    bidder.join()
+    assert Auction.one(auction_id).status == const.AUCTION_STATUS_CALLED_SUCCESS
+
+    auction_id = auctioneer.register_item_and_start_auction("stalled", 100)["auction_id"]
+    assert participant_one.submit_bid_for_auction(auction_id, 120)["status"] == "success"
+    ret = CLOSE_AUCTION_SCRIPT(
+        [rmanager.record_key("auction", auction_id)],
+        [const.AUCTION_STATUS_IN_PROGRESS, time.time(), ""])
+    assert ret == "ok"
+    ret = participant_two.submit_bid_for_auction(auction_id, 130)
+    assert "This auction is currently not in progress." in ret["errors"]
+    auction = Auction.one(auction_id)
+    assert auction.status == const.AUCTION_STATUS_IN_PROGRESS
+    assert auctioneer.call_auction(auction_id)["status"] == "success"
+    assert Auction.one(auction_id).status == const.AUCTION_STATUS_CALLED_SUCCESS
+    assert auction_id in [
+        a.id for a in Auction.between("closed_at", start=auction.closed_at)]
+    ret = auctioneer.call_auction(auction_id)
+    assert ret["errors"] == [
+        "This auction cannot be ended because it is currently not in progress."]
+
+    # Scripts run in one go fail one at a time.
+    def fail_bad(r, keys, args):
+        if args[0] == b"bad":
+            raise Exception("bad")
+        return "ok"
+
+    script = rmanager.Script(
+        'if ARGV[1] == "bad" then return redis.error_reply("bad") end return "ok"',
+        fail_bad)
+    key = rmanager.record_key("test", "script")
+    ret = script.run_many([([key], ["good"]), ([key], ["bad"]), ([key], ["good"])],
+                          raise_on_error=False)
+    assert ret[::2] == ["ok", "ok"] and isinstance(ret[1], Exception)
+
+    # A worker's bid turned down for being below one that failed (here, on
+    # a bidder's index of the wrong type, which shards spread) is checked
+    # against storage after all.
+    if not rmanager.current_settings()["shards"]:
+        auction_id = auctioneer_one.register_item_and_start_auction(
+            "owned", 1)["auction_id"]
+        broken = rmanager.index_key(Bid.category, "participant_id", "broken")
+        rmanager.get_backend().hset(broken, "not", "a set")
+        owned = bidpool.OwnedAuctions()
+        results = owned.process([
+            (0, auction_id, 10, "broken"), (1, auction_id, 8, participant_two.id)])
+        assert results[0][2] is not None and results[1][1]["status"] == "success"
+        assert [b.offer_price for b in Auction.top_bids(auction_id, 3)] == [8]
+        rmanager.get_backend().delete(broken)
+
+    # Through bid workers, each auction's bids are taken in submission order
+    # by its one worker; workers need storage they share, so not in memory.
+    settings = rmanager.current_settings()
+    if all(dict(settings, **node)["backend"] == "redis" for node in settings["shards"] or [{}]):
+        auctioneer = Auctioneer(save=True)
+        auction_ids = [
+            auctioneer.register_item_and_start_auction("pooled-{}".format(i), 1)["auction_id"]
+            for i in range(4)]
+        rmanager.configure(bid_workers=2, bid_batch_size=3)
+        pool = bidpool.get_pool()
+        assert len(set(pool.owner(a) for a in auction_ids * 2)) <= 2
+
+        prices = [5, 3, 7, 7, 6, 9, 0, 12]
+        pending = [
+            (pool.submit(a, price, participant_one.id), price)
+            for price in prices for a in auction_ids]
+        results = [(p.result(10), price) for p, price in pending]
+        assert [r["status"] for r, _ in results] == [
+            s for s in ["success", "error", "success", "error", "error", "success",
+                        "error", "success"] for _ in auction_ids]
+        assert [r["errors"] for r, price in results if price == 0] == [
+            ["Not a valid bid price for submission."]] * len(auction_ids)
+        for auction_id in auction_ids:
+            assert [b.offer_price for b in Auction.top_bids(auction_id, 10)] == [12, 9, 7, 5]
+        for price in (float("nan"), float("inf")):
+            ret = pool.submit_bid(auction_ids[0], price, participant_one.id)
+            assert "Not a valid bid price for submission." in ret["errors"]
+
+        # Bids accepted and auctions called elsewhere are honoured.
+        assert Auction.accept_bid(auction_ids[0], 20, participant_two.id)["status"] == "success"
+        ret = participant_one.submit_bid_for_auction(auction_ids[0], 15)
+        assert "Bid must be higher than the current highest bid." in ret["errors"]
+        ret = participant_one.submit_bid_for_auction(auction_ids[0], 25)
+        assert ret["status"] == "success"
+        assert Auction.one(auction_ids[0]).highest_bid_id == ret["bid_id"]
+        assert auctioneer.call_auction(auction_ids[1])["status"] == "success"
+        ret = participant_one.submit_bid_for_auction(auction_ids[1], 30)
+        assert "This auction is currently not in progress." in ret["errors"]
+        ret = participant_one.submit_bid_for_auction("no-such-auction", 30)
+        assert "This auction does not exist." in ret["errors"]
+
+        rmanager.configure(bid_workers=0)
+        assert bidpool.get_pool() is None
+        ret = participant_one.submit_bid_for_auction(auction_ids[2], 13)
+        assert ret["status"] == "success"
+
+    # Spread over shards, an auction and its bids go to their item's shard
+    # (braces in its name or not), and category-wide reads gather from every
+    # shard.
+    rmanager.configure(shards=[{"backend": "memory"}] * 3)
+    backend = rmanager.get_backend()
+    auctioneer = Auctioneer(save=True)
+    participant = Participant(save=True)
+    auction_ids = []
+    item_names = ["item-{}".format(i) for i in range(17)] + ["a}b", "{}", "{{x}y"]
+    for item_name in item_names:
+        ret = auctioneer.register_item_and_start_auction(item_name, 100)
+        assert ret["status"] == "success"
+        auction_ids.append(ret["auction_id"])
+        ret = participant.submit_bid_for_auction(ret["auction_id"], 150)
+        assert ret["status"] == "success"
+
+        shard = backend.shard_for(rmanager.record_key("item", item_name))
+        assert backend.shard_for(rmanager.record_key(summary.CATEGORY, item_name)) == shard
+        assert backend.shard_for(rmanager.record_key("auction", auction_ids[-1])) == shard
+        assert backend.shard_for(rmanager.record_key("bid", ret["bid_id"])) == shard
+        summary_record = rmanager.get_one_record(summary.CATEGORY, item_name)
+        assert summary_record["highest_bid_id"] == ret["bid_id"]
+
+    assert len(set(backend.shard_for(rmanager.record_key("auction", a))
+                   for a in auction_ids)) > 1
+    assert sorted(a.id for a in participant.query_all_live_auctions()) == sorted(auction_ids)
+    paged, cursor = [], 0
+    while True:
+        ret = participant.query_all_live_auctions(page_size=3, cursor=cursor)
+        paged += [a.id for a in ret["auctions"]]
+        cursor = ret["cursor"]
+        if cursor == 0:
+            break
+    assert sorted(paged) == sorted(auction_ids)
+    ret = auctioneer.call_auction(auction_ids[0])
+    assert ret["status"] == "success"
+    assert len(participant.query_all_live_auctions()) == 19
+    rmanager.configure(shards=rmanager.DEFAULT_SETTINGS["shards"])